@@ -0,0 +1,286 @@
+#
+# Story Time App
+# Benchmarks the story_time_service functions and the website and API routes against seeded datasets.
+#
+# For each dataset size, the DB is truncated and loaded with db/load_test_data.py (so run this against a local
+# benchmark DB only), then each benchmark is run repeatedly and its latency percentiles, queries per call and peak
+# memory are reported. Results can be saved as a baseline and later runs compared against it.
+#
+# Example: python bench/run_benchmarks.py --sizes 1000 100000 --save-baseline
+#          python bench/run_benchmarks.py --sizes 1000 100000 --compare
+#
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "bench"
+
+from sqlalchemy import event
+
+from db import load_test_data
+from storytime import page_cache, story_time_service
+from storytime.app import app
+from storytime.story_time_db_init import db_engine, db_session
+
+BENCH_DATASET_SIZES = (1000, 10000, 100000)
+BENCH_ITERATIONS = 200
+BENCH_WARMUP_ITERATIONS = 10
+BENCH_SEED = 1
+
+BASELINES_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'baselines')
+DEFAULT_BASELINE = 'baseline.json'
+# A benchmark has regressed if its p95 latency is more than this many times the baseline's
+REGRESSION_THRESHOLD = 1.25
+
+PERCENTILES = (50, 95, 99)
+
+# A named function to time, with a function run untimed before each call (e.g. to clear a cache)
+Benchmark = namedtuple('Benchmark', ['name', 'run', 'setup'])
+
+
+def percentile(sorted_values: list, pct: float):
+    """
+    Gets a percentile of a list of values using the nearest rank method.
+    :param sorted_values: the values, sorted ascending
+    :param pct: the percentile, from 0 to 100
+    :return: the value at the percentile
+    """
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def end_request():
+    """
+    Ends the simulated request of a service benchmark, as the app does when its app context is torn down.
+    """
+    db_session.remove()
+
+
+def get_url(client, url: str, expected_status: int = 200):
+    """
+    Makes a function that requests a url from the Flask test client.
+    """
+
+    def run():
+        response = client.get(url)
+        if response.status_code != expected_status:
+            raise RuntimeError('GET {} returned {}, expected {}'.format(url, response.status_code, expected_status))
+        # Consume streamed responses
+        response.get_data()
+
+    return run
+
+
+def call_service(func, *args, **kwargs):
+    """
+    Makes a function that calls a service function as a request would, with its own DB session.
+    """
+
+    def run():
+        try:
+            func(*args, **kwargs)
+        finally:
+            end_request()
+
+    return run
+
+
+def make_benchmarks(client):
+    """
+    Makes the benchmarks to run against the current dataset.
+    :param client: the Flask test client
+    :return: a list of Benchmarks
+    """
+    story_id = story_time_service.get_published_stories(count=1)[0].id
+    end_request()
+    clear_page_cache = page_cache.page_cache.invalidate
+    return [
+        Benchmark('service.get_published_stories', call_service(
+            story_time_service.get_published_stories, count=story_time_service.STORIES_PAGE_SIZE), None),
+        Benchmark('service.get_published_stories_page', call_service(
+            story_time_service.get_published_stories_page), None),
+        Benchmark('service.get_published_stories_count', call_service(
+            story_time_service.get_published_stories_count), None),
+        Benchmark('service.get_story_by_id', call_service(story_time_service.get_story_by_id, story_id), None),
+        Benchmark('service.get_story_random', call_service(story_time_service.get_story_random), None),
+        Benchmark('service.search_stories', call_service(story_time_service.search_stories, 'dragon castle'), None),
+        Benchmark('route.index', get_url(client, '/'), clear_page_cache),
+        Benchmark('route.index_cached', get_url(client, '/'), None),
+        Benchmark('route.view_story', get_url(client, '/stories/{}'.format(story_id)), clear_page_cache),
+        Benchmark('route.view_story_random', get_url(client, '/stories/random', expected_status=302), None),
+        Benchmark('route.api_stories', get_url(client, '/api/stories'), None),
+        Benchmark('route.api_story', get_url(client, '/api/stories/{}'.format(story_id)), None),
+        Benchmark('route.api_search', get_url(client, '/api/search?q=dragon'), None)
+    ]
+
+
+def run_benchmark(benchmark: Benchmark, iterations: int, warmup_iterations: int):
+    """
+    Runs a benchmark and measures it.
+    :param benchmark: the benchmark
+    :param iterations: the number of timed calls
+    :param warmup_iterations: the number of untimed calls made first
+    :return: a dict of the latency percentiles and mean (ms), the mean number of queries per call and the peak memory
+    allocated during a call (KB)
+    """
+    for _ in range(warmup_iterations):
+        if benchmark.setup:
+            benchmark.setup()
+        benchmark.run()
+
+    num_queries = 0
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        nonlocal num_queries
+        num_queries += 1
+
+    timings = []
+    event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for _ in range(iterations):
+            if benchmark.setup:
+                benchmark.setup()
+            start = time.perf_counter()
+            benchmark.run()
+            timings.append(time.perf_counter() - start)
+    finally:
+        event.remove(db_engine, 'before_cursor_execute', before_cursor_execute)
+
+    # Memory is traced in a separate call, as tracing slows down allocation and would skew the timings
+    if benchmark.setup:
+        benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    result = {'p{}_ms'.format(pct): round(percentile(timings, pct) * 1000, 3) for pct in PERCENTILES}
+    result['mean_ms'] = round(sum(timings) / len(timings) * 1000, 3)
+    result['queries'] = round(num_queries / iterations, 2)
+    result['peak_memory_kb'] = round(peak_memory / 1024, 1)
+    return result
+
+
+def seed_dataset(size: int, seed: int):
+    """
+    Replaces the data in the DB with a synthetic dataset of the given number of stories.
+    :param size: the number of stories
+    :param seed: the random number generator seed
+    """
+    load_test_data.load_test_data(load_test_data.parse_args(
+        ['--truncate', '--seed', str(seed), '--stories', str(size), '--users', str(max(1, size // 100))]))
+    story_time_service.reset_caches()
+    page_cache.page_cache.invalidate()
+
+
+def run_benchmarks(args):
+    """
+    Seeds each dataset size and runs the benchmarks against it.
+    :param args: the parsed command line arguments
+    :return: the results, as a dict of metadata and of dataset size to benchmark name to measurements
+    """
+    results = {}
+    client = app.test_client()
+    for size in args.sizes:
+        if not args.no_seed:
+            print('Seeding {} stories'.format(size))
+            seed_dataset(size, args.seed)
+        size_results = results.setdefault(str(size), {})
+        for benchmark in make_benchmarks(client):
+            if args.only and not any(name in benchmark.name for name in args.only):
+                continue
+            size_results[benchmark.name] = run_benchmark(benchmark, args.iterations, args.warmup)
+            print('{:>8} {:<40} {}'.format(size, benchmark.name, format_result(size_results[benchmark.name])))
+    return {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'iterations': args.iterations,
+            'seed': args.seed
+        },
+        'results': results
+    }
+
+
+def format_result(result: dict):
+    return 'p50 {p50_ms:>8.2f}ms  p95 {p95_ms:>8.2f}ms  p99 {p99_ms:>8.2f}ms  queries {queries:>5}  ' \
+           'peak {peak_memory_kb:>9.1f}KB'.format(**result)
+
+
+def compare_to_baseline(run: dict, baseline: dict, threshold: float):
+    """
+    Compares the p95 latency of each benchmark in a run to the baseline, printing the ratios.
+    :param run: the results of this run
+    :param baseline: the baseline results
+    :param threshold: the ratio above which a benchmark has regressed
+    :return: a list of (dataset size, benchmark name) that regressed
+    """
+    regressions = []
+    for size, size_results in run['results'].items():
+        for name, result in size_results.items():
+            baseline_result = baseline['results'].get(size, {}).get(name)
+            if not baseline_result:
+                continue
+            ratio = result['p95_ms'] / baseline_result['p95_ms'] if baseline_result['p95_ms'] else 1
+            query_change = result['queries'] - baseline_result['queries']
+            regressed = ratio > threshold or query_change >= 1
+            print('{:>8} {:<40} p95 x{:.2f}  queries {:+.2f}{}'.format(
+                size, name, ratio, query_change, '  REGRESSED' if regressed else ''))
+            if regressed:
+                regressions.append((size, name))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the Story Time service functions and routes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_DATASET_SIZES,
+                        help='numbers of stories in the seeded datasets')
+    parser.add_argument('--iterations', type=int, default=BENCH_ITERATIONS, help='timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=BENCH_WARMUP_ITERATIONS, help='untimed calls per benchmark')
+    parser.add_argument('--seed', type=int, default=BENCH_SEED, help='dataset random number generator seed')
+    parser.add_argument('--only', nargs='+', help='only run benchmarks whose names contain one of these strings')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='benchmark the data already in the DB (with a single --sizes value as its label)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file name in bench/baselines')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results to the baseline and exit with status 1 if any regressed')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='p95 latency ratio to the baseline above which a benchmark has regressed')
+    args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error('--iterations must be at least 1')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    baseline_path = os.path.join(BASELINES_DIR, args.baseline)
+    run = run_benchmarks(args)
+
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(run, baseline_file, indent=2, sort_keys=True)
+        print('Saved baseline {}'.format(baseline_path))
+
+    if args.compare:
+        with open(baseline_path, 'r') as baseline_file:
+            regressions = compare_to_baseline(run, json.load(baseline_file), args.threshold)
+        if regressions:
+            print('{} benchmarks regressed'.format(len(regressions)))
+            sys.exit(1)
@@ -0,0 +1,19 @@
+#
+# Story Time App
+# Creates the resized image variants of uploaded images that do not have them yet.
+#
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from storytime import story_time_service
+from storytime.app import app
+
+if __name__ == '__main__':
+    with app.app_context():
+        num_images = story_time_service.backfill_image_variants()
+    print('Created image variants for {} images'.format(num_images))
@@ -0,0 +1,19 @@
+#
+# Story Time App
+# Splits and saves the paragraphs of stories saved before paragraphs were stored with them.
+#
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from storytime import story_time_service
+from storytime.app import app
+
+if __name__ == '__main__':
+    with app.app_context():
+        num_stories = story_time_service.backfill_story_paragraphs()
+    print('Saved the paragraphs of {} stories'.format(num_stories))
@@ -2,11 +2,13 @@
 --  Table definitions for the Story Time project.
 --
 
--- Delete
+-- Delete (including the record of applied migrations, so db/migrate.py applies them all to the new tables)
+DROP TABLE IF EXISTS schema_migration;
+DROP TABLE IF EXISTS story_count;
 DROP TABLE IF EXISTS story_category;
 DROP TABLE IF EXISTS category;
 DROP TABLE IF EXISTS story;
-DROP TABLE IF EXISTS file_upload;
+DROP TABLE IF EXISTS upload_file;
 DROP TABLE IF EXISTS sec_user;
 
 -- Recreate
@@ -3,11 +3,7 @@
 # Creates test data for the integration tests and development environment setup.
 #
 
-import json
 import shutil
-import time
-
-import httplib2
 
 if __name__ == "__main__" and __package__ is None:
     from sys import path
@@ -16,12 +12,16 @@ if __name__ == "__main__" and __package__ is None:
     path.append(dir(path[0]))
     __package__ = "db"
 
+from db.synthetic_data import TextGenerator
 from storytime import story_time_service
 from storytime.story_time_db_init import Category, Story, User, db_session
 
 # TODO fill in
 APP_UPLOAD_DIR = None
 
+# Seed for the generated story text, so the test data is the same on every run
+TEST_DATA_SEED = 1
+
 
 def delete_and_recreate_test_data():
     """
@@ -55,11 +55,8 @@ def delete_and_recreate_test_data():
             Category(label='Musical', description='Musicals'))
         cat_nonfiction_id = story_time_service.create_category(
             Category(label='Nonfiction', description='True Stories'))
-        cat_scary = story_time_service.get_category_by_id(category_id=cat_scary_id)
-        cat_funny = story_time_service.get_category_by_id(category_id=cat_funny_id)
-        cat_animal = story_time_service.get_category_by_id(category_id=cat_animal_id)
-        cat_musical = story_time_service.get_category_by_id(category_id=cat_musical_id)
-        cat_nonfiction = story_time_service.get_category_by_id(category_id=cat_nonfiction_id)
+        cat_scary, cat_funny, cat_animal, cat_musical, cat_nonfiction = story_time_service.get_categories_by_ids(
+            category_ids=[cat_scary_id, cat_funny_id, cat_animal_id, cat_musical_id, cat_nonfiction_id])
         num_rows_created = db_session.query(Category).count()
         print('Created {} categories'.format(num_rows_created))
 
@@ -71,19 +68,18 @@ def delete_and_recreate_test_data():
                               categories=[cat_funny, cat_animal, cat_musical])
         story_initial_id = story_time_service.create_story(story_initial)
 
-        # Update story text for each story from lipsum generator (every second so we don't hit server too hard)
-        url = 'https://lipsum.com/feed/json?what=paras&amount=5&start=yes'
-        for story in db_session.query(Story).all():
-            h = httplib2.Http()
-            json_result = json.loads(str(h.request(url, 'GET')[1], 'utf-8'))
-            story.story_text = json_result['feed']['lipsum']
-            db_session.add(story)
-            db_session.commit()
-            time.sleep(1)
+        # Generate story text for each story
+        text = TextGenerator(seed=TEST_DATA_SEED)
+        for story in db_session.query(Story).order_by(Story.id).all():
+            story.story_text = text.make_story_text()
+        db_session.commit()
 
         num_rows_created = db_session.query(Story).count()
         print('Created {} stories'.format(num_rows_created))
 
+        # Stories were deleted in bulk above, so rebuild the published story counts
+        story_time_service.reconcile_story_counts()
+
         db_session.commit()
     except Exception as exc:
         print('Error creating test data:')
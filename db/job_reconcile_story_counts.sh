@@ -0,0 +1,2 @@
+#!/bin/sh
+python3 /var/www/fsw-p4-story-time/db/reconcile_story_counts.py
@@ -0,0 +1,204 @@
+#
+# Story Time App
+# Generates a large synthetic data set offline and bulk loads it with COPY, for load testing and profiling.
+#
+# The same arguments (including --seed) always generate the same data. Generated rows are added to any existing
+# data unless --truncate is given. Run against a load testing DB only, while the app is stopped: ids are assigned
+# here rather than by the DB sequences, which are moved past the loaded ids afterwards.
+#
+# Example: python db/load_test_data.py --truncate --users 10000 --stories 1000000
+#
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import time
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from db.synthetic_data import TextGenerator
+from storytime import story_time_service
+from storytime.story_time_db_init import db_engine
+
+# Rows are generated and sent to the DB this many at a time, which bounds memory use
+COPY_BATCH_SIZE = 10000
+
+SQL_TRUNCATE = 'TRUNCATE story_count, story_category, story, category, upload_file, sec_user RESTART IDENTITY'
+SQL_GET_MAX_ID = 'SELECT coalesce(max(id), 0) FROM {}'
+SQL_SET_SEQUENCE = "SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {0}), " \
+                   "false)"
+SQL_COPY = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'
+SQL_ANALYZE = 'ANALYZE {}'
+
+USER_COLUMNS = ('id', 'name', 'email', 'active')
+CATEGORY_COLUMNS = ('id', 'label', 'description')
+STORY_COLUMNS = ('id', 'user_id', 'title', 'description', 'story_text', 'paragraphs', 'published', 'date_created',
+                 'date_last_modified')
+STORY_CATEGORY_COLUMNS = ('story_id', 'category_id')
+
+
+def copy_rows(cursor, table: str, columns: tuple, rows):
+    """
+    Loads rows into a table with COPY, COPY_BATCH_SIZE rows at a time.
+    :param cursor: a psycopg2 cursor
+    :param table: the name of the table
+    :param columns: the names of the columns, in the order of the values in each row
+    :param rows: an iterable of row tuples
+    :return: the number of rows loaded
+    """
+    sql = SQL_COPY.format(table, ', '.join(columns))
+    num_rows = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        num_rows += 1
+        if num_rows % COPY_BATCH_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+    return num_rows
+
+
+def generate_users(first_id: int, num_users: int):
+    """
+    Generates user rows.
+    """
+    for user_id in range(first_id, first_id + num_users):
+        yield user_id, 'User {}'.format(user_id), 'user{}@example.com'.format(user_id), True
+
+
+def generate_categories(text: TextGenerator, first_id: int, num_categories: int):
+    """
+    Generates category rows.
+    """
+    for category_id in range(first_id, first_id + num_categories):
+        yield category_id, 'Category {}'.format(category_id), text.make_description()
+
+
+def generate_stories(text: TextGenerator, args, first_id: int, user_ids: range, category_ids: list,
+                     story_categories: list):
+    """
+    Generates story rows, appending each story's (story_id, category_id) rows to story_categories.
+    """
+    rng = text.rng
+    now = datetime.datetime.utcnow()
+    span_seconds = args.days * 24 * 60 * 60
+    for story_id in range(first_id, first_id + args.stories):
+        date_created = now - datetime.timedelta(seconds=rng.randrange(span_seconds))
+        date_last_modified = min(now, date_created + datetime.timedelta(seconds=rng.randrange(30 * 24 * 60 * 60)))
+        num_categories = rng.randint(0, min(args.max_categories_per_story, len(category_ids)))
+        for category_id in rng.sample(category_ids, num_categories):
+            story_categories.append((story_id, category_id))
+        user_id, title, description = rng.choice(user_ids), text.make_title(), text.make_description()
+        story_text = text.make_story_text(num_paragraphs=rng.randint(1, args.max_paragraphs))
+        yield (story_id, user_id, title, description, story_text,
+               json.dumps(story_time_service.split_story_paragraphs(story_text)), rng.random() < args.published_ratio,
+               date_created, date_last_modified)
+
+
+def generate_story_categories(story_categories: list):
+    """
+    Generates the story category rows collected by generate_stories, removing them from the list.
+    """
+    while story_categories:
+        yield story_categories.pop()
+
+
+def load_test_data(args):
+    """
+    Generates and loads the synthetic data set described by the command line arguments.
+    :param args: the parsed command line arguments
+    """
+    text = TextGenerator(seed=args.seed)
+    connection = db_engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        if args.truncate:
+            cursor.execute(SQL_TRUNCATE)
+
+        first_ids = {}
+        for table in ('sec_user', 'category', 'story'):
+            cursor.execute(SQL_GET_MAX_ID.format(table))
+            first_ids[table] = cursor.fetchone()[0] + 1
+
+        start = time.monotonic()
+        num_rows = copy_rows(cursor, 'sec_user', USER_COLUMNS, generate_users(first_ids['sec_user'], args.users))
+        print('Loaded {} users'.format(num_rows))
+        num_rows = copy_rows(cursor, 'category', CATEGORY_COLUMNS,
+                             generate_categories(text, first_ids['category'], args.categories))
+        print('Loaded {} categories'.format(num_rows))
+
+        # Stories are only linked to the categories generated here, so the data set is the same on every run
+        category_ids = list(range(first_ids['category'], first_ids['category'] + args.categories))
+        user_ids = range(first_ids['sec_user'], first_ids['sec_user'] + args.users)
+        story_categories = []
+        stories = generate_stories(text, args, first_ids['story'], user_ids, category_ids, story_categories)
+        num_stories = 0
+        num_story_categories = 0
+        # Load the category links of each batch of stories after the batch, so they are never all held in memory
+        while True:
+            num_rows = copy_rows(cursor, 'story', STORY_COLUMNS,
+                                 (row for _, row in zip(range(COPY_BATCH_SIZE), stories)))
+            num_story_categories += copy_rows(cursor, 'story_category', STORY_CATEGORY_COLUMNS,
+                                              generate_story_categories(story_categories))
+            num_stories += num_rows
+            if num_rows < COPY_BATCH_SIZE:
+                break
+            print('Loaded {} stories'.format(num_stories))
+        print('Loaded {} stories and {} story categories in {:.1f}s'.format(
+            num_stories, num_story_categories, time.monotonic() - start))
+
+        for table in ('sec_user', 'category', 'story'):
+            cursor.execute(SQL_SET_SEQUENCE.format(table))
+        # The planner needs fresh statistics to choose the same plans it would at production scale
+        for table in ('sec_user', 'category', 'story', 'story_category'):
+            cursor.execute(SQL_ANALYZE.format(table))
+        connection.commit()
+    except Exception as exc:
+        connection.rollback()
+        raise exc
+    finally:
+        connection.close()
+
+    # The stories were loaded without going through story_time_service, so rebuild the published story counts
+    story_time_service.reconcile_story_counts()
+    print('Reconciled story counts: {} published stories'.format(story_time_service.get_published_stories_count()))
+
+
+def parse_args(argv: list = None):
+    """
+    Parses the command line arguments.
+    :param argv: the arguments to parse (defaults to the command line)
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description='Generates a synthetic Story Time data set and bulk loads it.')
+    parser.add_argument('--seed', type=int, default=1, help='random number generator seed')
+    parser.add_argument('--users', type=int, default=1000, help='number of users to create')
+    parser.add_argument('--categories', type=int, default=20, help='number of categories to create')
+    parser.add_argument('--stories', type=int, default=100000, help='number of stories to create')
+    parser.add_argument('--max-categories-per-story', type=int, default=3,
+                        help='maximum number of categories linked to each story')
+    parser.add_argument('--max-paragraphs', type=int, default=8, help='maximum number of paragraphs in each story')
+    parser.add_argument('--published-ratio', type=float, default=0.9, help='fraction of stories that are published')
+    parser.add_argument('--days', type=int, default=3 * 365, help='stories are created over this many past days')
+    parser.add_argument('--truncate', action='store_true', help='delete all existing data first')
+    args = parser.parse_args(argv)
+    if args.users < 1 or args.stories < 0 or args.categories < 0 or args.days < 1:
+        parser.error('--users and --days must be at least 1, and --stories and --categories at least 0')
+    return args
+
+
+if __name__ == '__main__':
+    load_test_data(parse_args())
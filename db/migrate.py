@@ -0,0 +1,99 @@
+#
+# Story Time App
+# Applies the versioned, forward-only schema migrations in db/migrations to the DB.
+#
+# Migrations are SQL files named <version>_<description>.sql, applied in version order, each in its own
+# transaction. Applied versions are recorded in the schema_migration table, so running this again only applies
+# new migrations.
+#
+
+import os
+import re
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from storytime.story_time_db_init import db_engine
+
+MIGRATIONS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'migrations')
+# The baseline schema the migrations are applied to
+CREATE_SCHEMA_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'create_schema.sql')
+MIGRATION_FILE_NAME_PATTERN = re.compile(r'^(\d+)_\w+\.sql$')
+
+# Arbitrary key for the advisory lock that stops two runners applying migrations at the same time
+MIGRATION_LOCK_KEY = 8472301
+
+SQL_CREATE_MIGRATION_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_migration (
+      version               TEXT PRIMARY KEY,
+      date_applied          TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'utc')
+    )'''
+SQL_GET_APPLIED_VERSIONS = 'SELECT version FROM schema_migration'
+SQL_INSERT_VERSION = 'INSERT INTO schema_migration (version) VALUES (%s)'
+SQL_LOCK = 'SELECT pg_advisory_lock(%s)'
+SQL_UNLOCK = 'SELECT pg_advisory_unlock(%s)'
+
+
+def get_migrations():
+    """
+    Gets the migration files in the migrations directory.
+    :return: a list of (version, file path) tuples ordered by version
+    """
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE_NAME_PATTERN.match(file_name)
+        if match:
+            migrations.append((match.group(1), os.path.join(MIGRATIONS_DIR, file_name)))
+    return sorted(migrations, key=lambda migration: int(migration[0]))
+
+
+def apply_migrations(connection=None):
+    """
+    Applies the migrations that have not yet been applied to the DB.
+    :param connection: the DB-API connection to apply them with (or None to use, and then close, a connection from
+    the app's DB engine)
+    :return: the list of versions applied
+    """
+    applied_now = []
+    close_connection = connection is None
+    if close_connection:
+        connection = db_engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(SQL_LOCK, (MIGRATION_LOCK_KEY,))
+    try:
+        cursor.execute(SQL_CREATE_MIGRATION_TABLE)
+        cursor.execute(SQL_GET_APPLIED_VERSIONS)
+        applied = {row[0] for row in cursor.fetchall()}
+        connection.commit()
+
+        for version, file_path in get_migrations():
+            if version in applied:
+                continue
+            with open(file_path, 'r') as migration_file:
+                sql = migration_file.read()
+            try:
+                cursor.execute(sql)
+                cursor.execute(SQL_INSERT_VERSION, (version,))
+                connection.commit()
+            except Exception as exc:
+                connection.rollback()
+                raise RuntimeError('Migration {} failed: {}'.format(os.path.basename(file_path), exc)) from exc
+            applied_now.append(version)
+            print('Applied migration {}'.format(os.path.basename(file_path)))
+    finally:
+        # The lock is held by the DB session rather than the transaction, so release it explicitly
+        connection.rollback()
+        cursor.execute(SQL_UNLOCK, (MIGRATION_LOCK_KEY,))
+        connection.commit()
+        if close_connection:
+            connection.close()
+    return applied_now
+
+
+if __name__ == '__main__':
+    versions = apply_migrations()
+    print('Applied {} migrations'.format(len(versions)) if versions else 'DB schema is up to date')
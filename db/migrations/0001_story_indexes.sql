@@ -0,0 +1,18 @@
+--
+--  Indexes for the story_time_service queries.
+--
+
+-- Published story listings: WHERE published ORDER BY date_created DESC, id DESC (and the keyset cursor)
+CREATE INDEX IF NOT EXISTS story_published_date_created_idx ON story (published, date_created, id);
+
+-- Latest modification of published stories (API validators)
+CREATE INDEX IF NOT EXISTS story_published_date_last_modified_idx ON story (published, date_last_modified);
+
+-- User dashboard: WHERE user_id = ? ORDER BY date_last_modified DESC
+CREATE INDEX IF NOT EXISTS story_user_id_date_last_modified_idx ON story (user_id, date_last_modified);
+
+-- Category filter: EXISTS (... WHERE story_category.category_id = ?)
+CREATE INDEX IF NOT EXISTS story_category_category_id_idx ON story_category (category_id, story_id);
+
+-- Upload file lookups by file name
+CREATE INDEX IF NOT EXISTS upload_file_filename_idx ON upload_file (filename);
@@ -0,0 +1,27 @@
+--
+--  Full text search over story title, description and text.
+--
+
+ALTER TABLE story ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+-- Keep search_vector up to date on insert and on update of the searched columns. The text is capped so novel
+-- length stories stay within the tsvector size limit.
+CREATE OR REPLACE FUNCTION story_search_vector_update() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.search_vector :=
+    setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B') ||
+    setweight(to_tsvector('english', left(coalesce(NEW.story_text, ''), 200000)), 'C');
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS story_search_vector_trigger ON story;
+CREATE TRIGGER story_search_vector_trigger
+  BEFORE INSERT OR UPDATE OF title, description, story_text ON story
+  FOR EACH ROW EXECUTE PROCEDURE story_search_vector_update();
+
+-- Backfill existing stories (the trigger fires on the update)
+UPDATE story SET title = title WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS story_search_vector_idx ON story USING GIN (search_vector);
@@ -0,0 +1,5 @@
+--
+--  Resized image variants of uploaded files.
+--
+
+ALTER TABLE upload_file ADD COLUMN IF NOT EXISTS variants JSONB;
@@ -0,0 +1,7 @@
+--
+--  Content addressed upload files: files are stored under the hash of their content and shared by the stories
+--  that upload the same content.
+--
+
+ALTER TABLE upload_file ADD COLUMN IF NOT EXISTS content_hash TEXT UNIQUE;
+ALTER TABLE upload_file ADD COLUMN IF NOT EXISTS ref_count INTEGER NOT NULL DEFAULT 1;
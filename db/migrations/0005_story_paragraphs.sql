@@ -0,0 +1,5 @@
+--
+--  The paragraphs of story text, split when a story is saved so viewing it does not split it again.
+--
+
+ALTER TABLE story ADD COLUMN IF NOT EXISTS paragraphs JSONB;
@@ -0,0 +1,23 @@
+--
+--  The number of published stories overall (scope 'all'), per category (scope 'category') and per user (scope
+--  'user'), kept up to date as stories are written and corrected by db/reconcile_story_counts.py.
+--
+
+CREATE TABLE IF NOT EXISTS story_count (
+  scope                 TEXT NOT NULL,
+  scope_id              INTEGER NOT NULL,
+  published_count       INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (scope, scope_id)
+);
+
+-- Fill in the counts of the existing stories (as the reconcile job does), so they are not counted from zero
+UPDATE story_count SET published_count = 0;
+
+INSERT INTO story_count (scope, scope_id, published_count)
+SELECT 'all', 0, count(*) FROM story WHERE published
+UNION ALL
+SELECT 'category', sc.category_id, count(*)
+FROM story_category sc JOIN story s ON s.id = sc.story_id WHERE s.published GROUP BY sc.category_id
+UNION ALL
+SELECT 'user', user_id, count(*) FROM story WHERE published AND user_id IS NOT NULL GROUP BY user_id
+ON CONFLICT (scope, scope_id) DO UPDATE SET published_count = EXCLUDED.published_count;
@@ -0,0 +1,18 @@
+--
+--  The time the published stories counted in each story_count row last changed, so the version of a story list
+--  is read with its count in one primary key lookup.
+--
+
+ALTER TABLE story_count ADD COLUMN IF NOT EXISTS last_modified TIMESTAMP;
+
+UPDATE story_count SET last_modified = (SELECT max(date_last_modified) FROM story WHERE published)
+WHERE scope = 'all';
+
+UPDATE story_count c SET last_modified = (
+  SELECT max(s.date_last_modified) FROM story_category sc JOIN story s ON s.id = sc.story_id
+  WHERE s.published AND sc.category_id = c.scope_id)
+WHERE scope = 'category';
+
+UPDATE story_count c SET last_modified = (
+  SELECT max(s.date_last_modified) FROM story s WHERE s.published AND s.user_id = c.scope_id)
+WHERE scope = 'user';
@@ -0,0 +1,17 @@
+#
+# Story Time App
+# Rebuilds the published story counts in the story_count table from the story tables.
+#
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from storytime import story_time_service
+
+if __name__ == '__main__':
+    story_time_service.reconcile_story_counts()
+    print('Reconciled story counts: {} published stories'.format(story_time_service.get_published_stories_count()))
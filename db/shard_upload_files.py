@@ -0,0 +1,20 @@
+#
+# Story Time App
+# Moves uploaded files stored in the flat upload directory into the sharded layout and updates their urls. Run once,
+# while the app is stopped, after upgrading to the sharded layout.
+#
+
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    from os.path import dirname as dir
+
+    path.append(dir(path[0]))
+    __package__ = "db"
+
+from storytime import story_time_service
+from storytime.app import app
+
+if __name__ == '__main__':
+    with app.app_context():
+        num_files = story_time_service.shard_upload_files()
+    print('Moved or updated {} upload files'.format(num_files))
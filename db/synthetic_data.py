@@ -0,0 +1,84 @@
+#
+# Story Time App
+# Generates synthetic story text offline from a seeded random number generator.
+#
+
+import random
+
+LOREM_WORDS = (
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor',
+    'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam', 'quis',
+    'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'ex', 'ea', 'commodo', 'consequat', 'duis',
+    'aute', 'irure', 'in', 'reprehenderit', 'voluptate', 'velit', 'esse', 'cillum', 'eu', 'fugiat', 'nulla',
+    'pariatur', 'excepteur', 'sint', 'occaecat', 'cupidatat', 'non', 'proident', 'sunt', 'culpa', 'qui', 'officia',
+    'deserunt', 'mollit', 'anim', 'id', 'est', 'laborum', 'curabitur', 'pretium', 'tincidunt', 'lacus', 'nunc',
+    'gravida', 'vulputate', 'mauris', 'vitae', 'ultricies', 'leo', 'integer', 'malesuada', 'felis', 'donec',
+    'dapibus', 'arcu', 'risus', 'quisque', 'sagittis', 'purus', 'semper', 'eget', 'duis', 'tellus', 'mattis',
+    'pellentesque', 'habitant', 'morbi', 'tristique', 'senectus', 'netus', 'fames', 'turpis', 'egestas', 'dragon',
+    'castle', 'forest', 'river', 'princess', 'robot', 'wizard', 'puppy', 'kitten', 'rocket', 'pirate', 'treasure',
+    'monster', 'garden', 'school', 'friend', 'storm', 'island', 'moon', 'star', 'giant', 'mouse', 'owl', 'song'
+)
+
+# Story text is assembled from a pool of pre-generated paragraphs so that generating millions of stories costs a few
+# random choices each rather than hundreds
+PARAGRAPH_POOL_SIZE = 2000
+
+
+def make_sentence(rng: random.Random, min_words: int = 6, max_words: int = 16):
+    """
+    Makes a sentence of random words.
+    :param rng: the random number generator
+    :param min_words: the minimum number of words in the sentence
+    :param max_words: the maximum number of words in the sentence
+    :return: the sentence
+    """
+    words = [rng.choice(LOREM_WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return '{}.'.format(' '.join(words).capitalize())
+
+
+def make_paragraph(rng: random.Random, min_sentences: int = 3, max_sentences: int = 8):
+    """
+    Makes a paragraph of random sentences.
+    :param rng: the random number generator
+    :param min_sentences: the minimum number of sentences in the paragraph
+    :param max_sentences: the maximum number of sentences in the paragraph
+    :return: the paragraph
+    """
+    return ' '.join(make_sentence(rng) for _ in range(rng.randint(min_sentences, max_sentences)))
+
+
+class TextGenerator:
+    """
+    TextGenerator makes titles, descriptions and story text from a seeded random number generator, so the same seed
+    always produces the same text.
+    """
+
+    def __init__(self, seed: int, paragraph_pool_size: int = PARAGRAPH_POOL_SIZE):
+        """
+        :param seed: the seed for the random number generator
+        :param paragraph_pool_size: the number of distinct paragraphs story text is assembled from
+        """
+        self.rng = random.Random(seed)
+        self._paragraphs = [make_paragraph(self.rng) for _ in range(paragraph_pool_size)]
+
+    def make_title(self):
+        """
+        Makes a story title.
+        :return: the title
+        """
+        return make_sentence(self.rng, min_words=2, max_words=6)[:-1].title()
+
+    def make_description(self):
+        """
+        Makes a story description.
+        :return: the description
+        """
+        return make_sentence(self.rng, min_words=8, max_words=20)
+
+    def make_story_text(self, num_paragraphs: int = 5):
+        """
+        Makes story text: paragraphs separated by new lines.
+        :param num_paragraphs: the number of paragraphs
+        :return: the story text
+        """
+        return '\n'.join(self.rng.choices(self._paragraphs, k=num_paragraphs))
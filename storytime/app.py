@@ -9,20 +9,22 @@ import os
 import random
 import string
 
-import httplib2
-import requests
-from flask import Flask, flash, jsonify, make_response, redirect, render_template, request, \
-    session as login_session, url_for
+from flask import Flask, Markup, flash, jsonify, make_response, redirect, request, session as login_session, url_for
 from flask_uploads import configure_uploads
 from oauth2client.client import FlowExchangeError, OAuth2Credentials, flow_from_clientsecrets
-from werkzeug.exceptions import HTTPException, NotFound, default_exceptions
-
-from storytime import story_time_service
-from storytime.file_storage_service import upload_set_photos
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, default_exceptions
+
+from storytime import compression, file_storage_service, metrics, page_cache, story_time_service
+from storytime.file_storage_service import UploadServeMode, upload_set_photos
+from storytime.http_util import get_not_modified_response, make_etag, set_validators
+from storytime.metrics import render_template
+from storytime.job_queue import JobQueue
+from storytime.oauth_client import FACEBOOK_GRAPH_BASE_URL, GOOGLE_ACCOUNTS_BASE_URL, GOOGLE_API_BASE_URL, \
+    OAuthClient, OAuthProviderError, is_retryable
 from storytime.sec_util import AuthProvider, LoginSessionKeys, csrf_protect, do_authorization, is_user_authenticated, \
     login_required, reset_user_session, store_user_session
-from storytime.story_time_db_init import Story, User
-from storytime.web_api import web_api
+from storytime.story_time_db_init import Story, User, db_engine, db_session
+from storytime.web_api import API_STORIES_IDS_MAX_DEFAULT, web_api
 
 # Auth
 GOOGLE_CLIENT_SECRETS_JSON = os.path.join(
@@ -42,8 +44,47 @@ app.register_blueprint(web_api)
 app.config['MAX_CONTENT_LENGTH'] = 512 * 1024  # 512 KB
 app.config['UPLOADED_PHOTOS_DEST'] = os.path.join(
     os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static/upload/img'))
+# Uploads are served by the serve_upload route below rather than by Flask-Uploads
+app.config['UPLOADED_PHOTOS_URL'] = '/uploads/'
+# How serve_upload sends files (see UploadServeMode): in production, hand them to the front web server
+app.config['UPLOAD_SERVE_MODE'] = UploadServeMode.FLASK.value
+# The internal nginx location that maps to UPLOADED_PHOTOS_DEST (for UploadServeMode.X_ACCEL_REDIRECT)
+app.config['UPLOAD_X_ACCEL_REDIRECT_PREFIX'] = '/protected-uploads/'
 configure_uploads(app, upload_set_photos)
 
+# Authentication provider API base urls (e.g. to point the app at stub providers in test environments)
+app.config['GOOGLE_API_BASE_URL'] = GOOGLE_API_BASE_URL
+app.config['GOOGLE_ACCOUNTS_BASE_URL'] = GOOGLE_ACCOUNTS_BASE_URL
+app.config['FACEBOOK_GRAPH_BASE_URL'] = FACEBOOK_GRAPH_BASE_URL
+# File that token revocations which failed for good are appended to (or None to only print them)
+app.config['REVOCATION_DEAD_LETTER_LOG'] = None
+# The most stories /api/stories?ids= returns in one request
+app.config['API_STORIES_IDS_MAX'] = API_STORIES_IDS_MAX_DEFAULT
+# Response compression (turn off if the front web server compresses responses)
+app.config['COMPRESS_ENABLED'] = True
+app.config['COMPRESS_MIN_SIZE'] = compression.COMPRESS_MIN_SIZE_DEFAULT
+
+
+# Invalidate cached pages when the stories they show change
+story_time_service.register_story_change_listener(page_cache.invalidate_story)
+
+# Count and time the SQL statements, template rendering and overall latency of each request, served at /metrics
+metrics.init_app(app, db_engine)
+metrics.register_cache('page', page_cache.page_cache.stats)
+metrics.register_cache('category', story_time_service.get_category_cache_stats)
+metrics.register_cache('story_body', story_time_service.get_story_body_cache_stats)
+
+# Compress text responses for clients that accept gzip (or brotli, if it is installed)
+compression.init_app(app)
+metrics.register_cache('compressed_response', compression.compressed_cache.stats)
+
+
+# Configure DB session lifecycle: each request gets its own session, which is closed (returning its connection
+# to the pool and discarding any failed transaction) when the app context is torn down
+@app.teardown_appcontext
+def remove_db_session(exc=None):
+    db_session.remove()
+
 
 # Configure Template Filters
 @app.template_filter('format_date')
@@ -85,12 +126,97 @@ for exc in default_exceptions:
     app.register_error_handler(exc, handle_exception)
 
 
+def get_oauth_client():
+    """
+    Gets the client for the authentication provider APIs, creating it from the app config on first use.
+    :return: the OAuthClient
+    """
+    if 'oauth_client' not in app.extensions:
+        app.extensions['oauth_client'] = OAuthClient(google_api_base_url=app.config['GOOGLE_API_BASE_URL'],
+                                                     google_accounts_base_url=app.config['GOOGLE_ACCOUNTS_BASE_URL'],
+                                                     facebook_graph_base_url=app.config['FACEBOOK_GRAPH_BASE_URL'])
+    return app.extensions['oauth_client']
+
+
+def get_revocation_queue():
+    """
+    Gets the background queue that revokes provider tokens on logout, creating it from the app config on first use.
+    :return: the JobQueue
+    """
+    if 'revocation_queue' not in app.extensions:
+        revocation_queue = JobQueue('revocation', is_retryable=is_retryable,
+                                    dead_letter_log=app.config['REVOCATION_DEAD_LETTER_LOG'])
+        metrics.register_job_queue(revocation_queue)
+        app.extensions['revocation_queue'] = revocation_queue
+    return app.extensions['revocation_queue']
+
+
+def make_provider_error_response():
+    response = make_response(json.dumps('Failed to reach the authentication provider.'), 502)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
 # WEBSITE ROUTE DEFINITIONS
 @app.route('/', methods=['GET'])
 def index():
+    cursor = request.args.get('cursor')
+    search_query = request.args.get('q', '').strip()
+
+    # Search results are not cached: the number of possible queries is unbounded
+    if search_query:
+        return render_search(search_query, cursor)
+
+    return page_cache.get_or_render_page((page_cache.INDEX, cursor), lambda: render_index(cursor))
+
+
+def render_index(cursor: str):
     stories_count = story_time_service.get_published_stories_count()
-    stories = story_time_service.get_published_stories(count=12)
-    return render_template('index.html', stories=stories, stories_count=stories_count)
+    stories_html = page_cache.get_or_render_fragment((page_cache.INDEX, cursor), lambda: render_story_cards(cursor))
+    return render_template('index.html', stories_html=Markup(stories_html), stories_count=stories_count)
+
+
+@app.route('/stories/cards', methods=['GET'])
+def view_story_cards():
+    # The next page of story cards, which the Load More Stories link appends to the page it is on
+    cursor = request.args.get('cursor')
+    search_query = request.args.get('q', '').strip()
+    if search_query:
+        return render_search_cards(search_query, cursor)
+    return page_cache.get_or_render_fragment((page_cache.INDEX, cursor), lambda: render_story_cards(cursor))
+
+
+def render_story_cards(cursor: str):
+    try:
+        page = story_time_service.get_published_stories_page(cursor=cursor)
+    except ValueError:
+        raise BadRequest('The cursor parameter is not valid.')
+    next_url, more_url = None, None
+    if page.next_cursor:
+        next_url = url_for('index', cursor=page.next_cursor)
+        more_url = url_for('view_story_cards', cursor=page.next_cursor)
+    return render_template('story_cards.html', stories=page.stories, next_url=next_url, more_url=more_url)
+
+
+def render_search_cards(search_query: str, cursor: str):
+    try:
+        page = story_time_service.search_stories(search_query, cursor=cursor)
+    except ValueError:
+        raise BadRequest('The cursor parameter is not valid.')
+    next_url, more_url = None, None
+    if page.next_cursor:
+        next_url = url_for('index', q=search_query, cursor=page.next_cursor)
+        more_url = url_for('view_story_cards', q=search_query, cursor=page.next_cursor)
+    return render_template('story_cards.html', stories=[result.story for result in page.results],
+                           snippets={result.story.id: result.snippet for result in page.results},
+                           next_url=next_url, more_url=more_url)
+
+
+def render_search(search_query: str, cursor: str):
+    stories_count = story_time_service.get_published_stories_count()
+    stories_html = render_search_cards(search_query, cursor)
+    return render_template('index.html', stories_html=Markup(stories_html), stories_count=stories_count,
+                           search_query=search_query)
 
 
 @app.route('/login', methods=['GET'])
@@ -118,11 +244,12 @@ def login_google():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token={}'.format(access_token))
-    h = httplib2.Http()
-    result = json.loads(str(h.request(url, 'GET')[1], 'utf-8'))
+    # Check that the access token is valid, getting the user info at the same time
+    try:
+        result, data = get_oauth_client().get_google_token_and_user_info(credentials.access_token)
+    except OAuthProviderError as exc:
+        print(exc)
+        return make_provider_error_response()
 
     # If there was an error in the access token info, abort
     if result.get('error') is not None:
@@ -160,11 +287,6 @@ def login_google():
             reset_user_session()
 
     # Get user info
-    user_info_url = 'https://www.googleapis.com/oauth2/v1/userinfo'
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(user_info_url, params=params)
-
-    data = json.loads(answer.text)
     username = data['name']
     email = data['email']
     picture = data['picture']
@@ -187,27 +309,17 @@ def login_facebook():
     # Obtain one-time-use authorization code
     one_time_auth_code = request.get_data(as_text=True)
 
-    # Exchange client token for long lived server side token
-    url = 'https://graph.facebook.com/v2.12/oauth/access_token?grant_type=fb_exchange_token&client_id={}&client_secret={}&fb_exchange_token={}'.format(
-        FACEBOOK_APP_ID, FACEBOOK_APP_SECRET, one_time_auth_code)
-
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to get user info from API
-    token_json = json.loads(str(result, 'utf-8'))
-    token = token_json['access_token']
-
-    url = 'https://graph.facebook.com/v2.12/me?access_token={}&fields=name,email,id'.format(token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data_me = json.loads(str(result, 'utf-8'))
+    try:
+        # Exchange client token for long lived server side token
+        token_json = get_oauth_client().exchange_facebook_token(FACEBOOK_APP_ID, FACEBOOK_APP_SECRET,
+                                                                one_time_auth_code)
+        token = token_json['access_token']
 
-    # Get user picture
-    url = 'https://graph.facebook.com/v2.12/me/picture?access_token={}&redirect=0&height=200&width=200'.format(token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data_picture = json.loads(str(result, 'utf-8'))
+        # Use token to get user info and picture from API
+        data_me, data_picture = get_oauth_client().get_facebook_user_and_picture(token)
+    except OAuthProviderError as exc:
+        print(exc)
+        return make_provider_error_response()
 
     facebook_id = data_me['id']
     username = data_me['name']
@@ -221,7 +333,7 @@ def login_facebook():
 
     # Store the session information
     store_user_session(user_id=user_id, username=username, email=email, picture=picture, provider=AuthProvider.FACEBOOK,
-                       facebook_id=facebook_id)
+                       facebook_id=facebook_id, facebook_access_token=token)
 
     return 'Login successful'
 
@@ -234,25 +346,23 @@ def logout():
 
     auth_provider = login_session.get(LoginSessionKeys.PROVIDER.value)
 
+    # Revoke the provider token in the background, so a slow provider does not hold up the logout
     if auth_provider == AuthProvider.GOOGLE.value:
         # Get oauth2 credentials and only disconnect a connected user
         credentials = OAuth2Credentials.from_json(login_session.get(LoginSessionKeys.GOOGLE_CREDENTIALS_JSON.value))
 
         # Tell Google to revoke current token
-        access_token = credentials.access_token
-        url = 'https://accounts.google.com/o/oauth2/revoke?token={}'.format(access_token)
-        h = httplib2.Http()
-        result = h.request(url, 'GET')[0]
-
-        if result['status'] != '200':
-            # For whatever reason, the given token was invalid
-            print('google revoke token failed; received {}'.format(result['status']))
+        get_revocation_queue().submit(get_oauth_client().revoke_google_token, credentials.access_token,
+                                      description='Revoke Google token of user {}'.format(
+                                          login_session.get(LoginSessionKeys.USER_ID.value)))
     elif auth_provider == AuthProvider.FACEBOOK.value:
         # Tell FB to reject access token
-        facebook_id = login_session[LoginSessionKeys.FACEBOOK_ID.value]
-        url = 'https://graph.facebook.com/{}/permissions'.format(facebook_id)
-        h = httplib2.Http()
-        result = h.request(url, 'DELETE')[1]
+        facebook_access_token = login_session.get(LoginSessionKeys.FACEBOOK_ACCESS_TOKEN.value)
+        if facebook_access_token:
+            get_revocation_queue().submit(get_oauth_client().revoke_facebook_permissions,
+                                          login_session[LoginSessionKeys.FACEBOOK_ID.value], facebook_access_token,
+                                          description='Revoke Facebook permissions of user {}'.format(
+                                              login_session.get(LoginSessionKeys.USER_ID.value)))
 
     # Reset the user's session
     reset_user_session()
@@ -321,23 +431,65 @@ def delete_story(story_id):
 
 @app.route('/stories/<int:story_id>', methods=['GET'])
 def view_story(story_id):
-    story = story_time_service.get_story_by_id(story_id=story_id)
+    # Long stories are shown a page of paragraphs at a time, starting at the offset
+    offset = request.args.get('offset', 0, type=int)
+    # The image variants are created after the story is saved, so the page's version includes whether they exist
+    story_version = story_time_service.get_story_version(story_id=story_id)
+
+    # Return 304 if the client's copy of the page is current. The page differs for the story's owner, so the user
+    # is part of the ETag; pages with flashed messages waiting to be shown are always rendered.
+    etag = make_etag(page_cache.VIEW_STORY, story_id, story_version, offset,
+                     login_session.get(LoginSessionKeys.USER_ID.value))
+    has_flashes = '_flashes' in login_session
+    if story_version and not has_flashes:
+        not_modified = get_not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+    response = make_response(page_cache.get_or_render_page(
+        (page_cache.VIEW_STORY, story_id, story_version, offset), lambda: render_view_story(story_id, offset)))
+    response.vary.add('Cookie')
+    if has_flashes:
+        # A flashed message is shown once: the page must not be stored, or revalidated by the ETag of the plain page
+        response.cache_control.no_store = True
+        return response
+    return set_validators(response, etag)
+
+
+def render_view_story(story_id: int, offset: int):
+    story = story_time_service.get_story_summary_by_id(story_id=story_id)
 
     # Resource check - 404
     if not story:
         raise NotFound
 
-    story_text_paragraphs = story.story_text.splitlines()
-    return render_template('view_story.html', story=story, story_text_paragraphs=story_text_paragraphs,
+    try:
+        story_body = story_time_service.get_story_body(story, offset=offset)
+    except ValueError:
+        raise BadRequest('The offset parameter must not be negative.')
+    if offset and offset >= story_body.total:
+        raise NotFound
+
+    return render_template('view_story.html', story=story, story_body=story_body, offset=offset,
                            csrf_token=login_session.get(LoginSessionKeys.CSRF_TOKEN.value))
 
 
 @app.route('/stories/random', methods=['GET'])
 def view_story_random():
     story = story_time_service.get_story_random()
+
+    # Resource check - 404
+    if not story:
+        raise NotFound
+
     return redirect(url_for('view_story', story_id=story.id))
 
 
+@app.route('/uploads/<path:filename>', methods=['GET'])
+def serve_upload(filename):
+    return file_storage_service.make_upload_response(filename)
+
+
 @app.route('/stories/create', methods=['POST'])
 @login_required
 @csrf_protect()
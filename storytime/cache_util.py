@@ -0,0 +1,133 @@
+#
+# Story Time App
+# In-process caching helpers
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    LRUCache is a thread safe, in-process cache that holds at most maxsize entries (and, if max_bytes is given, at
+    most max_bytes bytes of values as measured by sizeof), evicting the least recently used entries when full.
+    Entries optionally expire ttl seconds after they are stored. Hits, misses and evictions are counted so the
+    effectiveness of the cache can be reported.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = None, max_bytes: int = None, sizeof=len,
+                 timer=time.monotonic):
+        """
+        :param maxsize: the maximum number of entries to hold
+        :param ttl: the number of seconds an entry is valid for (or None for entries that do not expire)
+        :param max_bytes: the maximum total size of the values held (or None for no limit)
+        :param sizeof: a function returning the size in bytes of a value (only used if max_bytes is given)
+        :param timer: a function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Gets the value stored for the given key.
+        :param key: the key to look up
+        :param default: the value to return if the key is not cached or has expired
+        :return: the cached value or the default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at is None or expires_at > self._timer():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Stores a value for the given key, evicting the least recently used entries if the cache is full. Values
+        larger than max_bytes are not stored.
+        :param key: the key to store the value under
+        :param value: the value to store
+        """
+        expires_at = self._timer() + self.ttl if self.ttl is not None else None
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._entries) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """
+        Gets the value stored for the given key, calling load to get and store it if it is not cached.
+        :param key: the key to look up
+        :param load: a function with no arguments that returns the value for the key
+        :return: the cached or loaded value
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Removes the entry for the given key from the cache, or every entry if no key is given.
+        :param key: the key to remove (or None to clear the cache)
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._remove(key)
+
+    def invalidate_where(self, predicate):
+        """
+        Removes the entries whose keys match the given predicate from the cache.
+        :param predicate: a function that takes a key and returns True if its entry should be removed
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def stats(self):
+        """
+        Gets the usage counters for the cache.
+        :return: a dict of hits, misses, evictions (entries removed to make room), size (number of entries) and bytes
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'bytes': self._bytes
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
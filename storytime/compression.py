@@ -0,0 +1,97 @@
+#
+# Story Time App
+# Compresses responses for clients that accept it, keeping compressed copies of responses with an ETag so an
+# unchanged page, API body or static file is only compressed once.
+#
+
+import hashlib
+
+from flask import current_app, request
+
+from storytime.cache_util import LRUCache
+from storytime.compression_util import choose_encoding, compress, compress_chunks
+
+# Responses smaller than this many bytes are sent uncompressed: the saving does not pay for the work
+COMPRESS_MIN_SIZE_DEFAULT = 500
+
+COMPRESSIBLE_MIMETYPES = frozenset(['text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                                    'application/json', 'application/x-ndjson', 'application/xml', 'image/svg+xml'])
+
+COMPRESSED_CACHE_MAX_ENTRIES = 4096
+COMPRESSED_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Compressed bodies, keyed by (path, ETag, encoding). Each entry holds a digest of the uncompressed body it was made
+# from, which is checked before it is used: a few pages (e.g. those showing a flashed message) share their ETag with
+# a different body.
+compressed_cache = LRUCache(maxsize=COMPRESSED_CACHE_MAX_ENTRIES, max_bytes=COMPRESSED_CACHE_MAX_BYTES,
+                            sizeof=lambda entry: len(entry[1]))
+
+
+def _is_compressible(response):
+    """
+    Checks to see if a response may be compressed: a complete 200 response of a text based type, not already encoded
+    and not handed to the front web server to send.
+    """
+    return response.status_code == 200 and response.mimetype in COMPRESSIBLE_MIMETYPES \
+        and 'Content-Encoding' not in response.headers and 'X-Sendfile' not in response.headers \
+        and 'X-Accel-Redirect' not in response.headers
+
+
+def _get_compressed_body(etag: str, encoding: str, body: bytes):
+    """
+    Gets the compressed body of a response from the cache, compressing and caching it if it is not cached.
+    """
+    key = (request.path, etag, encoding)
+    digest = hashlib.sha1(body).digest()
+    entry = compressed_cache.get(key)
+    if entry is None or entry[0] != digest:
+        entry = (digest, compress(body, encoding))
+        compressed_cache.put(key, entry)
+    return entry[1]
+
+
+def compress_response(response):
+    """
+    Compresses a response with the encoding negotiated from the request's Accept-Encoding header, if it is of a
+    compressible type and at least COMPRESS_MIN_SIZE bytes. Streamed responses are compressed as they are sent.
+    A compressed response's ETag is made weak, since its bytes differ from the uncompressed response's; conditional
+    requests compare ETags weakly, so a compressed copy still revalidates.
+    :param response: the response
+    :return: the response
+    """
+    if not current_app.config.get('COMPRESS_ENABLED', True) or not _is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding or request.method == 'HEAD':
+        return response
+
+    etag, is_weak = response.get_etag()
+    if response.is_streamed and not response.direct_passthrough:
+        charset = response.charset
+        response.response = compress_chunks((chunk.encode(charset) if isinstance(chunk, str) else chunk
+                                             for chunk in response.response), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        if response.direct_passthrough:
+            # Static files are sent from a file wrapper; only read the ones that may be compressed into memory
+            if request.endpoint != 'static':
+                return response
+            response.direct_passthrough = False
+        body = response.get_data()
+        if len(body) < current_app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE_DEFAULT):
+            return response
+        response.set_data(_get_compressed_body(etag, encoding, body) if etag else compress(body, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """
+    Compresses the responses of a Flask app.
+    :param app: the Flask app
+    """
+    app.after_request(compress_response)
@@ -0,0 +1,105 @@
+#
+# Story Time App
+# Content-Encoding negotiation and compression of response bodies
+#
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional: without it responses are only gzip compressed
+    brotli = None
+
+ENCODING_GZIP = 'gzip'
+ENCODING_BROTLI = 'br'
+
+# Moderate levels: responses are compressed on the request path
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# zlib window bits for a gzip header and trailer (with no file name or modification time)
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# The encodings that can be produced, most preferred first
+SUPPORTED_ENCODINGS = ((ENCODING_BROTLI,) if brotli else ()) + (ENCODING_GZIP,)
+
+
+def parse_accept_encoding(accept_encoding: str):
+    """
+    Parses an Accept-Encoding header.
+    :param accept_encoding: the header value (or None)
+    :return: a dict of content coding (lower case) to quality value
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def choose_encoding(accept_encoding: str, encodings: tuple = SUPPORTED_ENCODINGS):
+    """
+    Chooses the encoding to compress a response with: the one the client gives the highest quality value, or the
+    most preferred of those it rates equally.
+    :param accept_encoding: the Accept-Encoding header of the request (or None)
+    :param encodings: the encodings that can be produced, most preferred first
+    :return: the encoding or None if the response should not be compressed
+    """
+    qualities = parse_accept_encoding(accept_encoding)
+    best_encoding, best_quality = None, 0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+
+def compress(data: bytes, encoding: str):
+    """
+    Compresses a response body. Raises ValueError if the encoding is not supported.
+    :param data: the body
+    :param encoding: one of SUPPORTED_ENCODINGS
+    :return: the compressed body
+    """
+    if encoding == ENCODING_GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == ENCODING_BROTLI and brotli:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+
+def compress_chunks(chunks, encoding: str):
+    """
+    Compresses a streamed response body as it is iterated. Each chunk is flushed, so the client can decode what it
+    has received without waiting for the end of the stream. Raises ValueError if the encoding is not supported.
+    :param chunks: an iterator of bytes
+    :param encoding: one of SUPPORTED_ENCODINGS
+    :return: an iterator of compressed bytes
+    """
+    if encoding == ENCODING_GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    elif encoding == ENCODING_BROTLI and brotli:
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        raise ValueError('Unsupported encoding: {}'.format(encoding))
+    return _generate_compressed_chunks(chunks, process, flush, finish)
+
+
+def _generate_compressed_chunks(chunks, process, flush, finish):
+    for chunk in chunks:
+        if chunk:
+            yield process(chunk) + flush()
+    yield finish()
@@ -0,0 +1,29 @@
+#
+# Story Time App
+# DB connection pool instrumentation, kept free of Flask so the DB objects can be used outside of the app
+#
+
+import time
+
+from sqlalchemy.pool import QueuePool
+
+from storytime.metrics_util import DURATION_BUCKETS, Histogram
+
+# Registered with the app's metrics by storytime.metrics
+db_pool_wait_seconds = Histogram(
+    'storytime_db_pool_wait_seconds', 'Time spent waiting for a connection from the DB connection pool.',
+    buckets=(0.0001, 0.0005) + DURATION_BUCKETS)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    TimedQueuePool is a QueuePool that records how long each checkout waits for a connection, including the time to
+    open a new connection when the pool has room for one.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait_seconds.observe(time.perf_counter() - start)
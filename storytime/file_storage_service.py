@@ -3,51 +3,261 @@
 # Exposes functions that deal with file storage
 #
 
+import hashlib
+import mimetypes
 import os
-import uuid
+import tempfile
+from collections import OrderedDict, namedtuple
+from enum import Enum
+from urllib.parse import quote
 
-from flask_uploads import IMAGES, UploadSet
+from PIL import Image
+from flask import current_app, safe_join, send_file
+from flask_uploads import IMAGES, UploadNotAllowed, UploadSet
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
 from storytime.story_time_db_init import UploadFile
 
 upload_set_photos = UploadSet('photos', IMAGES)
 
+# Resized image variants created for each upload, by name and width in pixels
+IMAGE_VARIANTS = OrderedDict([
+    ('card', 350),
+    ('detail', 400),
+    ('retina', 800)
+])
+IMAGE_VARIANT_JPEG_QUALITY = 85
 
-def _generate_file_name(file_extension: str):
+# Uploads are read, hashed and written this many bytes at a time
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Extensions that name the same format, mapped to the one used in stored file names
+FILE_EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+STORED_FILE_MODE = 0o644
+
+# Stored files are fanned out into UPLOAD_SHARD_DEPTH levels of subdirectories named by UPLOAD_SHARD_WIDTH hex
+# characters of the hash of the file name (ab/cd/name.jpg), so no directory holds more than a few hundred files
+UPLOAD_SHARD_DEPTH = 2
+UPLOAD_SHARD_WIDTH = 2
+
+# Stored files are never overwritten with different content, so clients and proxies can cache them for good
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+UPLOAD_CACHE_CONTROL = 'public, max-age={}, immutable'.format(UPLOAD_CACHE_MAX_AGE)
+
+
+class UploadServeMode(Enum):
     """
-    Generates a unique file name from UUID.
+    Enum representing how uploaded files are served (the UPLOAD_SERVE_MODE app config value).
+    """
+    # Flask reads the file and sends it (for development)
+    FLASK = 'flask'
+    # Flask only checks the file exists; Apache (mod_xsendfile) or lighttpd sends it from the X-Sendfile path
+    X_SENDFILE = 'x-sendfile'
+    # Flask only checks the file exists; nginx sends it from the internal location in the X-Accel-Redirect header,
+    # which is UPLOAD_X_ACCEL_REDIRECT_PREFIX followed by the file name
+    X_ACCEL_REDIRECT = 'x-accel-redirect'
+
+
+# An upload written to a temporary file, with the SHA-256 hash of its content and the content addressed file name
+# it will be stored under
+StagedFile = namedtuple('StagedFile', ['temp_path', 'content_hash', 'filename'])
+
+
+def _generate_file_name(content_hash: str, file_extension: str):
+    """
+    Generates a sharded, content addressed file name from the hash of a file's content.
+    :param content_hash: the hex SHA-256 hash of the file content
     :param file_extension: the extension to add to the new file name
-    :return: a string in the form filename.extension
+    :return: a string in the form shard/shard/hash.extension
+    """
+    file_extension = file_extension.lower()
+    return get_shard_path(
+        secure_filename('{}{}'.format(content_hash, FILE_EXTENSION_ALIASES.get(file_extension, file_extension))))
+
+
+def get_shard_path(filename: str):
     """
-    uid = uuid.uuid1()
-    return secure_filename('{}{}'.format(uid, file_extension))
+    Gets the path, relative to the upload directory, that a file is stored at in the sharded layout.
+    :param filename: the base file name of the file
+    :return: a string in the form shard/shard/filename
+    """
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    shards = [digest[i * UPLOAD_SHARD_WIDTH:(i + 1) * UPLOAD_SHARD_WIDTH] for i in range(UPLOAD_SHARD_DEPTH)]
+    return '/'.join(shards + [filename])
 
 
-def save_file(file: FileStorage):
+def stage_file(file: FileStorage):
     """
-    Save a file to the file system using the Flask-Uploads config.
-    :param file: the file to save to the file system
-    :return: the UploadFile object representing the file that was saved
+    Streams an uploaded file to a temporary file in the upload directory, hashing its content as it is written.
+    Raises UploadNotAllowed if the file type is not allowed. Pass the result to store_staged_file or
+    discard_staged_file.
+    :param file: the uploaded file
+    :return: the StagedFile
     """
+    if not upload_set_photos.file_allowed(file, file.filename):
+        raise UploadNotAllowed()
+
+    upload_dir = get_upload_dir()
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=upload_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                temp_file.write(chunk)
+        os.chmod(temp_path, STORED_FILE_MODE)
+    except Exception as exc:
+        os.remove(temp_path)
+        raise exc
+
+    content_hash = digest.hexdigest()
     orig_filename, file_extension = os.path.splitext(file.filename)
+    return StagedFile(temp_path=temp_path, content_hash=content_hash,
+                      filename=_generate_file_name(content_hash=content_hash, file_extension=file_extension))
 
-    # Give file a new randomly generated filename
-    file.filename = _generate_file_name(file_extension=file_extension)
-    saved_filename = upload_set_photos.save(file)
-    url = upload_set_photos.url(saved_filename)
-    upload_file = UploadFile(filename=saved_filename, url=url)
-    return upload_file
 
+def store_staged_file(staged_file: StagedFile, filename: str = None):
+    """
+    Moves a staged file to its content addressed location, unless a file with the same content is already stored
+    there, in which case nothing is written.
+    :param staged_file: the staged file
+    :param filename: the file name to store the file under (defaults to the staged file's file name)
+    :return: a boolean indicating if the file was written
+    """
+    file_path = upload_set_photos.path(filename or staged_file.filename)
+    if os.path.exists(file_path):
+        discard_staged_file(staged_file)
+        return False
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.replace(staged_file.temp_path, file_path)
+    return True
 
-def delete_file(file: UploadFile):
+
+def discard_staged_file(staged_file: StagedFile):
     """
-    Delete from the file system the file associated with the given UploadFile
-    :param file: the UploadFile associated with the file to delete
+    Deletes the temporary file of a staged file.
+    :param staged_file: the staged file
     """
-    file_path = upload_set_photos.path(file.filename)
     try:
-        os.remove(file_path)
+        os.remove(staged_file.temp_path)
     except OSError:
         pass
+
+
+def get_file_url(filename: str):
+    """
+    Gets the url a stored file is served from.
+    :param filename: the file name of the stored file
+    :return: the url
+    """
+    return upload_set_photos.url(filename)
+
+
+def get_upload_dir():
+    """
+    Gets the directory uploaded photos are saved in. Must be called with a Flask app context.
+    :return: the directory path
+    """
+    return upload_set_photos.config.destination
+
+
+def shard_stored_file(filename: str, variants: dict = None):
+    """
+    Moves a file stored in the flat layout used before uploads were sharded, and its image variants, to the sharded
+    layout. Files that have already been moved are skipped, so this can be run again after a failure.
+    :param filename: the file name of the stored file
+    :param variants: the image variants of the stored file (or None)
+    :return: a tuple of (the sharded file name, the variants updated with their sharded file names and urls)
+    """
+    upload_dir = get_upload_dir()
+    filenames = {filename: get_shard_path(os.path.basename(filename))}
+    sharded_variants = None
+    if variants is not None:
+        sharded_variants = {}
+        for name, variant in variants.items():
+            sharded_filename = filenames.setdefault(variant['filename'],
+                                                    get_shard_path(os.path.basename(variant['filename'])))
+            sharded_variants[name] = dict(variant, filename=sharded_filename, url=get_file_url(sharded_filename))
+
+    for old_filename, new_filename in filenames.items():
+        old_path = os.path.join(upload_dir, old_filename)
+        if old_filename == new_filename or not os.path.exists(old_path):
+            continue
+        new_path = os.path.join(upload_dir, new_filename)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(old_path, new_path)
+    return filenames[filename], sharded_variants
+
+
+def make_upload_response(filename: str):
+    """
+    Makes the response for a request for a stored file, as configured by the UPLOAD_SERVE_MODE app config value.
+    Raises NotFound if the file does not exist.
+    :param filename: the file name of the stored file
+    :return: the response
+    """
+    file_path = safe_join(get_upload_dir(), filename)
+    if not os.path.isfile(file_path):
+        raise NotFound()
+
+    serve_mode = UploadServeMode(current_app.config.get('UPLOAD_SERVE_MODE', UploadServeMode.FLASK.value))
+    if serve_mode == UploadServeMode.FLASK:
+        response = send_file(file_path, conditional=True, cache_timeout=UPLOAD_CACHE_MAX_AGE)
+    else:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = current_app.response_class(mimetype=mimetype)
+        if serve_mode == UploadServeMode.X_SENDFILE:
+            response.headers['X-Sendfile'] = file_path
+        else:
+            response.headers['X-Accel-Redirect'] = \
+                current_app.config['UPLOAD_X_ACCEL_REDIRECT_PREFIX'] + quote(filename)
+    response.headers['Cache-Control'] = UPLOAD_CACHE_CONTROL
+    return response
+
+
+def save_image_variants(filename: str, url: str, upload_dir: str):
+    """
+    Saves resized variants of an uploaded image next to it, one for each of IMAGE_VARIANTS. Variants that would be
+    as wide or wider than the original use the original instead. Does not need a Flask app context, so it can run
+    on a background thread.
+    :param filename: the file name of the original image
+    :param url: the url of the original image
+    :param upload_dir: the directory the image is saved in (see get_upload_dir)
+    :return: a dict of variant name to a dict of the variant's filename, url and width
+    """
+    base_url = url[:-len(filename)]
+    base_name, file_extension = os.path.splitext(filename)
+    variants = {}
+    with Image.open(os.path.join(upload_dir, filename)) as original:
+        for name, width in IMAGE_VARIANTS.items():
+            if width >= original.width:
+                variants[name] = {'filename': filename, 'url': url, 'width': original.width}
+                continue
+
+            variant_filename = '{}_{}{}'.format(base_name, name, file_extension)
+            variant = original.copy()
+            variant.thumbnail((width, original.height * width // original.width), Image.LANCZOS)
+            if original.format == 'JPEG':
+                variant.save(os.path.join(upload_dir, variant_filename), 'JPEG', quality=IMAGE_VARIANT_JPEG_QUALITY,
+                             optimize=True, progressive=True)
+            else:
+                variant.save(os.path.join(upload_dir, variant_filename), original.format, optimize=True)
+            variants[name] = {'filename': variant_filename, 'url': base_url + variant_filename,
+                              'width': variant.width}
+    return variants
+
+
+def delete_file(file: UploadFile):
+    """
+    Delete from the file system the file associated with the given UploadFile and its image variants
+    :param file: the UploadFile associated with the file to delete
+    """
+    filenames = {file.filename}
+    filenames.update(variant['filename'] for variant in (file.variants or {}).values())
+    for filename in filenames:
+        try:
+            os.remove(upload_set_photos.path(filename))
+        except OSError:
+            pass
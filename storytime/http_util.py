@@ -0,0 +1,48 @@
+#
+# Story Time App
+# HTTP conditional request (ETag / Last-Modified) helpers
+#
+
+import datetime
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """
+    Makes an entity tag from the values that identify a version of a resource.
+    :param parts: the values the resource depends on, e.g. its id and date last modified
+    :return: the entity tag
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def set_validators(response: Response, etag: str, last_modified: datetime.datetime = None):
+    """
+    Sets the ETag and (optionally) Last-Modified headers on a response, and requires caches to revalidate it before
+    reuse.
+    :param response: the response
+    :param etag: the entity tag of the response
+    :param last_modified: the date the resource was last modified (naive UTC)
+    :return: the response
+    """
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_not_modified_response(etag: str, last_modified: datetime.datetime = None):
+    """
+    Checks the If-None-Match and If-Modified-Since headers of the current request against the given validators.
+    Call this before loading the resource so an unchanged resource costs only the lookup of its validators.
+    :param etag: the entity tag of the current version of the resource
+    :param last_modified: the date the resource was last modified (naive UTC)
+    :return: a 304 Not Modified response if the client's copy is current, or None
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
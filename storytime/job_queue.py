@@ -0,0 +1,158 @@
+#
+# Story Time App
+# In-process background job queue with retries and a dead letter log
+#
+
+import datetime
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import traceback
+
+
+class JobQueue:
+    """
+    JobQueue runs functions on background worker threads so a request does not wait for them. A job that raises is
+    retried with exponential backoff (with jitter) until it succeeds, its error is not retryable, or it has been
+    attempted max_attempts times, when it is recorded in the dead letter log.
+
+    Jobs are held in memory: jobs still waiting when the process exits are lost.
+    """
+
+    def __init__(self, name: str, num_workers: int = 1, max_attempts: int = 5, backoff: float = 1,
+                 max_backoff: float = 60, max_pending: int = 1000, is_retryable=None, dead_letter_log: str = None,
+                 timer=time.monotonic):
+        """
+        :param name: the name of the queue, used in the dead letter log
+        :param num_workers: the number of worker threads
+        :param max_attempts: the number of times a job is attempted before it is dead lettered
+        :param backoff: the number of seconds before the first retry; each further retry waits twice as long
+        :param max_backoff: the maximum number of seconds between retries
+        :param max_pending: the maximum number of jobs waiting to run; jobs submitted beyond it are dead lettered
+        :param is_retryable: a function that takes the exception a job raised and returns False if the job should not
+        be retried (defaults to retrying every exception)
+        :param dead_letter_log: the path of the file dead lettered jobs are appended to as JSON lines (or None to
+        only print them)
+        :param timer: a function returning the current time in seconds
+        """
+        self.name = name
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self._is_retryable = is_retryable or (lambda exc: True)
+        self.dead_letter_log = dead_letter_log
+        self._timer = timer
+        self._condition = threading.Condition()
+        # Heap of (run at time, sequence number, job) so jobs run in due order, then submission order
+        self._heap = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        for i in range(num_workers):
+            threading.Thread(target=self._work, name='{}-{}'.format(name, i), daemon=True).start()
+
+    def submit(self, func, *args, description: str = None):
+        """
+        Adds a job to the queue to be run as soon as a worker is free.
+        :param func: the function to run
+        :param args: the arguments to call the function with
+        :param description: a description of the job for the dead letter log (do not include secrets; the
+        arguments are never logged)
+        :return: a boolean indicating if the job was queued (False if the queue was full and it was dead lettered)
+        """
+        description = description or getattr(func, '__name__', repr(func))
+        job = {'func': func, 'args': args, 'description': description, 'attempts': 0}
+        with self._condition:
+            if len(self._heap) < self.max_pending:
+                heapq.heappush(self._heap, (self._timer(), next(self._sequence), job))
+                self._condition.notify()
+                return True
+        self._dead_letter(job, 'Queue full')
+        return False
+
+    def stats(self):
+        """
+        Gets the counters for the queue.
+        :return: a dict of pending (waiting to run, including retries), running, succeeded, retried and dead lettered
+        """
+        with self._condition:
+            return {
+                'pending': len(self._heap),
+                'running': self._running,
+                'succeeded': self.succeeded,
+                'retried': self.retried,
+                'dead_lettered': self.dead_lettered
+            }
+
+    def join(self, timeout: float = None):
+        """
+        Waits until no jobs are waiting or running.
+        :param timeout: the maximum number of seconds to wait (or None to wait indefinitely)
+        :return: a boolean indicating if the queue is empty
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._heap and not self._running, timeout)
+
+    def _get_backoff(self, attempts: int):
+        backoff = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > self._timer():
+                    self._condition.wait(self._heap[0][0] - self._timer() if self._heap else None)
+                run_at, sequence, job = heapq.heappop(self._heap)
+                self._running += 1
+
+            job['attempts'] += 1
+            error = None
+            retry = False
+            try:
+                job['func'](*job['args'])
+            except Exception as exc:
+                error = '{}: {}'.format(type(exc).__name__, exc)
+                retry = job['attempts'] < self.max_attempts and self._is_retryable(exc)
+            if error and not retry:
+                self._dead_letter(job, error)
+
+            with self._condition:
+                self._running -= 1
+                if not error:
+                    self.succeeded += 1
+                elif retry:
+                    self.retried += 1
+                    heapq.heappush(self._heap, (self._timer() + self._get_backoff(job['attempts']),
+                                                next(self._sequence), job))
+                self._condition.notify_all()
+
+    def _dead_letter(self, job: dict, error: str):
+        """
+        Records a job that will not be run again.
+        :param job: the job
+        :param error: the reason the job failed
+        """
+        entry = json.dumps({
+            'date': datetime.datetime.utcnow().isoformat(),
+            'queue': self.name,
+            'job': job['description'],
+            'attempts': job['attempts'],
+            'error': error
+        })
+        with self._condition:
+            self.dead_lettered += 1
+        print('Dead lettered job: {}'.format(entry))
+        if self.dead_letter_log:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.dead_letter_log)), exist_ok=True)
+                with open(self.dead_letter_log, 'a') as log_file:
+                    log_file.write(entry + '\n')
+            except OSError:
+                traceback.print_exc()
@@ -0,0 +1,209 @@
+#
+# Story Time App
+# Per-request SQL, template rendering and latency instrumentation, exposed at /metrics in the Prometheus text format.
+#
+# Metrics are held in memory per process: when the app runs in several processes, each must be scraped separately.
+#
+
+import time
+
+import flask
+from flask import Blueprint, Response, g, has_app_context, request
+from sqlalchemy import event
+
+from storytime import db_pool
+from storytime.metrics_util import PROMETHEUS_CONTENT_TYPE, CallbackMetric, Counter, Histogram, \
+    MetricsRegistry
+
+metrics_api = Blueprint('metrics_api', __name__)
+
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# The endpoint label of requests that did not match a route, so unknown urls do not each get their own series
+UNMATCHED_ENDPOINT = 'unmatched'
+
+registry = MetricsRegistry()
+http_requests_total = registry.register(Counter(
+    'storytime_http_requests_total', 'Requests served.', ('endpoint', 'method', 'status')))
+http_request_duration_seconds = registry.register(Histogram(
+    'storytime_http_request_duration_seconds', 'Time taken to produce a response.', ('endpoint', 'status')))
+db_queries_per_request = registry.register(Histogram(
+    'storytime_db_queries_per_request', 'SQL statements executed by a request.', ('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS))
+db_time_seconds = registry.register(Histogram(
+    'storytime_db_time_seconds', 'Time a request spent executing SQL statements.', ('endpoint',)))
+render_time_seconds = registry.register(Histogram(
+    'storytime_render_time_seconds', 'Time a request spent rendering templates.', ('endpoint',)))
+db_pool_wait_seconds = registry.register(db_pool.db_pool_wait_seconds)
+
+# Background job queues whose counters are exposed, see register_job_queue
+_job_queues = []
+
+# In-process caches whose counters are exposed, as (name, stats function) tuples, see register_cache
+_caches = []
+
+
+def _collect_job_queue_depths():
+    depths = {}
+    for job_queue in _job_queues:
+        stats = job_queue.stats()
+        depths[(job_queue.name,)] = stats['pending'] + stats['running']
+    return depths
+
+
+def _collect_job_queue_outcomes():
+    outcomes = {}
+    for job_queue in _job_queues:
+        stats = job_queue.stats()
+        for outcome in ('succeeded', 'retried', 'dead_lettered'):
+            outcomes[(job_queue.name, outcome)] = stats[outcome]
+    return outcomes
+
+
+job_queue_depth = registry.register(CallbackMetric(
+    'storytime_job_queue_depth', 'Background jobs waiting to run (including retries) or running.', 'gauge',
+    _collect_job_queue_depths, ('queue',)))
+job_queue_jobs_total = registry.register(CallbackMetric(
+    'storytime_job_queue_jobs_total', 'Background job outcomes (each retry is counted).', 'counter',
+    _collect_job_queue_outcomes, ('queue', 'outcome')))
+
+
+def _collect_cache_lookups():
+    lookups = {}
+    for cache_name, stats in _caches:
+        cache_stats = stats()
+        lookups[(cache_name, 'hit')] = cache_stats['hits']
+        lookups[(cache_name, 'miss')] = cache_stats['misses']
+    return lookups
+
+
+def _collect_cache_stat(name: str):
+    return lambda: {(cache_name,): stats()[name] for cache_name, stats in _caches}
+
+
+cache_lookups_total = registry.register(CallbackMetric(
+    'storytime_cache_lookups_total', 'In-process cache lookups, by result.', 'counter', _collect_cache_lookups,
+    ('cache', 'result')))
+cache_evictions_total = registry.register(CallbackMetric(
+    'storytime_cache_evictions_total', 'In-process cache entries removed to make room for others.', 'counter',
+    _collect_cache_stat('evictions'), ('cache',)))
+cache_entries = registry.register(CallbackMetric(
+    'storytime_cache_entries', 'In-process cache entries held.', 'gauge', _collect_cache_stat('size'), ('cache',)))
+cache_bytes = registry.register(CallbackMetric(
+    'storytime_cache_bytes', 'In-process cache size in bytes (for caches bounded by size).', 'gauge',
+    _collect_cache_stat('bytes'), ('cache',)))
+
+
+def _get_request_metrics():
+    """
+    Gets the metrics being accumulated for the current request, or None outside of a request (e.g. on a background
+    thread).
+    """
+    if not has_app_context():
+        return None
+    return g.get('request_metrics')
+
+
+def instrument_engine(engine):
+    """
+    Adds event hooks to a DB engine that count and time the SQL statements executed for each request.
+    :param engine: the engine
+    """
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_times'].pop()
+        request_metrics = _get_request_metrics()
+        if request_metrics is not None:
+            request_metrics['db_queries'] += 1
+            request_metrics['db_time'] += elapsed
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        # A failed statement never reaches after_cursor_execute, so drop its start time here
+        if exception_context.connection is not None:
+            query_start_times = exception_context.connection.info.get('query_start_times')
+            if query_start_times:
+                query_start_times.pop()
+
+
+def register_job_queue(job_queue):
+    """
+    Exposes the depth and outcome counters of a background job queue.
+    :param job_queue: the JobQueue
+    """
+    _job_queues.append(job_queue)
+
+
+def register_cache(name: str, stats):
+    """
+    Exposes the lookup, eviction and size counters of an in-process cache.
+    :param name: the name of the cache, used as the cache label
+    :param stats: a function with no arguments that returns the cache's LRUCache.stats()
+    """
+    _caches.append((name, stats))
+
+
+def render_template(template_name_or_list, **context):
+    """
+    Renders a template like flask.render_template, adding the time taken to the current request's render time.
+    """
+    start = time.perf_counter()
+    try:
+        return flask.render_template(template_name_or_list, **context)
+    finally:
+        request_metrics = _get_request_metrics()
+        if request_metrics is not None:
+            request_metrics['render_time'] += time.perf_counter() - start
+
+
+def _start_request():
+    g.request_metrics = {'start': time.perf_counter(), 'db_queries': 0, 'db_time': 0.0, 'render_time': 0.0,
+                         'recorded': False}
+
+
+def _record_request(status_code: int):
+    request_metrics = _get_request_metrics()
+    if request_metrics is None or request_metrics['recorded']:
+        return
+    request_metrics['recorded'] = True
+    endpoint = request.endpoint or UNMATCHED_ENDPOINT
+    status = str(status_code)
+    http_requests_total.inc(endpoint=endpoint, method=request.method, status=status)
+    http_request_duration_seconds.observe(time.perf_counter() - request_metrics['start'], endpoint=endpoint,
+                                          status=status)
+    db_queries_per_request.observe(request_metrics['db_queries'], endpoint=endpoint)
+    db_time_seconds.observe(request_metrics['db_time'], endpoint=endpoint)
+    render_time_seconds.observe(request_metrics['render_time'], endpoint=endpoint)
+
+
+def _after_request(response):
+    _record_request(response.status_code)
+    return response
+
+
+def _teardown_request(exc=None):
+    # Requests that failed with an unhandled exception never reach the after request hooks
+    _record_request(500)
+
+
+def init_app(app, engine):
+    """
+    Instruments a Flask app and its DB engine, and serves the metrics at /metrics.
+    :param app: the Flask app
+    :param engine: the DB engine the app uses
+    """
+    instrument_engine(engine)
+    app.before_request(_start_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(metrics_api)
+
+
+@metrics_api.route('/metrics')
+def get_metrics():
+    return Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,200 @@
+#
+# Story Time App
+# In-process metrics exposed in the Prometheus text format
+#
+
+import threading
+
+# Default histogram buckets for durations, in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: tuple = ()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Metric is the base class of the metric types: a named, thread safe set of values, one for each combination of
+    label values.
+    """
+    type_name = None
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        """
+        :param name: the metric name
+        :param description: the help text of the metric
+        :param label_names: the names of the labels values are broken down by
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _get_label_values(self, labels: dict):
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.label_names, sorted(labels)))
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        """
+        Renders the metric in the Prometheus text format.
+        :return: the lines of the metric
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.type_name)]
+        with self._lock:
+            for label_values in sorted(self._values, key=lambda values: tuple(str(value) for value in values)):
+                lines.extend(self._render_value(label_values, self._values[label_values]))
+        return lines
+
+    def _render_value(self, label_values: tuple, value):
+        return ['{}{} {}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value))]
+
+
+class Counter(Metric):
+    """
+    Counter is a metric whose values only increase, e.g. the number of requests served.
+    """
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Increments the value for the given label values.
+        :param amount: the amount to add
+        :param labels: the label values
+        """
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, **labels):
+        """
+        Gets the value for the given label values.
+        :param labels: the label values
+        :return: the value
+        """
+        with self._lock:
+            return self._values.get(self._get_label_values(labels), 0)
+
+
+class Histogram(Metric):
+    """
+    Histogram is a metric that counts observations (e.g. request durations) in cumulative buckets, and records their
+    count and sum.
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        """
+        :param name: the metric name
+        :param description: the help text of the metric
+        :param label_names: the names of the labels values are broken down by
+        :param buckets: the upper bounds of the buckets, ascending
+        """
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        """
+        Records an observation for the given label values.
+        :param value: the observed value
+        :param labels: the label values
+        """
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            bucket_counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0))
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            self._values[label_values] = (bucket_counts, total + value)
+
+    def get_count(self, **labels):
+        """
+        Gets the number of observations for the given label values.
+        :param labels: the label values
+        :return: the count
+        """
+        with self._lock:
+            bucket_counts, total = self._values.get(self._get_label_values(labels), ([0], 0))
+            return sum(bucket_counts)
+
+    def _render_value(self, label_values: tuple, value):
+        bucket_counts, total = value
+        lines = []
+        cumulative_count = 0
+        for upper_bound, count in zip(self.buckets, bucket_counts):
+            cumulative_count += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _format_labels(self.label_names, label_values, (('le', _format_value(upper_bound)),)),
+                cumulative_count))
+        labels = _format_labels(self.label_names, label_values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative_count))
+        return lines
+
+
+class CallbackMetric(Metric):
+    """
+    CallbackMetric is a metric whose values are read from a function when the metrics are rendered, e.g. to expose
+    the counters another object keeps.
+    """
+
+    def __init__(self, name: str, description: str, type_name: str, collect, label_names: tuple = ()):
+        """
+        :param name: the metric name
+        :param description: the help text of the metric
+        :param type_name: the metric type: 'counter' or 'gauge'
+        :param collect: a function with no arguments that returns a dict of label values tuple to value
+        :param label_names: the names of the labels values are broken down by
+        """
+        super().__init__(name, description, label_names)
+        self.type_name = type_name
+        self._collect = collect
+
+    def render(self):
+        values = self._collect()
+        with self._lock:
+            self._values = values
+        return super().render()
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry holds the metrics exposed together, in the order they were registered.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric):
+        """
+        Adds a metric to the registry.
+        :param metric: the metric
+        :return: the metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders every registered metric in the Prometheus text format.
+        :return: the text
+        """
+        return ''.join(line + '\n' for metric in self._metrics for line in metric.render())
@@ -0,0 +1,182 @@
+#
+# Story Time App
+# HTTP client for the Google and Facebook APIs used to sign users in
+#
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GOOGLE_API_BASE_URL = 'https://www.googleapis.com'
+GOOGLE_ACCOUNTS_BASE_URL = 'https://accounts.google.com'
+FACEBOOK_GRAPH_BASE_URL = 'https://graph.facebook.com/v2.12'
+
+# Seconds to wait to connect to a provider, and then for each read from it
+OAUTH_CONNECT_TIMEOUT = 3.05
+OAUTH_READ_TIMEOUT = 10
+# Keep alive connections held open per provider host
+OAUTH_POOL_SIZE = 10
+# Provider calls made at the same time, across all requests
+OAUTH_MAX_CONCURRENT_CALLS = 8
+
+FACEBOOK_PICTURE_SIZE = 200
+
+
+class OAuthProviderError(Exception):
+    """
+    Raised when an authentication provider cannot be reached or returns an unexpected response.
+    """
+
+    def __init__(self, message: str, retryable: bool = True):
+        """
+        :param message: the error message
+        :param retryable: False if making the same call again cannot succeed (e.g. the provider rejected it)
+        """
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def is_retryable(exc: Exception):
+    """
+    Checks to see if a failed provider call may succeed if it is made again.
+    :param exc: the exception the call raised
+    :return: a boolean indicating if the call should be retried
+    """
+    return not isinstance(exc, OAuthProviderError) or exc.retryable
+
+
+class OAuthClient:
+    """
+    OAuthClient makes the calls to the authentication providers' APIs over a pool of keep alive connections, with
+    timeouts, so signing in costs one TLS handshake per provider host rather than one per call. Calls that do not
+    depend on each other are made at the same time. The client is thread safe and meant to be shared by the app.
+    """
+
+    def __init__(self, google_api_base_url: str = GOOGLE_API_BASE_URL,
+                 google_accounts_base_url: str = GOOGLE_ACCOUNTS_BASE_URL,
+                 facebook_graph_base_url: str = FACEBOOK_GRAPH_BASE_URL,
+                 timeout: tuple = (OAUTH_CONNECT_TIMEOUT, OAUTH_READ_TIMEOUT)):
+        """
+        :param google_api_base_url: the base url of the Google APIs
+        :param google_accounts_base_url: the base url of the Google accounts (OAuth 2.0) endpoints
+        :param facebook_graph_base_url: the base url of the Facebook Graph API, including the version
+        :param timeout: a tuple of the connect and read timeouts in seconds
+        """
+        self.google_api_base_url = google_api_base_url.rstrip('/')
+        self.google_accounts_base_url = google_accounts_base_url.rstrip('/')
+        self.facebook_graph_base_url = facebook_graph_base_url.rstrip('/')
+        self.timeout = timeout
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=OAUTH_POOL_SIZE, pool_maxsize=OAUTH_POOL_SIZE)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=OAUTH_MAX_CONCURRENT_CALLS)
+
+    def _request(self, method: str, url: str, params: dict = None, data: dict = None):
+        """
+        Makes a request. Raises OAuthProviderError if the provider cannot be reached. The error message does not
+        include the parameters, which hold tokens.
+        :param method: the HTTP method
+        :param url: the url
+        :param params: the query string parameters
+        :param data: the form parameters
+        :return: the response
+        """
+        try:
+            return self._http.request(method, url, params=params, data=data, timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise OAuthProviderError('{} {} failed: {}'.format(method, url, type(exc).__name__)) from exc
+
+    def _get_json(self, url: str, params: dict):
+        """
+        Makes a GET request and parses the JSON response, whatever its status code (the providers describe errors in
+        the JSON). Raises OAuthProviderError if the provider cannot be reached or the response is not JSON.
+        :param url: the url
+        :param params: the query string parameters
+        :return: the parsed JSON
+        """
+        response = self._request('GET', url, params=params)
+        try:
+            return response.json()
+        except ValueError as exc:
+            raise OAuthProviderError('GET {} returned a response that is not JSON'.format(url)) from exc
+
+    @staticmethod
+    def _check_status(method: str, url: str, response):
+        """
+        Raises OAuthProviderError if a response is an error: retryable for server errors and rate limiting, not
+        retryable for other client errors.
+        """
+        if response.status_code < 400:
+            return
+        retryable = response.status_code >= 500 or response.status_code == 429
+        raise OAuthProviderError('{} {} returned {}'.format(method, url, response.status_code), retryable=retryable)
+
+    def _get_json_all(self, *calls):
+        """
+        Makes several GET requests at the same time.
+        :param calls: (url, params) tuples
+        :return: a list of the parsed JSON responses, in the order of the calls
+        """
+        futures = [self._executor.submit(self._get_json, url, params) for url, params in calls]
+        return [future.result() for future in futures]
+
+    def get_google_token_and_user_info(self, access_token: str):
+        """
+        Gets the token info (to validate the token) and the user info for a Google access token.
+        :param access_token: the access token
+        :return: a tuple of (the token info, the user info)
+        """
+        token_info, user_info = self._get_json_all(
+            ('{}/oauth2/v1/tokeninfo'.format(self.google_api_base_url), {'access_token': access_token}),
+            ('{}/oauth2/v1/userinfo'.format(self.google_api_base_url), {'access_token': access_token, 'alt': 'json'}))
+        return token_info, user_info
+
+    def exchange_facebook_token(self, app_id: str, app_secret: str, token: str):
+        """
+        Exchanges a short lived Facebook client token for a long lived server side token.
+        :param app_id: the Facebook app id
+        :param app_secret: the Facebook app secret
+        :param token: the client token
+        :return: the parsed JSON response, including access_token if the exchange succeeded
+        """
+        return self._get_json('{}/oauth/access_token'.format(self.facebook_graph_base_url), {
+            'grant_type': 'fb_exchange_token',
+            'client_id': app_id,
+            'client_secret': app_secret,
+            'fb_exchange_token': token
+        })
+
+    def get_facebook_user_and_picture(self, access_token: str):
+        """
+        Gets the profile and the profile picture of the Facebook user an access token belongs to.
+        :param access_token: the access token
+        :return: a tuple of (the user's name, email and id, the picture info)
+        """
+        user, picture = self._get_json_all(
+            ('{}/me'.format(self.facebook_graph_base_url), {'access_token': access_token, 'fields': 'name,email,id'}),
+            ('{}/me/picture'.format(self.facebook_graph_base_url), {
+                'access_token': access_token,
+                'redirect': 0,
+                'height': FACEBOOK_PICTURE_SIZE,
+                'width': FACEBOOK_PICTURE_SIZE
+            }))
+        return user, picture
+
+    def revoke_google_token(self, access_token: str):
+        """
+        Revokes a Google access token. Raises OAuthProviderError if the revocation failed.
+        :param access_token: the access token
+        """
+        url = '{}/o/oauth2/revoke'.format(self.google_accounts_base_url)
+        self._check_status('POST', url, self._request('POST', url, data={'token': access_token}))
+
+    def revoke_facebook_permissions(self, facebook_id: str, access_token: str):
+        """
+        Revokes the permissions a Facebook user granted the app. Raises OAuthProviderError if the revocation failed.
+        :param facebook_id: the user's Facebook id
+        :param access_token: the user's access token
+        """
+        url = '{}/{}/permissions'.format(self.facebook_graph_base_url, facebook_id)
+        self._check_status('DELETE', url, self._request('DELETE', url, params={'access_token': access_token}))
@@ -0,0 +1,67 @@
+#
+# Story Time App
+# Cache of rendered website pages and page fragments
+#
+
+from flask import request, session as login_session
+
+from storytime.cache_util import LRUCache
+from storytime.sec_util import is_user_authenticated
+
+PAGE_CACHE_MAX_ENTRIES = 4096
+PAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Bounds how long a page can be stale when a story is changed by another process
+PAGE_CACHE_TTL = 300
+
+# Cache key kinds
+PAGE = 'page'
+FRAGMENT = 'fragment'
+
+# Cache key routes
+INDEX = 'index'
+VIEW_STORY = 'view_story'
+
+# Rendered HTML, keyed by (kind, route, *route specific parts)
+page_cache = LRUCache(maxsize=PAGE_CACHE_MAX_ENTRIES, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_MAX_BYTES,
+                      sizeof=lambda html: len(html.encode('utf-8')))
+
+
+def is_page_cacheable():
+    """
+    Checks to see if the full page for the current request can be served from the cache: only GET requests from
+    anonymous users without flashed messages waiting to be shown get the same page as everyone else.
+    :return: a boolean indicating if the page can be cached
+    """
+    return request.method == 'GET' and not is_user_authenticated() and '_flashes' not in login_session
+
+
+def get_or_render_page(key: tuple, render):
+    """
+    Gets the rendered page for the current request from the cache, rendering and caching it if it is not cached.
+    Pages are only cached for requests where is_page_cacheable is true; otherwise the page is always rendered.
+    :param key: the route specific part of the cache key, e.g. (VIEW_STORY, story_id, date_last_modified)
+    :param render: a function with no arguments that returns the rendered page
+    :return: the rendered page
+    """
+    if not is_page_cacheable():
+        return render()
+    return page_cache.get_or_load((PAGE,) + key, render)
+
+
+def get_or_render_fragment(key: tuple, render):
+    """
+    Gets a rendered page fragment that does not depend on the user from the cache, rendering and caching it if it
+    is not cached.
+    :param key: the route specific part of the cache key, e.g. (INDEX, cursor)
+    :param render: a function with no arguments that returns the rendered fragment
+    :return: the rendered fragment
+    """
+    return page_cache.get_or_load((FRAGMENT,) + key, render)
+
+
+def invalidate_story(story_id: int):
+    """
+    Removes the cached pages and fragments that show the given story: the story's own page and the story lists.
+    :param story_id: the primary key of the story that changed
+    """
+    page_cache.invalidate_where(lambda key: key[1] == INDEX or (key[1] == VIEW_STORY and key[2] == story_id))
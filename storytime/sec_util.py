@@ -32,10 +32,12 @@ class LoginSessionKeys(Enum):
     GOOGLE_CREDENTIALS_JSON = 'google_credentials_json'
     GOOGLE_ID = 'google_id'
     FACEBOOK_ID = 'facebook_id'
+    FACEBOOK_ACCESS_TOKEN = 'facebook_access_token'
 
 
 def store_user_session(user_id: int, username: str, email: str, picture: str, provider: AuthProvider,
-                       google_credentials_json=None, google_id: int = None, facebook_id: int = None):
+                       google_credentials_json=None, google_id: int = None, facebook_id: int = None,
+                       facebook_access_token: str = None):
     """
     Stores a user session by adding each of the given parameters to the session.
     :param user_id: the (SecUser) user id of the logged in user
@@ -46,6 +48,7 @@ def store_user_session(user_id: int, username: str, email: str, picture: str, pr
     :param google_credentials_json: the google json credentials object for the user
     :param google_id: the google id for the user
     :param facebook_id: the facebook id for the user
+    :param facebook_access_token: the facebook access token for the user (used to revoke it on logout)
     :return:
     """
     # Validation
@@ -65,6 +68,7 @@ def store_user_session(user_id: int, username: str, email: str, picture: str, pr
     login_session[LoginSessionKeys.GOOGLE_CREDENTIALS_JSON.value] = google_credentials_json
     login_session[LoginSessionKeys.GOOGLE_ID.value] = google_id
     login_session[LoginSessionKeys.FACEBOOK_ID.value] = facebook_id
+    login_session[LoginSessionKeys.FACEBOOK_ACCESS_TOKEN.value] = facebook_access_token
 
 
 def reset_user_session():
@@ -79,6 +83,7 @@ def reset_user_session():
     login_session.pop(LoginSessionKeys.GOOGLE_CREDENTIALS_JSON.value, None)
     login_session.pop(LoginSessionKeys.GOOGLE_ID.value, None)
     login_session.pop(LoginSessionKeys.FACEBOOK_ID.value, None)
+    login_session.pop(LoginSessionKeys.FACEBOOK_ACCESS_TOKEN.value, None)
 
 
 def is_user_authenticated():
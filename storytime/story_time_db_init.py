@@ -5,12 +5,16 @@
 
 import configparser
 import os
+from collections import namedtuple
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, Table, Text, create_engine, text
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, PrimaryKeyConstraint, Table, Text, create_engine, text
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import deferred, relationship, scoped_session, sessionmaker
 from sqlalchemy.types import DateTime
 
+from storytime.db_pool import TimedQueuePool
+
 Base = declarative_base()
 
 
@@ -33,13 +37,40 @@ class UploadFile(Base):
     id = Column(Integer, primary_key=True)
     filename = Column(Text, nullable=False, unique=True)
     url = Column(Text, nullable=False)
+    # Hex SHA-256 hash of the file content (None for files stored before uploads were content addressed)
+    content_hash = Column(Text, nullable=True, unique=True)
+    # Number of stories using the file; the file is deleted when the last one stops using it
+    ref_count = Column(Integer, nullable=False, default=1)
+    # Resized variants of the image by name (see file_storage_service.IMAGE_VARIANTS), each a dict of filename, url
+    # and width; None until the variants have been created
+    variants = Column(JSONB, nullable=True)
+
+    def get_variant_url(self, name: str):
+        """
+        Gets the url of the named image variant, falling back to the original until the variant has been created.
+        :param name: the name of the variant
+        :return: the url
+        """
+        variant = (self.variants or {}).get(name)
+        return variant['url'] if variant else self.url
+
+    @property
+    def srcset(self):
+        """
+        The srcset attribute value listing the image variants by width, or None if there are no variants yet.
+        """
+        if not self.variants:
+            return None
+        widths = {variant['url']: variant['width'] for variant in self.variants.values()}
+        return ', '.join('{} {}w'.format(url, width) for url, width in sorted(widths.items(), key=lambda item: item[1]))
 
     @property
     def serialize(self):
         return {
             'id': self.id,
             'filename': self.filename,
-            'url': self.url
+            'url': self.url,
+            'variants': self.variants
         }
 
 
@@ -61,20 +92,33 @@ class Story(Base):
     upload_file_id = Column(Integer, ForeignKey('upload_file.id'), nullable=True)
     user = relationship("User")
     upload_file = relationship("UploadFile")
+    # Maintained by a DB trigger for full text search; never loaded unless asked for
+    search_vector = deferred(Column(TSVECTOR))
+    # The lines of story_text, split when the story is saved (NULL for stories saved before the column was added)
+    paragraphs = deferred(Column(JSONB(none_as_null=True), nullable=True))
+
+    # The fields of the serialized story, in order
+    FIELDS = ('id', 'title', 'description', 'published', 'story_text', 'user_id', 'date_created', 'date_last_modified',
+              'categories')
+    # The fields of the serialized story but its text, which can be megabytes
+    SUMMARY_FIELDS = tuple(field for field in FIELDS if field != 'story_text')
 
     @property
     def serialize(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'description': self.description,
-            'published': self.published,
-            'story_text': self.story_text,
-            'user_id': self.user_id,
-            'date_created': self.date_created,
-            'date_last_modified': self.date_last_modified,
-            'categories': [category.serialize for category in self.categories]
-        }
+        return self.serialize_fields(Story.FIELDS)
+
+    def serialize_fields(self, fields):
+        """
+        Serializes only the given fields of the story, so columns that were not loaded are not loaded to serialize it.
+        :param fields: the fields to include, from Story.FIELDS
+        :return: a dict of the fields, in the order of Story.FIELDS
+        """
+        serialized = {}
+        for field in Story.FIELDS:
+            if field in fields:
+                serialized[field] = [category.serialize for category in self.categories] if field == 'categories' \
+                    else getattr(self, field)
+        return serialized
 
 
 class Category(Base):
@@ -95,6 +139,40 @@ class Category(Base):
         }
 
 
+class StoryCount(Base):
+    """
+    StoryCount is a Python SQL Alchemy representation of the story_count DB table, which holds the number of
+    published stories overall (scope 'all'), per category (scope 'category') and per user (scope 'user'), and when
+    the published stories in each last changed.
+    """
+    __tablename__ = 'story_count'
+    __table_args__ = (PrimaryKeyConstraint('scope', 'scope_id'),)
+    scope = Column(Text, nullable=False)
+    scope_id = Column(Integer, nullable=False)
+    published_count = Column(Integer, nullable=False)
+    last_modified = Column(DateTime(timezone=False), nullable=True)
+
+
+class CategorySnapshot(namedtuple('CategorySnapshot', ['id', 'label', 'description'])):
+    """
+    CategorySnapshot is an immutable copy of a Category row that is not tied to any DB session, so it can be cached
+    and shared between requests.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_category(cls, category: Category):
+        return cls(id=category.id, label=category.label, description=category.description)
+
+    @property
+    def serialize(self):
+        return {
+            'id': self.id,
+            'label': self.label,
+            'description': self.description
+        }
+
+
 # Represents join table story_category
 story_category_join_table = Table('story_category', Base.metadata,
                                   Column('story_id', Integer, ForeignKey('story.id')),
@@ -109,12 +187,19 @@ db_port = db_config['DEFAULT']['db.port']
 db_name = db_config['DEFAULT']['db.name']
 db_user = db_config['DEFAULT']['db.user']
 db_password = db_config['DEFAULT']['db.password']
+db_pool_size = db_config['DEFAULT'].getint('db.pool_size', fallback=5)
+db_max_overflow = db_config['DEFAULT'].getint('db.max_overflow', fallback=10)
+db_pool_pre_ping = db_config['DEFAULT'].getboolean('db.pool_pre_ping', fallback=True)
+db_pool_recycle = db_config['DEFAULT'].getint('db.pool_recycle', fallback=3600)
 
 # Create an Engine, which the session will use for connection resources
-db_engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(db_user, db_password, db_server, db_port, db_name))
+db_engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(db_user, db_password, db_server, db_port, db_name),
+                          pool_size=db_pool_size, max_overflow=db_max_overflow, pool_pre_ping=db_pool_pre_ping,
+                          pool_recycle=db_pool_recycle, poolclass=TimedQueuePool)
 
 # Create a configured "Session" class
 Session = sessionmaker(bind=db_engine)
 
-# Create a session
-db_session = Session()
+# Create a thread local session registry. Each thread (i.e. each request being served) gets its own session
+# through the db_session proxy; call db_session.remove() when the work (i.e. the request) is done.
+db_session = scoped_session(Session)
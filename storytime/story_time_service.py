@@ -3,15 +3,606 @@
 # Exposes functions that connect to and query the storytime DB
 #
 
+import base64
+import binascii
+import datetime
+import json
+import threading
+import traceback
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from types import MappingProxyType
 from typing import List
 
+from markupsafe import Markup, escape
+from sqlalchemy import REAL, and_, cast, func, inspect, tuple_
+from sqlalchemy.orm import defer, joinedload, load_only, make_transient_to_detached, selectinload
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.datastructures import FileStorage
 
 from storytime import file_storage_service
-from storytime.story_time_db_init import Category, Story, UploadFile, User, db_engine, db_session
+from storytime.cache_util import LRUCache
+from storytime.story_id_pool import StoryIdPool
+from storytime.story_time_db_init import Category, CategorySnapshot, Story, StoryCount, UploadFile, User, \
+    db_session
 
-SQL_GET_STORY_RANDOM = 'SELECT id FROM story ORDER BY random() LIMIT 1'
+# Random story selection
+RANDOM_STORY_MAX_ATTEMPTS = 5
+
+# Content addressed upload files. The advisory lock serializes adding and removing references to the same content,
+# so a file is never deleted from disk while a concurrent upload of the same content is reusing it.
+SQL_LOCK_UPLOAD_CONTENT = 'SELECT pg_advisory_xact_lock(hashtext(:content_hash))'
+SQL_ADD_UPLOAD_FILE_REFERENCE = '''
+    INSERT INTO upload_file (filename, url, content_hash, ref_count) VALUES (:filename, :url, :content_hash, 1)
+    ON CONFLICT (content_hash) DO UPDATE SET ref_count = upload_file.ref_count + 1
+    RETURNING id, ref_count'''
+SQL_REMOVE_UPLOAD_FILE_REFERENCE = 'UPDATE upload_file SET ref_count = ref_count - 1 WHERE id = :id RETURNING ref_count'
+
+# Image variant creation
+IMAGE_VARIANT_WORKERS = 2
+IMAGE_VARIANT_MAX_PENDING = 100
+
+# Category cache
+CATEGORY_CACHE_MAX_SIZE = 16
+CATEGORY_CACHE_TTL = 300
+CATEGORY_CACHE_KEY_ALL = 'categories'
+
+# Pre-rendered story bodies
+STORY_BODY_CACHE_MAX_SIZE = 1024
+STORY_BODY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+STORY_BODY_BACKFILL_BATCH_SIZE = 500
+STORY_PARAGRAPH_HTML = '<p class="text-left">{}</p>'
+
+# Story text pages. Only the requested slice of the paragraphs is sent from the DB.
+STORY_TEXT_PAGE_SIZE = 50
+SQL_GET_STORY_TEXT_PAGE = '''
+    SELECT jsonb_array_length(s.paragraphs) AS total,
+           (SELECT coalesce(jsonb_agg(p.paragraph ORDER BY p.position), '[]'::jsonb)
+            FROM jsonb_array_elements_text(s.paragraphs) WITH ORDINALITY AS p(paragraph, position)
+            WHERE p.position > :offset AND p.position <= :offset + :limit) AS paragraphs
+    FROM story s WHERE s.id = :id'''
+
+# Published story counts and the time the published stories in each scope last changed
+SQL_INCREMENT_STORY_COUNT = '''
+    INSERT INTO story_count (scope, scope_id, published_count, last_modified)
+    VALUES (:scope, :scope_id, :delta, TIMEZONE('utc', CURRENT_TIMESTAMP))
+    ON CONFLICT (scope, scope_id) DO UPDATE
+    SET published_count = story_count.published_count + :delta, last_modified = EXCLUDED.last_modified'''
+SQL_LOCK_STORY_COUNT = 'LOCK TABLE story_count IN SHARE ROW EXCLUSIVE MODE'
+SQL_RESET_STORY_COUNTS = 'UPDATE story_count SET published_count = 0'
+# The last modified times are never moved back, so a list version is not repeated after stories are deleted
+SQL_INSERT_STORY_COUNTS = '''
+    INSERT INTO story_count (scope, scope_id, published_count, last_modified)
+    SELECT 'all', 0, count(*), max(date_last_modified) FROM story WHERE published
+    UNION ALL
+    SELECT 'category', sc.category_id, count(*), max(s.date_last_modified)
+    FROM story_category sc JOIN story s ON s.id = sc.story_id WHERE s.published GROUP BY sc.category_id
+    UNION ALL
+    SELECT 'user', user_id, count(*), max(date_last_modified) FROM story WHERE published AND user_id IS NOT NULL
+    GROUP BY user_id
+    ON CONFLICT (scope, scope_id) DO UPDATE
+    SET published_count = EXCLUDED.published_count,
+        last_modified = GREATEST(story_count.last_modified, EXCLUDED.last_modified)'''
+
+# Pagination
+STORIES_PAGE_SIZE = 12
+STREAM_BATCH_SIZE = 500
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class StoryCountScope(Enum):
+    """
+    Enum representing the scopes published stories are counted in.
+    """
+    ALL = 'all'
+    CATEGORY = 'category'
+    USER = 'user'
+
+
+class EagerLoadStrategy(Enum):
+    """
+    Enum representing the ways the relationships of stories (categories, user, upload_file) can be eager loaded
+    by the story listing functions.
+    SELECTIN: one extra SELECT ... WHERE id IN (...) per relationship
+    JOINED: a single SELECT with LEFT OUTER JOINs to each relationship
+    """
+    SELECTIN = 'selectin'
+    JOINED = 'joined'
+
+
+# The eager load strategy used by the story listing functions when none is given
+STORY_LIST_EAGER_LOAD_STRATEGY = EagerLoadStrategy.SELECTIN
+
+# Search
+SEARCH_PAGE_SIZE = 12
+SEARCH_CONFIG = 'english'
+# Matches are wrapped in control characters, which cannot appear in the escaped snippet, then replaced with <mark>
+SEARCH_SNIPPET_START = '\x02'
+SEARCH_SNIPPET_STOP = '\x03'
+SEARCH_SNIPPET_OPTIONS = 'StartSel={}, StopSel={}, MinWords=15, MaxWords=35, MaxFragments=2'.format(
+    SEARCH_SNIPPET_START, SEARCH_SNIPPET_STOP)
+
+# A story matching a search, its rank and an HTML snippet of its text with the matches highlighted
+SearchResult = namedtuple('SearchResult', ['story', 'rank', 'snippet'])
+
+# A page of search results and the cursor to use to fetch the next page (None if this is the last page)
+SearchPage = namedtuple('SearchPage', ['results', 'next_cursor'])
+
+# A page of stories and the cursor to use to fetch the next page (None if this is the last page)
+StoryPage = namedtuple('StoryPage', ['stories', 'next_cursor'])
+
+# The stories found for a list of ids, in the order of the ids, and the ids no story was found for
+StoryBatch = namedtuple('StoryBatch', ['stories', 'missing_ids'])
+
+# A page of a story's paragraphs, the offset of its first paragraph, the number of paragraphs in the story and the
+# offset of the next page (None if this is the last page)
+StoryTextPage = namedtuple('StoryTextPage', ['paragraphs', 'offset', 'total', 'next_offset'])
+
+# A page of a story's paragraphs rendered as HTML, the number of paragraphs in the story and the offset of the next
+# page (None if this is the last page)
+StoryBody = namedtuple('StoryBody', ['html', 'total', 'next_offset'])
+
+# What the page of a story depends on: the date the story was last modified, and whether the resized variants of its
+# image have been created (which happens after the story is saved)
+StoryVersion = namedtuple('StoryVersion', ['date_last_modified', 'has_image_variants'])
+
+# A category and the number of published stories in it
+CategoryWithCount = namedtuple('CategoryWithCount', ['category', 'published_count'])
+
+
+def _story_list_load_options(eager_load: EagerLoadStrategy = None, fields=None):
+    """
+    Builds the query options that eager load the relationships read when listing stories, so that a list of
+    stories is loaded in a constant number of queries regardless of its size. The story text, which lists do not
+    show, is not loaded unless it is one of the given fields.
+    :param eager_load: the eager load strategy to use (or None for STORY_LIST_EAGER_LOAD_STRATEGY)
+    :param fields: the serialized fields (from Story.FIELDS) to load, plus the id and date created the stories are
+    ordered and paged by (or None to load the columns and relationships shown by the HTML pages)
+    :return: a list of query options
+    """
+    strategy = eager_load or STORY_LIST_EAGER_LOAD_STRATEGY
+    loader = joinedload if strategy == EagerLoadStrategy.JOINED else selectinload
+    if fields is None:
+        return [defer(Story.story_text), loader(Story.categories), loader(Story.user), loader(Story.upload_file)]
+
+    columns = {'id', 'date_created'} | {field for field in fields if field != 'categories'}
+    options = [load_only(*columns)]
+    if 'categories' in fields:
+        options.append(loader(Story.categories))
+    return options
+
+
+def _get_published_story_ids(after_id: int):
+    """
+    Gets the ids of published stories greater than the given id.
+    :param after_id: the id to start after
+    :return: a list of story ids
+    """
+    return [row.id for row in db_session.query(Story.id).filter(Story.published.is_(True), Story.id > after_id)]
+
+
+# The published story ids that random stories are chosen from
+_published_story_id_pool = StoryIdPool(load_ids=_get_published_story_ids, on_background_load=db_session.remove)
+
+# Background workers that create resized image variants, with a bound on the number of pending jobs
+_image_variant_executor = ThreadPoolExecutor(max_workers=IMAGE_VARIANT_WORKERS)
+_image_variant_slots = threading.BoundedSemaphore(IMAGE_VARIANT_MAX_PENDING)
+
+# Read through cache of the category table
+_category_cache = LRUCache(maxsize=CATEGORY_CACHE_MAX_SIZE, ttl=CATEGORY_CACHE_TTL)
+
+# Rendered story body pages, keyed by (story id, date last modified, offset) so an updated story is never served
+# stale
+_story_body_cache = LRUCache(maxsize=STORY_BODY_CACHE_MAX_SIZE, max_bytes=STORY_BODY_CACHE_MAX_BYTES,
+                             sizeof=lambda story_body: len(story_body.html))
+
+
+# Story change listeners, called with the story id after a story is created, updated or deleted
+_story_change_listeners = []
+
+
+def register_story_change_listener(listener):
+    """
+    Registers a function to be called with the story id after a story is created, updated or deleted, e.g. to
+    invalidate caches of rendered stories.
+    :param listener: a function that takes a story id
+    """
+    _story_change_listeners.append(listener)
+
+
+def _notify_story_changed(story_id: int):
+    """
+    Calls each registered story change listener with the given story id.
+    :param story_id: the primary key of the story that changed
+    """
+    _story_body_cache.invalidate_where(lambda key: key[0] == story_id)
+    for listener in _story_change_listeners:
+        listener(story_id)
+
+
+def reset_caches():
+    """
+    Reloads the in-process caches of this module. Call after the DB has been changed without going through this
+    module, e.g. by a bulk load.
+    """
+    _published_story_id_pool.reload()
+    _category_cache.invalidate()
+    _story_body_cache.invalidate()
+
+
+# Published story count functions
+def _get_story_count_keys(published: bool, user_id: int, category_ids):
+    """
+    Gets the story_count rows a story with the given attributes is counted in.
+    :param published: whether or not the story is published
+    :param user_id: the primary key of the story's user
+    :param category_ids: the primary keys of the story's categories
+    :return: a set of (scope, scope_id) tuples
+    """
+    if not published:
+        return set()
+    keys = {(StoryCountScope.ALL.value, 0)}
+    if user_id:
+        keys.add((StoryCountScope.USER.value, user_id))
+    keys.update((StoryCountScope.CATEGORY.value, category_id) for category_id in category_ids)
+    return keys
+
+
+def _get_committed_story_count_keys(story: Story):
+    """
+    Gets the story_count rows the given story is counted in as of its last load from the DB, ignoring any changes
+    made to it since.
+    :param story: a persistent story
+    :return: a set of (scope, scope_id) tuples
+    """
+    state = inspect(story)
+    published = state.attrs.published.history.non_added()
+    user_id = state.attrs.user_id.history.non_added()
+    categories = state.attrs.categories.history.non_added()
+    return _get_story_count_keys(published=bool(published and published[0]),
+                                 user_id=user_id[0] if user_id else None,
+                                 category_ids=[category.id for category in categories])
+
+
+def _update_story_counts(before: set, after: set):
+    """
+    Applies the changes between the story_count rows a story was and is counted in, as part of the current
+    transaction, and updates the last modified time of each of them (including the rows it stays counted in, as
+    the story itself changed).
+    :param before: the (scope, scope_id) tuples the story was counted in
+    :param after: the (scope, scope_id) tuples the story is counted in
+    """
+    deltas = {key: 1 for key in after - before}
+    deltas.update({key: -1 for key in before - after})
+    deltas.update({key: 0 for key in before & after})
+
+    # Update rows in a consistent order so concurrent transactions cannot deadlock
+    for (scope, scope_id), delta in sorted(deltas.items()):
+        db_session.execute(SQL_INCREMENT_STORY_COUNT, {'scope': scope, 'scope_id': scope_id, 'delta': delta})
+
+
+def reconcile_story_counts():
+    """
+    Rebuilds the story_count table from the story tables. Run periodically, and after stories have been changed
+    without going through this module, to correct any drift.
+    """
+    try:
+        db_session.execute(SQL_LOCK_STORY_COUNT)
+        db_session.execute(SQL_RESET_STORY_COUNTS)
+        db_session.execute(SQL_INSERT_STORY_COUNTS)
+        db_session.commit()
+    except Exception as exc:
+        db_session.rollback()
+        raise exc
+
+
+# Upload file reference functions
+def _add_upload_file_reference(image_file: FileStorage):
+    """
+    Stores an uploaded image by the hash of its content, as part of the current transaction. If the same content is
+    already stored, nothing is written to disk and the existing upload file's reference count is incremented.
+    :param image_file: the uploaded image
+    :return: a tuple of (the UploadFile, a boolean indicating if the upload file is new)
+    """
+    staged_file = file_storage_service.stage_file(file=image_file)
+    try:
+        db_session.execute(SQL_LOCK_UPLOAD_CONTENT, {'content_hash': staged_file.content_hash})
+        upload_file_id, ref_count = db_session.execute(SQL_ADD_UPLOAD_FILE_REFERENCE, {
+            'filename': staged_file.filename,
+            'url': file_storage_service.get_file_url(staged_file.filename),
+            'content_hash': staged_file.content_hash
+        }).first()
+        upload_file = db_session.query(UploadFile).get(upload_file_id)
+        file_storage_service.store_staged_file(staged_file, filename=upload_file.filename)
+    except Exception as exc:
+        file_storage_service.discard_staged_file(staged_file)
+        raise exc
+    return upload_file, ref_count == 1
+
+
+def _remove_upload_file_reference(upload_file: UploadFile):
+    """
+    Decrements an upload file's reference count as part of the current transaction, deleting its row when the last
+    reference is removed. Call _delete_unreferenced_upload_file after committing to delete it from disk.
+    :param upload_file: the upload file a story no longer uses
+    :return: a boolean indicating if the row was deleted
+    """
+    if upload_file.content_hash:
+        db_session.execute(SQL_LOCK_UPLOAD_CONTENT, {'content_hash': upload_file.content_hash})
+    ref_count = db_session.execute(SQL_REMOVE_UPLOAD_FILE_REFERENCE, {'id': upload_file.id}).scalar()
+    if ref_count > 0:
+        return False
+    db_session.delete(upload_file)
+    return True
+
+
+def _delete_unreferenced_upload_file(upload_file: UploadFile):
+    """
+    Deletes from disk the file of an upload file whose row was deleted by _remove_upload_file_reference, unless a
+    concurrent upload of the same content has stored it again since.
+    :param upload_file: the deleted upload file
+    """
+    try:
+        is_stored_again = False
+        if upload_file.content_hash:
+            db_session.execute(SQL_LOCK_UPLOAD_CONTENT, {'content_hash': upload_file.content_hash})
+            is_stored_again = db_session.query(UploadFile.id).filter_by(
+                content_hash=upload_file.content_hash).first() is not None
+        if not is_stored_again:
+            file_storage_service.delete_file(file=upload_file)
+        # Release the lock
+        db_session.commit()
+    except Exception as exc:
+        db_session.rollback()
+        raise exc
+
+
+# Image variant functions
+def create_image_variants(upload_file_id: int, upload_dir: str, story_id: int = None):
+    """
+    Creates the resized variants of an uploaded image and records them on its UploadFile.
+    :param upload_file_id: the primary key of the upload file
+    :param upload_dir: the directory the image is saved in (see file_storage_service.get_upload_dir)
+    :param story_id: the primary key of the story that shows the image (or None)
+    """
+    try:
+        upload_file = db_session.query(UploadFile).filter_by(id=upload_file_id).one()
+        upload_file.variants = file_storage_service.save_image_variants(filename=upload_file.filename,
+                                                                        url=upload_file.url, upload_dir=upload_dir)
+        db_session.commit()
+    except Exception as exc:
+        db_session.rollback()
+        raise exc
+
+    if story_id:
+        _notify_story_changed(story_id)
+
+
+def _create_image_variants_job(upload_file_id: int, upload_dir: str, story_id: int):
+    """
+    Runs create_image_variants on a background worker thread, which has its own DB session.
+    """
+    try:
+        create_image_variants(upload_file_id=upload_file_id, upload_dir=upload_dir, story_id=story_id)
+    except Exception:
+        print('creating image variants for upload file {} failed:'.format(upload_file_id))
+        traceback.print_exc()
+    finally:
+        db_session.remove()
+        _image_variant_slots.release()
+
+
+def _submit_image_variants(upload_file_id: int, story_id: int):
+    """
+    Queues the creation of the variants of an uploaded image on the background workers. If too many jobs are
+    already pending the job is dropped; pages keep showing the original image until backfill_image_variants runs.
+    :param upload_file_id: the primary key of the upload file
+    :param story_id: the primary key of the story that shows the image
+    :return: a boolean indicating if the job was queued
+    """
+    if not _image_variant_slots.acquire(blocking=False):
+        return False
+    _image_variant_executor.submit(_create_image_variants_job, upload_file_id, file_storage_service.get_upload_dir(),
+                                   story_id)
+    return True
+
+
+def backfill_image_variants():
+    """
+    Creates the image variants of every uploaded image that does not have them yet. Must be called with a Flask app
+    context.
+    :return: the number of images processed
+    """
+    upload_dir = file_storage_service.get_upload_dir()
+    rows = db_session.query(UploadFile.id, Story.id).outerjoin(Story, Story.upload_file_id == UploadFile.id) \
+        .filter(UploadFile.variants.is_(None)).all()
+    for upload_file_id, story_id in rows:
+        create_image_variants(upload_file_id=upload_file_id, upload_dir=upload_dir, story_id=story_id)
+    return len(rows)
+
+
+def shard_upload_files():
+    """
+    Moves every uploaded file (and its image variants) that is not stored in the sharded layout into it, and updates
+    the urls of upload files that are not served from the current upload url. Must be called with a Flask app context,
+    while the app is not accepting uploads.
+    :return: the number of upload files updated
+    """
+    num_updated = 0
+    try:
+        for upload_file in db_session.query(UploadFile).order_by(UploadFile.id).all():
+            filename, variants = file_storage_service.shard_stored_file(filename=upload_file.filename,
+                                                                        variants=upload_file.variants)
+            url = file_storage_service.get_file_url(filename)
+            if (filename, url, variants) == (upload_file.filename, upload_file.url, upload_file.variants):
+                continue
+            upload_file.filename = filename
+            upload_file.url = url
+            upload_file.variants = variants
+            num_updated += 1
+        db_session.commit()
+    except Exception as exc:
+        db_session.rollback()
+        raise exc
+    return num_updated
+
+
+# Story body functions
+def split_story_paragraphs(story_text: str):
+    """
+    Splits story text into the paragraphs it is shown as, one per line.
+    :param story_text: the story text
+    :return: a list of paragraphs
+    """
+    return story_text.splitlines()
+
+
+def _render_story_body(paragraphs: list):
+    """
+    Renders the HTML of a story's paragraphs, escaping the text.
+    :param paragraphs: the paragraphs of the story
+    :return: the HTML markup
+    """
+    return Markup(''.join(STORY_PARAGRAPH_HTML.format(escape(paragraph)) for paragraph in paragraphs))
+
+
+def get_story_text_page(story_id: int, offset: int = 0, limit: int = STORY_TEXT_PAGE_SIZE):
+    """
+    Gets a page of a story's paragraphs. Only the page is read from the paragraphs saved with the story; the whole
+    text is only read for stories that have not been backfilled yet. Raises ValueError if the offset is negative or
+    the limit is not positive.
+    :param story_id: the primary key of the story
+    :param offset: the number of paragraphs to skip
+    :param limit: the maximum number of paragraphs to get
+    :return: a StoryTextPage or None if the story does not exist
+    """
+    if offset < 0 or limit < 1:
+        raise ValueError('The offset must not be negative and the limit must be positive.')
+    row = db_session.execute(SQL_GET_STORY_TEXT_PAGE, {'id': story_id, 'offset': offset, 'limit': limit}).first()
+    if row is None:
+        return None
+
+    if row.total is None:
+        paragraphs = split_story_paragraphs(db_session.query(Story.story_text).filter_by(id=story_id).scalar())
+        total, page_paragraphs = len(paragraphs), paragraphs[offset:offset + limit]
+    else:
+        total, page_paragraphs = row.total, row.paragraphs
+    next_offset = offset + limit if offset + limit < total else None
+    return StoryTextPage(paragraphs=page_paragraphs, offset=offset, total=total, next_offset=next_offset)
+
+
+def get_story_body(story: Story, offset: int = 0):
+    """
+    Gets a page of a story's text rendered as HTML, from the story body cache or else from the paragraphs saved with
+    the story. Raises ValueError if the offset is negative.
+    :param story: the story
+    :param offset: the number of paragraphs to skip
+    :return: a StoryBody
+    """
+    def load():
+        page = get_story_text_page(story.id, offset=offset)
+        return StoryBody(html=_render_story_body(page.paragraphs), total=page.total, next_offset=page.next_offset)
+
+    return _story_body_cache.get_or_load((story.id, story.date_last_modified, offset), load)
+
+
+def get_story_body_cache_stats():
+    """
+    Gets the hit, miss and size counters of the story body cache.
+    :return: a dict of cache statistics
+    """
+    return _story_body_cache.stats()
+
+
+def backfill_story_paragraphs(batch_size: int = STORY_BODY_BACKFILL_BATCH_SIZE):
+    """
+    Splits and saves the paragraphs of every story saved before they were stored, committing batch_size stories at a
+    time. The stories' dates last modified are not changed.
+    :param batch_size: the number of stories to update per transaction
+    :return: the number of stories updated
+    """
+    num_updated = 0
+    while True:
+        try:
+            rows = db_session.query(Story.id, Story.story_text).filter(Story.paragraphs.is_(None)) \
+                .order_by(Story.id).limit(batch_size).all()
+            if not rows:
+                return num_updated
+            db_session.bulk_update_mappings(Story, [
+                {'id': story_id, 'paragraphs': split_story_paragraphs(story_text)} for story_id, story_text in rows])
+            db_session.commit()
+        except Exception as exc:
+            db_session.rollback()
+            raise exc
+        num_updated += len(rows)
+
+
+# Pagination functions
+def _encode_cursor_values(values: list):
+    """
+    Encodes a list of JSON serializable keyset values as an opaque cursor string.
+    :param values: the keyset values of the last row on a page
+    :return: a url safe cursor string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor_values(cursor: str):
+    """
+    Decodes a cursor created by _encode_cursor_values. Raises ValueError if the cursor is not valid.
+    :param cursor: the cursor string
+    :return: the list of keyset values
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, binascii.Error) as exc:
+        raise ValueError('Invalid cursor: {}'.format(cursor)) from exc
+
+
+def _encode_cursor(story: Story):
+    """
+    Encodes the keyset position (date_created, id) of the given story as an opaque cursor string.
+    :param story: the last story on a page
+    :return: a url safe cursor string
+    """
+    return _encode_cursor_values([story.date_created.strftime(CURSOR_DATE_FORMAT), story.id])
+
+
+def _decode_cursor(cursor: str):
+    """
+    Decodes a cursor created by _encode_cursor. Raises ValueError if the cursor is not valid.
+    :param cursor: the cursor string
+    :return: a tuple of (date_created, story_id)
+    """
+    try:
+        date_created, story_id = _decode_cursor_values(cursor)
+        return datetime.datetime.strptime(date_created, CURSOR_DATE_FORMAT), int(story_id)
+    except (ValueError, TypeError) as exc:
+        raise ValueError('Invalid cursor: {}'.format(cursor)) from exc
+
+
+def _encode_search_cursor(rank: float, story_id: int):
+    """
+    Encodes the keyset position (rank, id) of a search result as an opaque cursor string.
+    :param rank: the rank of the last result on a page
+    :param story_id: the primary key of the story of the last result on a page
+    :return: a url safe cursor string
+    """
+    return _encode_cursor_values([rank, story_id])
+
+
+def _decode_search_cursor(cursor: str):
+    """
+    Decodes a cursor created by _encode_search_cursor. Raises ValueError if the cursor is not valid.
+    :param cursor: the cursor string
+    :return: a tuple of (rank, story_id)
+    """
+    try:
+        rank, story_id = _decode_cursor_values(cursor)
+        return float(rank), int(story_id)
+    except (ValueError, TypeError) as exc:
+        raise ValueError('Invalid cursor: {}'.format(cursor)) from exc
 
 
 # User functions
@@ -71,18 +662,29 @@ def create_story(story: Story, image_file: FileStorage = None):
     :param image_file: the image file to save (or None)
     :return: an integer representing the primary key of the object created
     """
+    create_image_variants_for = None
     try:
+        story.paragraphs = split_story_paragraphs(story.story_text)
         if image_file:
-            upload_file = file_storage_service.save_file(file=image_file)
-            create_upload_file(upload_file)
-            story.upload_file_id = upload_file.id
+            story.upload_file, is_new_upload_file = _add_upload_file_reference(image_file)
+            if is_new_upload_file:
+                create_image_variants_for = story.upload_file.id
         db_session.add(story)
+        _update_story_counts(before=set(), after=_get_story_count_keys(
+            published=story.published, user_id=story.user_id,
+            category_ids=[category.id for category in story.categories]))
         db_session.commit()
-        return story.id
     except Exception as exc:
         db_session.rollback()
         raise exc
 
+    if story.published:
+        _published_story_id_pool.add(story.id)
+    _notify_story_changed(story.id)
+    if create_image_variants_for:
+        _submit_image_variants(upload_file_id=create_image_variants_for, story_id=story.id)
+    return story.id
+
 
 def update_story(story: Story, remove_existing_image: bool, new_image_file):
     """
@@ -91,36 +693,56 @@ def update_story(story: Story, remove_existing_image: bool, new_image_file):
     :param remove_existing_image: a flag indicating whether or not to remove the existing image from the story
     :param new_image_file: a new image file to associate with the story
     """
-    # Save the old upload file for deletion later (if instructed to remove it)
-    old_upload_file_to_delete = story.upload_file if remove_existing_image and story.upload_file else None
+    # Get the story counts the story was included in before it was changed
+    story_count_keys_before = _get_committed_story_count_keys(story)
+
+    # Save the old upload file for removal (if instructed to remove it)
+    old_upload_file = story.upload_file if remove_existing_image and story.upload_file else None
+    old_upload_file_to_delete = None
+    create_image_variants_for = None
 
     try:
+        story.paragraphs = split_story_paragraphs(story.story_text)
+
         # Removing existing image from story
         if remove_existing_image:
             story.upload_file = None
 
         # Save new file and add new image to story
         if new_image_file:
-            story.upload_file = file_storage_service.save_file(file=new_image_file)
+            story.upload_file, is_new_upload_file = _add_upload_file_reference(new_image_file)
+            if is_new_upload_file:
+                create_image_variants_for = story.upload_file.id
 
         # Save story to DB
         db_session.add(story)
         db_session.execute("UPDATE story SET date_last_modified = TIMEZONE('utc', CURRENT_TIMESTAMP) WHERE id = :id",
                            {'id': story.id})
+        _update_story_counts(before=story_count_keys_before, after=_get_story_count_keys(
+            published=story.published, user_id=story.user_id,
+            category_ids=[category.id for category in story.categories]))
 
-        # Remove old file from DB
-        if old_upload_file_to_delete:
-            db_session.delete(old_upload_file_to_delete)
+        # Remove the story's reference to the old file, deleting it from the DB if no other story uses it
+        if old_upload_file and _remove_upload_file_reference(old_upload_file):
+            old_upload_file_to_delete = old_upload_file
 
         db_session.commit()
     except Exception as exc:
         db_session.rollback()
         raise exc
 
+    if story.published:
+        _published_story_id_pool.add(story.id)
+    else:
+        _published_story_id_pool.discard(story.id)
+    _notify_story_changed(story.id)
+    if create_image_variants_for:
+        _submit_image_variants(upload_file_id=create_image_variants_for, story_id=story.id)
+
     # Finally, delete the old image from the file system (do this last so we only delete when we know everything
     # else has succeeded)
     if old_upload_file_to_delete:
-        file_storage_service.delete_file(file=old_upload_file_to_delete)
+        _delete_unreferenced_upload_file(old_upload_file_to_delete)
 
 
 def delete_story(story_id: int):
@@ -128,83 +750,316 @@ def delete_story(story_id: int):
     Permanently deletes the story for the given story_id
     :param story_id: the primary key of the story to delete
     """
+    upload_file_to_delete = None
     try:
         story = db_session.query(Story).filter_by(id=story_id).one()
         upload_file = story.upload_file
+        _update_story_counts(before=_get_story_count_keys(
+            published=story.published, user_id=story.user_id,
+            category_ids=[category.id for category in story.categories]), after=set())
         story.categories = []
         db_session.delete(story)
-        if upload_file:
-            file_storage_service.delete_file(file=upload_file)
-            db_session.delete(upload_file)
+        if upload_file and _remove_upload_file_reference(upload_file):
+            upload_file_to_delete = upload_file
         db_session.commit()
     except Exception as exc:
         db_session.rollback()
         raise exc
 
+    _published_story_id_pool.discard(story_id)
+    _notify_story_changed(story_id)
 
-def get_published_stories_count():
+    # Delete the image from the file system once the story is deleted, if no other story uses it
+    if upload_file_to_delete:
+        _delete_unreferenced_upload_file(upload_file_to_delete)
+
+
+def _get_story_count_row(category_id: int = None, user_id: int = None):
     """
-    Gets the count of all published stories.
+    Gets the story_count row for all stories, or for a category or user.
+    :param category_id: the primary key of the category
+    :param user_id: the primary key of the user
+    :return: a (published_count, last_modified) row or None if the scope has never had a published story
+    """
+    if category_id and user_id:
+        raise ValueError('Only one of category_id and user_id may be provided')
+    if category_id:
+        scope, scope_id = StoryCountScope.CATEGORY, category_id
+    elif user_id:
+        scope, scope_id = StoryCountScope.USER, user_id
+    else:
+        scope, scope_id = StoryCountScope.ALL, 0
+    return db_session.query(StoryCount.published_count, StoryCount.last_modified) \
+        .filter_by(scope=scope.value, scope_id=scope_id).first()
+
+
+def get_published_stories_count(category_id: int = None, user_id: int = None):
+    """
+    Gets the count of published stories, overall or for a category or user, from the story_count table.
+    :param category_id: the primary key of the category to count stories in
+    :param user_id: the primary key of the user to count stories for
     :return: the number of published stories
     """
-    return db_session.query(Story).filter_by(published=True).count()
+    row = _get_story_count_row(category_id=category_id, user_id=user_id)
+    return row.published_count if row else 0
 
 
-def get_published_stories(count: int = None):
+def get_published_stories_version(category_id: int = None):
+    """
+    Gets the values that change whenever the list of published stories changes: the time a published story was last
+    created, updated, unpublished or deleted, and the count, read together from the story_count table.
+    :param category_id: the primary key for the category to filter on (or None for all categories)
+    :return: a tuple of (last modified, count)
+    """
+    row = _get_story_count_row(category_id=category_id)
+    return (row.last_modified, row.published_count) if row else (None, 0)
+
+
+def get_published_stories(count: int = None, eager_load: EagerLoadStrategy = None):
     """
     Gets all published stories.
     :param count: the number of stories to retrieve
+    :param eager_load: the eager load strategy for the story relationships
     :return: a list of stories
     """
-    query = db_session.query(Story).filter_by(published=True).order_by(Story.date_created.desc())
+    query = db_session.query(Story).options(*_story_list_load_options(eager_load)).filter_by(published=True) \
+        .order_by(Story.date_created.desc(), Story.id.desc())
     if count:
         query = query.limit(count)
     return query.all()
 
 
-def get_published_stories_by_category_id(category_id: int):
+def get_published_stories_page(cursor: str = None, limit: int = STORIES_PAGE_SIZE, category_id: int = None,
+                               eager_load: EagerLoadStrategy = None, fields=None):
+    """
+    Gets a page of published stories ordered by date created descending, using keyset pagination on
+    (date_created, id) so the cost of fetching a page does not depend on how deep into the list it is.
+    Raises ValueError if the cursor is not valid.
+    :param cursor: the cursor returned with the previous page (or None for the first page)
+    :param limit: the maximum number of stories to retrieve
+    :param category_id: the primary key for the category to filter on (or None for all categories)
+    :param eager_load: the eager load strategy for the story relationships
+    :param fields: the serialized fields (from Story.FIELDS) to load (or None for those shown by the HTML pages)
+    :return: a StoryPage
+    """
+    query = db_session.query(Story).options(*_story_list_load_options(eager_load, fields)).filter_by(published=True)
+    if category_id:
+        query = query.filter(Story.categories.any(Category.id == category_id))
+    if cursor:
+        date_created, story_id = _decode_cursor(cursor)
+        query = query.filter(tuple_(Story.date_created, Story.id) < tuple_(date_created, story_id))
+
+    # Fetch one extra row to find out whether there is a next page
+    stories = query.order_by(Story.date_created.desc(), Story.id.desc()).limit(limit + 1).all()
+    next_cursor = _encode_cursor(stories[limit - 1]) if len(stories) > limit else None
+    return StoryPage(stories=stories[:limit], next_cursor=next_cursor)
+
+
+def iter_published_stories(category_id: int = None, batch_size: int = STREAM_BATCH_SIZE, fields=Story.FIELDS):
+    """
+    Iterates over all published stories ordered by date created descending. Rows are fetched through a server side
+    cursor batch_size at a time, so memory use does not depend on the number of stories.
+    :param category_id: the primary key for the category to filter on (or None for all categories)
+    :param batch_size: the number of stories to fetch from the DB at a time
+    :param fields: the serialized fields (from Story.FIELDS) to load
+    :return: an iterator of stories
+    """
+    # Categories are the only relationship serialized; select in loading is the only collection eager load
+    # strategy that works with yield_per
+    query = db_session.query(Story).options(*_story_list_load_options(EagerLoadStrategy.SELECTIN, fields)) \
+        .filter_by(published=True)
+    if category_id:
+        query = query.filter(Story.categories.any(Category.id == category_id))
+    return query.order_by(Story.date_created.desc(), Story.id.desc()).yield_per(batch_size)
+
+
+def get_published_stories_by_category_id(category_id: int, eager_load: EagerLoadStrategy = None):
     """
     Gets all published stories for the given category_id.
     :param category_id: the primary key for the category to search on
-    :return: a list of stories
+    :param eager_load: the eager load strategy for the story relationships
+    :return: a list of stories ordered by date created descending
     """
-    return db_session.query(Story).filter_by(published=True).filter(
-        Story.categories.any(Category.id == category_id)).all()
+    return db_session.query(Story).options(*_story_list_load_options(eager_load)).filter_by(published=True).filter(
+        Story.categories.any(Category.id == category_id)).order_by(Story.date_created.desc(), Story.id.desc()).all()
 
 
-def get_stories_by_user_id(user_id: int):
+def get_stories_by_user_id(user_id: int, eager_load: EagerLoadStrategy = None):
     """
     Gets all stories for the given user id.
     :param user_id: the primary key for the user to search on
+    :param eager_load: the eager load strategy for the story relationships
     :return: a list of stories ordered by date last modified descending
     """
-    return db_session.query(Story).filter_by(user_id=user_id).order_by(Story.date_last_modified.desc()).all()
+    return db_session.query(Story).options(*_story_list_load_options(eager_load)).filter_by(user_id=user_id) \
+        .order_by(Story.date_last_modified.desc()).all()
 
 
-def get_story_by_id(story_id: int):
+def get_story_by_id(story_id: int, fields=None):
     """
     Gets a story by id
     :param story_id: the primary key for the story to search for
+    :param fields: the serialized fields (from Story.FIELDS) to load (or None to load the whole story)
     :return: the story or None
     """
+    query = db_session.query(Story)
+    if fields is not None:
+        query = query.options(*_story_list_load_options(EagerLoadStrategy.SELECTIN, fields))
     try:
-        return db_session.query(Story).filter_by(id=story_id).one()
+        return query.filter_by(id=story_id).one()
     except NoResultFound:
         return None
 
 
+def get_story_summary_by_id(story_id: int):
+    """
+    Gets a story by id for its page, without its text (which is read a page at a time by get_story_body), but with
+    the user, categories and upload file the page shows eager loaded.
+    :param story_id: the primary key for the story to search for
+    :return: the story or None
+    """
+    try:
+        return db_session.query(Story).options(*_story_list_load_options(EagerLoadStrategy.SELECTIN)) \
+            .filter_by(id=story_id).one()
+    except NoResultFound:
+        return None
+
+
+def get_stories_by_ids(story_ids: List, fields=Story.FIELDS):
+    """
+    Gets the stories (published or not, like get_story_by_id) with the given ids in a single query, with their
+    categories eager loaded.
+    :param story_ids: the list of primary keys of the stories to get (duplicates are ignored)
+    :param fields: the serialized fields (from Story.FIELDS) to load
+    :return: a StoryBatch with the stories in the order of the ids
+    """
+    story_ids = list(OrderedDict.fromkeys(story_ids))
+    if not story_ids:
+        return StoryBatch(stories=[], missing_ids=[])
+
+    # The date last modified is always loaded, as callers use it to version the stories
+    stories_by_id = {story.id: story for story in db_session.query(Story).options(
+        *_story_list_load_options(EagerLoadStrategy.SELECTIN, tuple(fields) + ('date_last_modified',)))
+        .filter(Story.id.in_(story_ids))}
+    return StoryBatch(stories=[stories_by_id[story_id] for story_id in story_ids if story_id in stories_by_id],
+                      missing_ids=[story_id for story_id in story_ids if story_id not in stories_by_id])
+
+
+def get_story_last_modified(story_id: int):
+    """
+    Gets the date a story was last modified without loading the story.
+    :param story_id: the primary key for the story to search for
+    :return: the date last modified or None if the story does not exist
+    """
+    return db_session.query(Story.date_last_modified).filter_by(id=story_id).scalar()
+
+
+def get_story_version(story_id: int):
+    """
+    Gets the version of a story's page without loading the story.
+    :param story_id: the primary key for the story to search for
+    :return: the StoryVersion or None if the story does not exist
+    """
+    row = db_session.query(Story.date_last_modified, UploadFile.variants.isnot(None)) \
+        .outerjoin(UploadFile, UploadFile.id == Story.upload_file_id).filter(Story.id == story_id).first()
+    return StoryVersion(*row) if row else None
+
+
 def get_story_random():
     """
-    Gets a random story
+    Gets a random published story. The story id is chosen uniformly from the in-memory published story id pool,
+    so the cost does not depend on the number of stories.
     :return: the story or None if none exist
     """
-    with db_engine.connect() as con:
-        rs = con.execute(SQL_GET_STORY_RANDOM)
-        row = rs.fetchone()
-        return get_story_by_id(story_id=row[0]) if row else None
+    for _ in range(RANDOM_STORY_MAX_ATTEMPTS):
+        story_id = _published_story_id_pool.choice()
+        if story_id is None:
+            return None
+        story = get_story_by_id(story_id=story_id)
+        if story and story.published:
+            return story
+        # The story was unpublished or deleted by another process: drop it from the pool and try again
+        _published_story_id_pool.discard(story_id)
+    return None
+
+
+# Search functions
+def _format_search_snippet(headline: str):
+    """
+    Converts a ts_headline result into safe HTML, escaping the story text and highlighting the matches with <mark>.
+    :param headline: the headline with matches wrapped in SEARCH_SNIPPET_START and SEARCH_SNIPPET_STOP
+    :return: the snippet markup
+    """
+    return Markup(str(escape(headline or '')).replace(SEARCH_SNIPPET_START, '<mark>').replace(
+        SEARCH_SNIPPET_STOP, '</mark>'))
+
+
+def search_stories(query: str, category_id: int = None, cursor: str = None, limit: int = SEARCH_PAGE_SIZE):
+    """
+    Searches the title, description and text of published stories using the GIN indexed story.search_vector,
+    ordered by rank descending. Raises ValueError if the cursor is not valid.
+    :param query: the words to search for
+    :param category_id: the primary key for the category to filter on (or None for all categories)
+    :param cursor: the cursor returned with the previous page (or None for the first page)
+    :param limit: the maximum number of results to retrieve
+    :return: a SearchPage
+    """
+    ts_query = func.plainto_tsquery(SEARCH_CONFIG, query)
+    rank = func.ts_rank_cd(Story.search_vector, ts_query)
+
+    # The story text is only needed for the snippets, which are built for the page of results below
+    search = db_session.query(Story, rank).options(*_story_list_load_options()) \
+        .filter(Story.published.is_(True), Story.search_vector.op('@@')(ts_query))
+    if category_id:
+        search = search.filter(Story.categories.any(Category.id == category_id))
+    if cursor:
+        cursor_rank, cursor_story_id = _decode_search_cursor(cursor)
+        # Compare ranks as REAL, the type ts_rank_cd returns, so a rank round trips through the cursor exactly
+        search = search.filter(tuple_(rank, Story.id) < tuple_(cast(cursor_rank, REAL), cursor_story_id))
+
+    # Fetch one extra row to find out whether there is a next page
+    rows = search.order_by(rank.desc(), Story.id.desc()).limit(limit + 1).all()
+    next_cursor = _encode_search_cursor(rows[limit - 1][1], rows[limit - 1][0].id) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    # Build snippets for the page of results only
+    snippets = {}
+    if rows:
+        headline = func.ts_headline(SEARCH_CONFIG, Story.story_text, ts_query, SEARCH_SNIPPET_OPTIONS)
+        snippets = dict(db_session.query(Story.id, headline).filter(Story.id.in_([story.id for story, _ in rows])))
+
+    results = [SearchResult(story=story, rank=story_rank, snippet=_format_search_snippet(snippets.get(story.id)))
+               for story, story_rank in rows]
+    return SearchPage(results=results, next_cursor=next_cursor)
 
 
 # Category functions
+def _load_category_snapshots():
+    """
+    Loads all categories from the DB.
+    :return: a read only mapping of category id to CategorySnapshot, ordered by label
+    """
+    categories = db_session.query(Category).order_by(Category.label.asc())
+    return MappingProxyType(OrderedDict((category.id, CategorySnapshot.from_category(category))
+                                        for category in categories))
+
+
+def _get_category_snapshots():
+    """
+    Gets all categories from the category cache, loading them from the DB if they are not cached.
+    :return: a read only mapping of category id to CategorySnapshot, ordered by label
+    """
+    return _category_cache.get_or_load(CATEGORY_CACHE_KEY_ALL, _load_category_snapshots)
+
+
+def get_category_cache_stats():
+    """
+    Gets the hit and miss counters of the category cache.
+    :return: a dict of hits, misses and size
+    """
+    return _category_cache.stats()
+
+
 def create_category(category: Category):
     """
     Creates the given category in the DB.
@@ -213,39 +1068,65 @@ def create_category(category: Category):
     """
     db_session.add(category)
     db_session.commit()
+    _category_cache.invalidate()
     return category.id
 
 
 def get_categories():
     """
     Gets all active categories.
-    :return: a list of categories
+    :return: a list of category snapshots ordered by label
     """
-    return db_session.query(Category).order_by(Category.label.asc()).all()
+    return list(_get_category_snapshots().values())
+
+
+def get_categories_with_counts():
+    """
+    Gets all categories with the number of published stories in each, in one query of the story_count summary table.
+    :return: a list of CategoryWithCount ordered by category label
+    """
+    rows = db_session.query(Category, func.coalesce(StoryCount.published_count, 0)) \
+        .outerjoin(StoryCount, and_(StoryCount.scope == StoryCountScope.CATEGORY.value,
+                                    StoryCount.scope_id == Category.id)) \
+        .order_by(Category.label.asc())
+    return [CategoryWithCount(category=CategorySnapshot.from_category(category), published_count=published_count)
+            for category, published_count in rows]
+
+
+def iter_categories(batch_size: int = STREAM_BATCH_SIZE):
+    """
+    Iterates over all categories ordered by label, fetching rows through a server side cursor batch_size at a time.
+    :param batch_size: the number of categories to fetch from the DB at a time
+    :return: an iterator of categories
+    """
+    return db_session.query(Category).order_by(Category.label.asc()).yield_per(batch_size)
 
 
 def get_category_by_id(category_id: int):
     """
     Gets a category by id
     :param category_id: the primary key for the category to search for
-    :return: the category or None
+    :return: the category snapshot or None
     """
-    try:
-        return db_session.query(Category).filter_by(id=category_id).one()
-    except NoResultFound:
-        return None
+    return _get_category_snapshots().get(category_id)
 
 
 def get_categories_by_ids(category_ids: List):
     """
-    Gets a list of categories by their ids
+    Gets a list of categories by their ids, attached to the current session so they can be assigned to a story.
+    The categories are built from the category cache rather than queried from the DB.
     :param category_ids: the list of category ids
     :return: a list of categories
     """
-    try:
-        return db_session.query(Category).filter(Category.id.in_(category_ids)).all()
-    except NoResultFound:
-        return None
+    snapshots = _get_category_snapshots()
+    categories = []
+    for category_id in category_ids:
+        snapshot = snapshots.get(category_id)
+        if snapshot:
+            category = Category(id=snapshot.id, label=snapshot.label, description=snapshot.description)
+            make_transient_to_detached(category)
+            categories.append(db_session.merge(category, load=False))
+    return categories
 
 
 def get_category_by_label(category_label: str):
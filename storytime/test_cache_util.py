@@ -0,0 +1,70 @@
+#
+# Story Time App
+# Unit tests for the cache helpers
+#
+
+from storytime.cache_util import LRUCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_max_bytes_eviction():
+    cache = LRUCache(max_bytes=10)
+    cache.put('a', 'x' * 4)
+    cache.put('b', 'x' * 4)
+    cache.put('c', 'x' * 4)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 8
+    cache.put('d', 'x' * 11)
+    assert cache.get('d') is None
+    assert cache.get('c') == 'xxxx'
+
+
+def test_invalidate_where():
+    cache = LRUCache()
+    cache.put(('story', 1), 'one')
+    cache.put(('story', 2), 'two')
+    cache.invalidate_where(lambda key: key[1] == 1)
+    assert cache.get(('story', 1)) is None
+    assert cache.get(('story', 2)) == 'two'
+
+
+def test_ttl_expiry():
+    timer = FakeTimer()
+    cache = LRUCache(ttl=10, timer=timer)
+    cache.put('a', 1)
+    timer.now = 9
+    assert cache.get('a') == 1
+    timer.now = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_get_or_load_and_stats():
+    cache = LRUCache()
+    loads = []
+    for _ in range(3):
+        assert cache.get_or_load('a', lambda: loads.append(1) or 'value') == 'value'
+    assert len(loads) == 1
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 0, 'size': 1, 'bytes': 0}
+
+    cache.invalidate()
+    assert cache.get_or_load('a', lambda: 'reloaded') == 'reloaded'
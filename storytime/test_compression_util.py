@@ -0,0 +1,55 @@
+#
+# Story Time App
+# Unit tests for the compression helpers
+#
+
+import gzip
+import zlib
+
+import pytest
+
+from storytime.compression_util import ENCODING_BROTLI, ENCODING_GZIP, choose_encoding, compress, compress_chunks, \
+    parse_accept_encoding
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding('gzip, deflate;q=0.5, BR;q=0, *;q=bad') == \
+        {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0, '*': 0.0}
+    assert parse_accept_encoding(None) == {}
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    (None, None),
+    ('identity', None),
+    ('gzip', ENCODING_GZIP),
+    ('gzip, br', ENCODING_BROTLI),
+    ('gzip;q=1, br;q=0.5', ENCODING_GZIP),
+    ('br;q=0, *', ENCODING_GZIP),
+    ('*;q=0', None),
+])
+def test_choose_encoding(accept_encoding, expected):
+    assert choose_encoding(accept_encoding, encodings=(ENCODING_BROTLI, ENCODING_GZIP)) == expected
+
+
+def test_compress_gzip():
+    data = b'story time ' * 1000
+    compressed = compress(data, ENCODING_GZIP)
+    assert len(compressed) < len(data)
+    assert gzip.decompress(compressed) == data
+
+
+def test_compress_chunks_gzip():
+    chunks = [b'story time ' * 100, b'', b'the end']
+    compressed = list(compress_chunks(iter(chunks), ENCODING_GZIP))
+    assert gzip.decompress(b''.join(compressed)) == b''.join(chunks)
+
+    # Each chunk is flushed, so it can be decoded before the stream ends
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(compressed[0]) == chunks[0]
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compress(b'data', 'deflate')
+    with pytest.raises(ValueError):
+        compress_chunks(iter([b'data']), 'deflate')
@@ -0,0 +1,162 @@
+#
+# Story Time App
+# Unit tests for the file storage functions
+#
+
+import hashlib
+import os
+
+import pytest
+from PIL import Image
+from flask_uploads import UploadConfiguration
+from werkzeug.exceptions import NotFound
+
+from storytime import file_storage_service
+from storytime.app import app
+from storytime.story_time_db_init import UploadFile
+
+BASE_URL = '/uploads/'
+
+
+def save_image(upload_dir: str, filename: str, width: int, height: int, image_format: str):
+    Image.new('RGB', (width, height), color=(200, 100, 50)).save(os.path.join(upload_dir, filename), image_format)
+    return filename
+
+
+def test_save_image_variants(tmpdir):
+    upload_dir = str(tmpdir)
+    filename = save_image(upload_dir, 'photo.jpg', 1000, 500, 'JPEG')
+    variants = file_storage_service.save_image_variants(filename=filename, url=BASE_URL + filename,
+                                                        upload_dir=upload_dir)
+
+    assert set(variants) == set(file_storage_service.IMAGE_VARIANTS)
+    for name, width in file_storage_service.IMAGE_VARIANTS.items():
+        variant = variants[name]
+        assert variant['filename'] == 'photo_{}.jpg'.format(name)
+        assert variant['url'] == BASE_URL + variant['filename']
+        assert variant['width'] == width
+        with Image.open(os.path.join(upload_dir, variant['filename'])) as image:
+            assert image.size == (width, width // 2)
+
+
+def test_save_image_variants_does_not_upscale(tmpdir):
+    upload_dir = str(tmpdir)
+    filename = save_image(upload_dir, 'photo.png', 380, 190, 'PNG')
+    variants = file_storage_service.save_image_variants(filename=filename, url=BASE_URL + filename,
+                                                        upload_dir=upload_dir)
+
+    # Only the variants narrower than the original are created; the others are the original
+    assert variants['card'] == {'filename': 'photo_card.png', 'url': BASE_URL + 'photo_card.png', 'width': 350}
+    assert variants['detail'] == {'filename': filename, 'url': BASE_URL + filename, 'width': 380}
+    assert variants['retina'] == {'filename': filename, 'url': BASE_URL + filename, 'width': 380}
+    assert sorted(os.listdir(upload_dir)) == ['photo.png', 'photo_card.png']
+
+
+def test_srcset_is_ordered_by_width():
+    upload_file = UploadFile(filename='photo.png', url=BASE_URL + 'photo.png', variants={
+        'retina': {'filename': 'photo.png', 'url': BASE_URL + 'photo.png', 'width': 380},
+        'card': {'filename': 'photo_card.png', 'url': BASE_URL + 'photo_card.png', 'width': 350},
+        'detail': {'filename': 'photo.png', 'url': BASE_URL + 'photo.png', 'width': 380}
+    })
+    assert upload_file.srcset == '/uploads/photo_card.png 350w, /uploads/photo.png 380w'
+    assert upload_file.get_variant_url('card') == BASE_URL + 'photo_card.png'
+    assert upload_file.get_variant_url('unknown') == BASE_URL + 'photo.png'
+
+
+def test_variants_fall_back_to_original():
+    upload_file = UploadFile(filename='photo.jpg', url=BASE_URL + 'photo.jpg', variants=None)
+    assert upload_file.srcset is None
+    for name in file_storage_service.IMAGE_VARIANTS:
+        assert upload_file.get_variant_url(name) == BASE_URL + 'photo.jpg'
+
+
+@pytest.fixture
+def upload_dir(tmpdir, monkeypatch):
+    """
+    Stores uploads in a temporary directory, within a request context.
+    """
+    upload_dir = str(tmpdir.mkdir('upload'))
+    monkeypatch.setitem(app.upload_set_config, 'photos', UploadConfiguration(upload_dir, base_url=BASE_URL))
+    with app.test_request_context():
+        yield upload_dir
+
+
+def write_file(upload_dir: str, filename: str, content: bytes = b'content'):
+    file_path = os.path.join(upload_dir, filename)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(content)
+    return file_path
+
+
+def test_get_shard_path():
+    digest = hashlib.sha1(b'photo.jpg').hexdigest()
+    assert file_storage_service.get_shard_path('photo.jpg') == '{}/{}/photo.jpg'.format(digest[0:2], digest[2:4])
+
+
+def test_shard_stored_file(upload_dir):
+    write_file(upload_dir, 'photo.jpg')
+    write_file(upload_dir, 'photo_card.jpg')
+    variants = {
+        'card': {'filename': 'photo_card.jpg', 'url': BASE_URL + 'photo_card.jpg', 'width': 350},
+        'detail': {'filename': 'photo.jpg', 'url': BASE_URL + 'photo.jpg', 'width': 380}
+    }
+    filename, sharded_variants = file_storage_service.shard_stored_file('photo.jpg', variants)
+
+    card_filename = file_storage_service.get_shard_path('photo_card.jpg')
+    assert filename == file_storage_service.get_shard_path('photo.jpg')
+    assert sharded_variants == {
+        'card': {'filename': card_filename, 'url': BASE_URL + card_filename, 'width': 350},
+        'detail': {'filename': filename, 'url': BASE_URL + filename, 'width': 380}
+    }
+    for old_filename, new_filename in (('photo.jpg', filename), ('photo_card.jpg', card_filename)):
+        assert not os.path.exists(os.path.join(upload_dir, old_filename))
+        assert os.path.isfile(os.path.join(upload_dir, new_filename))
+
+    # Files that have already been moved are skipped
+    assert file_storage_service.shard_stored_file('photo.jpg', variants) == (filename, sharded_variants)
+    assert os.path.isfile(os.path.join(upload_dir, filename))
+
+
+def test_make_upload_response_flask(upload_dir, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_SERVE_MODE', file_storage_service.UploadServeMode.FLASK.value)
+    filename = file_storage_service.get_shard_path('photo.jpg')
+    write_file(upload_dir, filename, b'jpeg')
+
+    response = file_storage_service.make_upload_response(filename)
+    response.direct_passthrough = False
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.get_data() == b'jpeg'
+    assert response.headers['Cache-Control'] == file_storage_service.UPLOAD_CACHE_CONTROL
+
+
+def test_make_upload_response_x_sendfile(upload_dir, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_SERVE_MODE', file_storage_service.UploadServeMode.X_SENDFILE.value)
+    filename = file_storage_service.get_shard_path('photo.jpg')
+    file_path = write_file(upload_dir, filename)
+
+    response = file_storage_service.make_upload_response(filename)
+    assert response.mimetype == 'image/jpeg'
+    assert response.headers['X-Sendfile'] == file_path
+    assert response.get_data() == b''
+    assert response.headers['Cache-Control'] == file_storage_service.UPLOAD_CACHE_CONTROL
+
+
+def test_make_upload_response_x_accel_redirect(upload_dir, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_SERVE_MODE', file_storage_service.UploadServeMode.X_ACCEL_REDIRECT.value)
+    filename = file_storage_service.get_shard_path('photo.png')
+    write_file(upload_dir, filename)
+
+    response = file_storage_service.make_upload_response(filename)
+    assert response.mimetype == 'image/png'
+    assert response.headers['X-Accel-Redirect'] == app.config['UPLOAD_X_ACCEL_REDIRECT_PREFIX'] + filename
+    assert response.get_data() == b''
+
+
+@pytest.mark.parametrize('filename', ['missing.jpg', '../secret.jpg', 'ab/../../secret.jpg', '/etc/passwd'])
+def test_make_upload_response_not_found(upload_dir, filename):
+    # A file outside the upload directory is not served, even if it exists
+    write_file(os.path.dirname(upload_dir), 'secret.jpg')
+    with pytest.raises(NotFound):
+        file_storage_service.make_upload_response(filename)
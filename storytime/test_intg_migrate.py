@@ -0,0 +1,49 @@
+#
+# Story Time App
+# Integration tests for the schema migrations: the baseline schema plus the migrations must build the schema the
+# app uses. They run in a schema of their own, so the tables of the app's DB are left untouched.
+#
+
+import pytest
+
+from db import migrate
+from storytime.story_time_db_init import Base, db_engine
+
+TEST_SCHEMA = 'storytime_migrate_test'
+
+
+@pytest.fixture
+def empty_schema_connection():
+    """
+    A DB-API connection whose search path is an empty schema, dropped when the test finishes.
+    """
+    connection = db_engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}'.format(TEST_SCHEMA))
+    connection.commit()
+    try:
+        yield connection
+    finally:
+        connection.rollback()
+        cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE; SET search_path TO DEFAULT'.format(TEST_SCHEMA))
+        connection.commit()
+        connection.close()
+
+
+def test_migrations_build_the_app_schema(empty_schema_connection):
+    cursor = empty_schema_connection.cursor()
+    with open(migrate.CREATE_SCHEMA_FILE, 'r') as schema_file:
+        cursor.execute(schema_file.read())
+    empty_schema_connection.commit()
+
+    applied = migrate.apply_migrations(empty_schema_connection)
+    assert applied == [version for version, file_path in migrate.get_migrations()]
+    assert migrate.apply_migrations(empty_schema_connection) == []
+
+    # Every table and column the app maps was created by the baseline schema or a migration
+    cursor.execute('SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = %s',
+                   (TEST_SCHEMA,))
+    columns = set(cursor.fetchall())
+    missing = [(table.name, column.name) for table in Base.metadata.tables.values() for column in table.columns
+               if (table.name, column.name) not in columns]
+    assert missing == []
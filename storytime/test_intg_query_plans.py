@@ -0,0 +1,97 @@
+#
+# Story Time App
+# Integration tests that check the query plans of the story_time_service queries.
+# These need a large seeded dataset: on small tables a sequential scan is the best plan, so the tests are skipped.
+#
+
+import json
+
+import pytest
+from sqlalchemy import event
+
+from storytime import story_time_service
+from storytime.story_time_db_init import Story, db_engine, db_session
+
+# The minimum number of stories for the plans to be representative of production
+MIN_STORIES = 100000
+
+# Tables that must never be read with a sequential scan by the service queries
+INDEXED_TABLES = {'story', 'story_category', 'upload_file'}
+
+pytestmark = pytest.mark.skipif(db_session.query(Story).count() < MIN_STORIES,
+                                reason='requires a dataset of at least {} stories'.format(MIN_STORIES))
+
+
+def capture_statements(func):
+    """
+    Calls the given function and records the SQL statements it executes.
+    :return: a list of (statement, parameters) tuples
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    db_session.expunge_all()
+    event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(db_engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def get_plan_nodes(plan: dict):
+    """
+    Gets all nodes in an EXPLAIN (FORMAT JSON) plan tree.
+    """
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from get_plan_nodes(child)
+
+
+def get_sequential_scans(statement: str, parameters):
+    """
+    Gets the tables in INDEXED_TABLES that the plan for the given statement reads with a sequential scan.
+    """
+    cursor = db_session.connection().connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return [node['Relation Name'] for node in get_plan_nodes(plan[0]['Plan'])
+            if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in INDEXED_TABLES]
+
+
+def get_service_calls():
+    story = story_time_service.get_published_stories(count=1)[0]
+    category = story.categories[0]
+    first_page = story_time_service.get_published_stories_page()
+    return [
+        ('get_published_stories_page', lambda: story_time_service.get_published_stories_page()),
+        ('get_published_stories_page cursor',
+         lambda: story_time_service.get_published_stories_page(cursor=first_page.next_cursor)),
+        ('get_published_stories_page category',
+         lambda: story_time_service.get_published_stories_page(category_id=category.id)),
+        ('get_published_stories_count', lambda: story_time_service.get_published_stories_count()),
+        ('get_published_stories_version',
+         lambda: story_time_service.get_published_stories_version(category_id=category.id)),
+        ('get_stories_by_user_id', lambda: story_time_service.get_stories_by_user_id(story.user_id)),
+        ('get_story_by_id', lambda: story_time_service.get_story_by_id(story.id)),
+        ('get_story_last_modified', lambda: story_time_service.get_story_last_modified(story.id)),
+        ('get_story_version', lambda: story_time_service.get_story_version(story.id)),
+        ('get_stories_by_ids', lambda: story_time_service.get_stories_by_ids([story.id, first_page.stories[-1].id])),
+        ('get_story_text_page', lambda: story_time_service.get_story_text_page(story.id, offset=1, limit=10)),
+        ('search_stories', lambda: story_time_service.search_stories(story.title)),
+        ('search_stories category', lambda: story_time_service.search_stories(story.title, category_id=category.id)),
+    ]
+
+
+def test_service_queries_use_indexes():
+    failures = []
+    for name, call in get_service_calls():
+        for statement, parameters in capture_statements(call):
+            tables = get_sequential_scans(statement, parameters)
+            if tables:
+                failures.append('{}: sequential scan on {}\n{}'.format(name, ', '.join(tables), statement))
+    assert not failures, '\n\n'.join(failures)
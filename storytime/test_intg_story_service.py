@@ -3,7 +3,41 @@
 # Integration tests for the story_time_service functions
 #
 
+import io
+import os
+from contextlib import contextmanager
+
+import pytest
+from PIL import Image
+from flask_uploads import UploadConfiguration
+from markupsafe import escape
+from sqlalchemy import event, inspect
+from werkzeug.datastructures import FileStorage
+
 from storytime import story_time_service
+from storytime.app import app
+from storytime.story_time_db_init import Category, Story, UploadFile, db_engine, db_session
+from storytime.story_time_service import EagerLoadStrategy
+
+# The most queries listing stories may take: the stories plus one per eager loaded relationship
+MAX_STORY_LIST_QUERIES = 4
+
+
+@contextmanager
+def count_queries():
+    """
+    Context manager that records the SQL statements executed against the DB engine while it is active.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db_engine, 'before_cursor_execute', before_cursor_execute)
 
 
 def test_get_stories_by_category_id():
@@ -12,3 +46,270 @@ def test_get_stories_by_category_id():
     assert stories.count() == 2
     assert any(story.title == 'Fresh Prince' for story in stories)
     assert any(story.title == 'Animal Escape' for story in stories)
+
+
+def test_get_published_stories_page():
+    stories = story_time_service.get_published_stories(count=2)
+    first_page = story_time_service.get_published_stories_page(limit=1)
+    second_page = story_time_service.get_published_stories_page(cursor=first_page.next_cursor, limit=1)
+    assert [story.id for story in first_page.stories + second_page.stories] == [story.id for story in stories]
+
+
+def test_get_published_stories_page_invalid_cursor():
+    with pytest.raises(ValueError):
+        story_time_service.get_published_stories_page(cursor='not-a-cursor')
+
+
+@pytest.mark.parametrize('eager_load', list(EagerLoadStrategy))
+@pytest.mark.parametrize('limit', [1, 5, 12])
+def test_get_published_stories_page_query_count_is_constant(eager_load, limit):
+    db_session.expunge_all()
+    with count_queries() as statements:
+        page = story_time_service.get_published_stories_page(limit=limit, eager_load=eager_load)
+        for story in page.stories:
+            assert story.serialize_fields([field for field in Story.FIELDS if field != 'story_text'])
+            assert story.user.name
+            assert story.upload_file is None or story.upload_file.url
+    assert len(statements) <= MAX_STORY_LIST_QUERIES
+
+
+def test_get_published_stories_page_loads_only_requested_fields():
+    db_session.expunge_all()
+    page = story_time_service.get_published_stories_page(limit=5, fields=('id', 'title'))
+    assert page.stories
+    for story in page.stories:
+        assert {'story_text', 'description', 'categories'} <= inspect(story).unloaded
+    with count_queries() as statements:
+        assert [story.serialize_fields(('id', 'title')) for story in page.stories]
+    assert len(statements) == 0
+
+
+def test_get_stories_by_ids():
+    story_ids = [story.id for story in story_time_service.get_published_stories(count=3)]
+    db_session.expunge_all()
+    with count_queries() as statements:
+        batch = story_time_service.get_stories_by_ids(list(reversed(story_ids)) + [-1, story_ids[0]])
+        for story in batch.stories:
+            assert story.serialize
+    assert [story.id for story in batch.stories] == list(reversed(story_ids))
+    assert batch.missing_ids == [-1]
+    assert len(statements) <= 2
+
+
+def test_get_story_summary_by_id():
+    story_id = story_time_service.get_published_stories(count=1)[0].id
+    db_session.expunge_all()
+    with count_queries() as statements:
+        story = story_time_service.get_story_summary_by_id(story_id)
+        assert story.title and story.description and story.date_created
+        assert story.user.name
+        assert all(category.label for category in story.categories)
+        assert story.upload_file is None or story.upload_file.url
+    assert 'story_text' in inspect(story).unloaded
+    assert len(statements) <= MAX_STORY_LIST_QUERIES
+    assert story_time_service.get_story_summary_by_id(-1) is None
+
+
+def test_get_published_stories_count_matches_stories():
+    published_stories = db_session.query(Story).filter_by(published=True)
+    assert story_time_service.get_published_stories_count() == published_stories.count()
+
+    category_funny = story_time_service.get_category_by_label('Funny')
+    assert story_time_service.get_published_stories_count(category_id=category_funny.id) == len(
+        story_time_service.get_published_stories_by_category_id(category_funny.id))
+
+
+def assert_story_counts_match_stories(user_id: int, category_ids):
+    """
+    Checks the story_count rows for all stories, the given user and categories against COUNT(*) of the stories.
+    """
+    published_stories = db_session.query(Story).filter(Story.published.is_(True))
+    assert story_time_service.get_published_stories_count() == published_stories.count()
+    assert story_time_service.get_published_stories_count(user_id=user_id) == \
+        published_stories.filter(Story.user_id == user_id).count()
+    for category_id in category_ids:
+        assert story_time_service.get_published_stories_count(category_id=category_id) == \
+            published_stories.filter(Story.categories.any(Category.id == category_id)).count()
+
+
+def test_story_counts_are_maintained_on_write():
+    user_id = story_time_service.get_published_stories(count=1)[0].user_id
+    category_ids = [category.id for category in story_time_service.get_categories()[:2]]
+    assert len(category_ids) == 2
+
+    # Create a draft
+    story = Story(title='Count Test', description='Counting', story_text='One\nTwo', published=False, user_id=user_id,
+                  categories=story_time_service.get_categories_by_ids(category_ids[:1]))
+    story_id = story_time_service.create_story(story)
+    assert_story_counts_match_stories(user_id, category_ids)
+
+    # Publish it
+    story = story_time_service.get_story_by_id(story_id)
+    story.published = True
+    story_time_service.update_story(story, remove_existing_image=False, new_image_file=None)
+    assert_story_counts_match_stories(user_id, category_ids)
+
+    # Move it to the other category
+    story = story_time_service.get_story_by_id(story_id)
+    story.categories = story_time_service.get_categories_by_ids(category_ids[1:])
+    story_time_service.update_story(story, remove_existing_image=False, new_image_file=None)
+    assert_story_counts_match_stories(user_id, category_ids)
+
+    # Unpublish it, then publish it again
+    story = story_time_service.get_story_by_id(story_id)
+    story.published = False
+    story_time_service.update_story(story, remove_existing_image=False, new_image_file=None)
+    assert_story_counts_match_stories(user_id, category_ids)
+    story = story_time_service.get_story_by_id(story_id)
+    story.published = True
+    story_time_service.update_story(story, remove_existing_image=False, new_image_file=None)
+    assert_story_counts_match_stories(user_id, category_ids)
+
+    # Delete it
+    story_time_service.delete_story(story_id)
+    assert_story_counts_match_stories(user_id, category_ids)
+
+
+def test_published_stories_version_changes_on_update():
+    story = next(story for story in story_time_service.get_published_stories() if story.categories)
+    category_id = story.categories[0].id
+    versions_before = [story_time_service.get_published_stories_version(),
+                       story_time_service.get_published_stories_version(category_id=category_id)]
+
+    with count_queries() as statements:
+        story_time_service.get_published_stories_version(category_id=category_id)
+    assert len(statements) == 1
+
+    story = story_time_service.get_story_by_id(story.id)
+    story.description = story.description + ' '
+    story_time_service.update_story(story, remove_existing_image=False, new_image_file=None)
+    versions_after = [story_time_service.get_published_stories_version(),
+                      story_time_service.get_published_stories_version(category_id=category_id)]
+    for (last_modified_before, count_before), (last_modified_after, count_after) in zip(versions_before,
+                                                                                        versions_after):
+        assert last_modified_after > last_modified_before
+        assert count_after == count_before
+
+
+def test_get_categories_with_counts():
+    with count_queries() as statements:
+        categories = story_time_service.get_categories_with_counts()
+    assert len(statements) == 1
+    assert [result.category.label for result in categories] == \
+        [category.label for category in story_time_service.get_categories()]
+    for result in categories:
+        assert result.published_count == story_time_service.get_published_stories_count(category_id=result.category.id)
+
+
+def test_search_stories():
+    page = story_time_service.search_stories('Fresh Prince')
+    assert any(result.story.title == 'Fresh Prince' for result in page.results)
+    assert all(result.story.published for result in page.results)
+    assert [result.rank for result in page.results] == sorted((result.rank for result in page.results), reverse=True)
+
+
+def test_get_story_body():
+    story = story_time_service.get_published_stories(count=1)[0]
+    story_time_service.reset_caches()
+    story_body = story_time_service.get_story_body(story)
+    paragraphs = story.story_text.splitlines()[:story_time_service.STORY_TEXT_PAGE_SIZE]
+    assert story_body.html == ''.join('<p class="text-left">{}</p>'.format(escape(paragraph))
+                                      for paragraph in paragraphs)
+
+    # The second render of an unchanged story is served from the cache
+    with count_queries() as statements:
+        assert story_time_service.get_story_body(story) == story_body
+    assert len(statements) == 0
+
+
+def test_get_story_text_page():
+    story = story_time_service.get_published_stories(count=1)[0]
+    paragraphs = story.story_text.splitlines()
+    first_page = story_time_service.get_story_text_page(story.id, offset=0, limit=1)
+    assert first_page.paragraphs == paragraphs[:1]
+    assert first_page.total == len(paragraphs)
+    assert first_page.next_offset == (1 if len(paragraphs) > 1 else None)
+
+    last_page = story_time_service.get_story_text_page(story.id, offset=len(paragraphs) - 1, limit=10)
+    assert last_page.paragraphs == paragraphs[-1:]
+    assert last_page.next_offset is None
+
+    assert story_time_service.get_story_text_page(-1) is None
+    with pytest.raises(ValueError):
+        story_time_service.get_story_text_page(story.id, offset=-1)
+
+
+@pytest.fixture
+def upload_dir(tmpdir, monkeypatch):
+    """
+    Stores uploads in a temporary directory, without creating image variants, within a request context.
+    """
+    config = app.upload_set_config['photos']
+    monkeypatch.setitem(app.upload_set_config, 'photos', UploadConfiguration(str(tmpdir), base_url=config.base_url))
+    monkeypatch.setattr(story_time_service, '_submit_image_variants', lambda upload_file_id, story_id: False)
+    with app.test_request_context():
+        yield str(tmpdir)
+
+
+def make_image_file(color: tuple):
+    stream = io.BytesIO()
+    Image.new('RGB', (20, 10), color=color).save(stream, 'PNG')
+    stream.seek(0)
+    return FileStorage(stream=stream, filename='photo.png')
+
+
+def get_upload_file(upload_file_id: int):
+    db_session.expire_all()
+    return db_session.query(UploadFile).get(upload_file_id)
+
+
+def test_identical_uploads_share_an_upload_file(upload_dir):
+    user_id = story_time_service.get_published_stories(count=1)[0].user_id
+    story_ids = [story_time_service.create_story(
+        Story(title='Upload Test', description='Uploads', story_text='Text', published=False, user_id=user_id),
+        image_file=make_image_file((10, 20, 30))) for _ in range(2)]
+    stories = [story_time_service.get_story_by_id(story_id) for story_id in story_ids]
+    upload_file_id = stories[0].upload_file_id
+    assert stories[1].upload_file_id == upload_file_id
+    upload_file = get_upload_file(upload_file_id)
+    assert upload_file.ref_count == 2
+    file_path = os.path.join(upload_dir, upload_file.filename)
+    assert os.path.isfile(file_path)
+
+    # Deleting one of the stories removes its reference but keeps the file
+    story_time_service.delete_story(story_ids[0])
+    assert get_upload_file(upload_file_id).ref_count == 1
+    assert os.path.isfile(file_path)
+
+    # Replacing the image of the last story using the file deletes it
+    story = story_time_service.get_story_by_id(story_ids[1])
+    story_time_service.update_story(story, remove_existing_image=True, new_image_file=make_image_file((40, 50, 60)))
+    assert get_upload_file(upload_file_id) is None
+    assert not os.path.exists(file_path)
+
+    new_upload_file = story_time_service.get_story_by_id(story_ids[1]).upload_file
+    assert new_upload_file.ref_count == 1
+    new_file_path = os.path.join(upload_dir, new_upload_file.filename)
+    assert os.path.isfile(new_file_path)
+
+    story_time_service.delete_story(story_ids[1])
+    assert not os.path.exists(new_file_path)
+
+
+def test_story_version_changes_when_image_variants_are_created(upload_dir):
+    user_id = story_time_service.get_published_stories(count=1)[0].user_id
+    story_id = story_time_service.create_story(
+        Story(title='Variant Test', description='Variants', story_text='Text', published=False, user_id=user_id),
+        image_file=make_image_file((70, 80, 90)))
+    version = story_time_service.get_story_version(story_id)
+    assert not version.has_image_variants
+
+    upload_file_id = story_time_service.get_story_by_id(story_id).upload_file_id
+    story_time_service.create_image_variants(upload_file_id=upload_file_id, upload_dir=upload_dir, story_id=story_id)
+    new_version = story_time_service.get_story_version(story_id)
+    assert new_version.has_image_variants
+    assert new_version.date_last_modified == version.date_last_modified
+    assert new_version != version
+
+    story_time_service.delete_story(story_id)
+    assert story_time_service.get_story_version(story_id) is None
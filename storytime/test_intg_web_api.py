@@ -0,0 +1,167 @@
+#
+# Story Time App
+# Integration tests for the web JSON API
+#
+
+import gzip
+import html
+import json
+import re
+
+import pytest
+
+from storytime.app import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.mark.parametrize('url', ['/api/stories', '/api/stories?limit=1'])
+def test_api_stories_conditional_get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+
+    not_modified = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+
+
+def test_api_story_conditional_get(client):
+    story_id = json.loads(client.get('/api/stories?limit=1').data.decode('utf-8'))['Stories'][0]['id']
+    response = client.get('/api/stories/{}'.format(story_id))
+    assert response.status_code == 200
+
+    not_modified = client.get('/api/stories/{}'.format(story_id),
+                              headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert not_modified.status_code == 304
+
+
+def get_published_story_id(client):
+    return json.loads(client.get('/api/stories?limit=1').data.decode('utf-8'))['Stories'][0]['id']
+
+
+def test_view_story_conditional_get(client):
+    url = '/stories/{}'.format(get_published_story_id(client))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+
+    not_modified = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+
+
+def test_view_story_with_flashed_message_has_no_etag(client):
+    url = '/stories/{}'.format(get_published_story_id(client))
+    etag = client.get(url).headers['ETag']
+    with client.session_transaction() as session:
+        session['_flashes'] = [('success', 'Story Updated Successfully!')]
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Story Updated Successfully!' in response.data
+    assert 'ETag' not in response.headers
+    assert response.cache_control.no_store
+
+
+def test_view_story_cards(client):
+    cards = client.get('/stories/cards')
+    assert cards.status_code == 200
+    assert b'class="card ' in cards.data
+    assert b'<html' not in cards.data
+
+    # The index links to the same next page of cards the fragment does (if there is one)
+    more_urls = re.findall(r'data-cards-url="([^"]+)"', cards.data.decode('utf-8'))
+    assert more_urls == re.findall(r'data-cards-url="([^"]+)"', client.get('/').data.decode('utf-8'))
+    for more_url in more_urls:
+        assert client.get(html.unescape(more_url)).status_code == 200
+
+    assert client.get('/stories/cards?cursor=not-a-cursor').status_code == 400
+
+
+def test_api_stories_stream_json(client):
+    stories = json.loads(client.get('/api/stories?limit=100').data.decode('utf-8'))['Stories']
+    response = client.get('/api/stories?stream=json')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.data.decode('utf-8'))['Stories'][:len(stories)] == stories
+
+
+def test_api_stories_stream_ndjson(client):
+    response = client.get('/api/stories?stream=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf-8').splitlines()
+    assert lines
+    for line in lines:
+        story = json.loads(line)
+        assert isinstance(story, dict)
+        assert story['id'] and story['title']
+
+
+def test_api_stories_stream_unknown_format(client):
+    assert client.get('/api/stories?stream=xml').status_code == 400
+
+
+def test_api_stories_fields(client):
+    stories = json.loads(client.get('/api/stories?limit=2').data.decode('utf-8'))['Stories']
+    assert stories
+    assert all('story_text' not in story and 'title' in story for story in stories)
+
+    stories = json.loads(client.get('/api/stories?limit=2&fields=id,title').data.decode('utf-8'))['Stories']
+    assert all(set(story) == {'id', 'title'} for story in stories)
+
+    story = json.loads(client.get('/api/stories/{}?fields=story_text'.format(stories[0]['id'])).data.decode(
+        'utf-8'))['Story']
+    assert set(story) == {'story_text'}
+
+    assert client.get('/api/stories?fields=id,password').status_code == 400
+
+
+def test_api_story_text(client):
+    story_id = json.loads(client.get('/api/stories?limit=1').data.decode('utf-8'))['Stories'][0]['id']
+    story_text = json.loads(client.get('/api/stories/{}'.format(story_id)).data.decode('utf-8'))['Story']['story_text']
+    page = json.loads(client.get('/api/stories/{}/text?limit=1'.format(story_id)).data.decode('utf-8'))
+    assert page['Paragraphs'] == story_text.splitlines()[:1]
+    assert page['Offset'] == 0
+    assert page['Total'] == len(story_text.splitlines())
+
+    assert client.get('/api/stories/{}/text?offset=-1'.format(story_id)).status_code == 400
+    assert client.get('/api/stories/0/text').status_code == 404
+
+
+def test_api_stories_by_ids(client):
+    stories = json.loads(client.get('/api/stories?limit=2').data.decode('utf-8'))['Stories']
+    story_ids = [story['id'] for story in stories]
+    response = client.get('/api/stories?ids={},0,{}&fields=id,title'.format(story_ids[1], story_ids[0]))
+    assert response.status_code == 200
+    result = json.loads(response.data.decode('utf-8'))
+    assert [story['id'] for story in result['Stories']] == [story_ids[1], story_ids[0]]
+    assert result['MissingIds'] == [0]
+
+    assert client.get('/api/stories?ids=1,a').status_code == 400
+    assert client.get('/api/stories?ids=1&limit=1').status_code == 400
+    assert client.get('/api/stories?ids=' + ','.join(str(i) for i in range(1000))).status_code == 400
+
+
+def test_api_categories_with_counts(client):
+    categories = json.loads(client.get('/api/categories?counts=true').data.decode('utf-8'))['Categories']
+    assert categories
+    assert all(category['published_count'] >= 0 for category in categories)
+
+    assert client.get('/api/categories?counts=maybe').status_code == 400
+
+
+def test_api_stories_compressed(client):
+    url = '/api/stories?fields=id,title,description,story_text'
+    plain = client.get(url)
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers['ETag'] == 'W/' + plain.headers['ETag']
+
+    not_modified = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
@@ -0,0 +1,75 @@
+#
+# Story Time App
+# Unit tests for the JobQueue
+#
+
+import json
+
+from storytime.job_queue import JobQueue
+
+
+class FlakyJob:
+    def __init__(self, failures: int, exc_type=RuntimeError):
+        self.failures = failures
+        self.exc_type = exc_type
+        self.calls = []
+
+    def __call__(self, value):
+        self.calls.append(value)
+        if len(self.calls) <= self.failures:
+            raise self.exc_type('failure {}'.format(len(self.calls)))
+
+
+def test_job_runs():
+    queue = JobQueue('test')
+    job = FlakyJob(failures=0)
+    assert queue.submit(job, 'a')
+    assert queue.join(timeout=5)
+    assert job.calls == ['a']
+    assert queue.stats() == {'pending': 0, 'running': 0, 'succeeded': 1, 'retried': 0, 'dead_lettered': 0}
+
+
+def test_job_is_retried_until_it_succeeds():
+    queue = JobQueue('test', max_attempts=3, backoff=0.01)
+    job = FlakyJob(failures=2)
+    queue.submit(job, 'a')
+    assert queue.join(timeout=5)
+    assert job.calls == ['a', 'a', 'a']
+    assert queue.stats()['succeeded'] == 1
+    assert queue.stats()['retried'] == 2
+
+
+def test_job_is_dead_lettered_after_max_attempts(tmpdir):
+    dead_letter_log = str(tmpdir.join('dead_letter.log'))
+    queue = JobQueue('test', max_attempts=2, backoff=0.01, dead_letter_log=dead_letter_log)
+    job = FlakyJob(failures=5)
+    queue.submit(job, 'secret', description='flaky job')
+    assert queue.join(timeout=5)
+    assert len(job.calls) == 2
+    assert queue.stats()['dead_lettered'] == 1
+
+    with open(dead_letter_log) as log_file:
+        entries = [json.loads(line) for line in log_file]
+    assert len(entries) == 1
+    assert entries[0]['queue'] == 'test'
+    assert entries[0]['job'] == 'flaky job'
+    assert entries[0]['attempts'] == 2
+    assert entries[0]['error'] == 'RuntimeError: failure 2'
+    assert 'secret' not in json.dumps(entries)
+
+
+def test_non_retryable_job_is_dead_lettered_immediately():
+    queue = JobQueue('test', max_attempts=5, backoff=0.01, is_retryable=lambda exc: not isinstance(exc, ValueError))
+    job = FlakyJob(failures=5, exc_type=ValueError)
+    queue.submit(job, 'a')
+    assert queue.join(timeout=5)
+    assert len(job.calls) == 1
+    assert queue.stats()['dead_lettered'] == 1
+
+
+def test_full_queue_dead_letters_jobs():
+    queue = JobQueue('test', num_workers=0, max_pending=1)
+    assert queue.submit(FlakyJob(failures=0), 'a')
+    assert not queue.submit(FlakyJob(failures=0), 'b')
+    assert queue.stats()['pending'] == 1
+    assert queue.stats()['dead_lettered'] == 1
@@ -0,0 +1,55 @@
+#
+# Story Time App
+# Unit tests for the metrics helpers
+#
+
+import pytest
+
+from storytime.metrics_util import CallbackMetric, Counter, Histogram, MetricsRegistry
+
+
+def test_counter():
+    counter = Counter('requests_total', 'Requests', ('endpoint',))
+    counter.inc(endpoint='index')
+    counter.inc(2, endpoint='index')
+    assert counter.get(endpoint='index') == 3
+    assert counter.get(endpoint='other') == 0
+
+
+def test_labels_must_match():
+    counter = Counter('requests_total', 'Requests', ('endpoint',))
+    with pytest.raises(ValueError):
+        counter.inc(status=200)
+
+
+def test_histogram_render():
+    histogram = Histogram('duration_seconds', 'Duration', ('endpoint',), buckets=(0.1, 1))
+    histogram.observe(0.05, endpoint='index')
+    histogram.observe(0.5, endpoint='index')
+    histogram.observe(5, endpoint='index')
+    assert histogram.get_count(endpoint='index') == 3
+    assert histogram.render() == [
+        '# HELP duration_seconds Duration',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{endpoint="index",le="0.1"} 1',
+        'duration_seconds_bucket{endpoint="index",le="1"} 2',
+        'duration_seconds_bucket{endpoint="index",le="+Inf"} 3',
+        'duration_seconds_sum{endpoint="index"} 5.55',
+        'duration_seconds_count{endpoint="index"} 3'
+    ]
+
+
+def test_registry_render_escapes_label_values():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter('errors_total', 'Errors', ('message',)))
+    counter.inc(message='a "quoted"\nvalue')
+    assert registry.render() == '# HELP errors_total Errors\n# TYPE errors_total counter\n' \
+                                'errors_total{message="a \\"quoted\\"\\nvalue"} 1\n'
+
+
+def test_callback_metric():
+    depths = {('revocation',): 3}
+    gauge = CallbackMetric('queue_depth', 'Depth', 'gauge', lambda: dict(depths), ('queue',))
+    assert gauge.render()[-1] == 'queue_depth{queue="revocation"} 3'
+    depths[('revocation',)] = 0
+    assert gauge.render()[-1] == 'queue_depth{queue="revocation"} 0'
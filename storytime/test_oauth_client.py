@@ -0,0 +1,137 @@
+#
+# Story Time App
+# Unit tests for the OAuthClient, against a local stub provider
+#
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from storytime.oauth_client import OAuthClient, OAuthProviderError, is_retryable
+
+# How long the stub takes to answer each call
+STUB_DELAY = 0.3
+
+
+class StubProviderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.server.client_ports.add(self.client_address[1])
+        time.sleep(STUB_DELAY)
+        if url.path == '/graph/me':
+            body = {'id': '42', 'name': 'Test User', 'email': 'test@example.com'}
+        elif url.path == '/graph/me/picture':
+            body = {'data': {'url': 'https://example.com/{}.jpg'.format(params['width'])}}
+        elif url.path == '/graph/oauth/access_token':
+            body = {'access_token': 'long-' + params['fb_exchange_token']}
+        elif url.path == '/google/oauth2/v1/tokeninfo':
+            body = {'user_id': '7', 'issued_to': 'client'}
+        elif url.path == '/google/oauth2/v1/userinfo':
+            body = {'name': 'Test User', 'email': 'test@example.com', 'picture': 'p'}
+        else:
+            body = None
+        payload = json.dumps(body).encode('utf-8') if body is not None else b'not json'
+        self.send_response(200 if body is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        if urlparse(self.path).path == '/accounts/o/oauth2/revoke' and form.get('token') == ['valid']:
+            self.send_empty_response(200)
+        else:
+            self.send_empty_response(400)
+
+    def do_DELETE(self):
+        self.send_empty_response(503)
+
+    def send_empty_response(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_provider():
+    server = StubProviderServer(('127.0.0.1', 0), StubProviderHandler)
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server, timeout=(1, 2)):
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return OAuthClient(google_api_base_url=base_url + '/google', google_accounts_base_url=base_url + '/accounts',
+                       facebook_graph_base_url=base_url + '/graph', timeout=timeout)
+
+
+def test_facebook_user_and_picture_are_fetched_concurrently(stub_provider):
+    client = make_client(stub_provider)
+    start = time.monotonic()
+    user, picture = client.get_facebook_user_and_picture('token')
+    elapsed = time.monotonic() - start
+
+    assert user['email'] == 'test@example.com'
+    assert picture['data']['url'] == 'https://example.com/200.jpg'
+    assert elapsed < STUB_DELAY * 1.8
+
+
+def test_connections_are_reused(stub_provider):
+    client = make_client(stub_provider)
+    for _ in range(3):
+        assert client.exchange_facebook_token('app', 'secret', 'short')['access_token'] == 'long-short'
+    assert len(stub_provider.client_ports) == 1
+
+
+def test_google_token_and_user_info(stub_provider):
+    token_info, user_info = make_client(stub_provider).get_google_token_and_user_info('token')
+    assert token_info['user_id'] == '7'
+    assert user_info['name'] == 'Test User'
+
+
+def test_timeout_raises_provider_error(stub_provider):
+    client = make_client(stub_provider, timeout=(1, STUB_DELAY / 3))
+    with pytest.raises(OAuthProviderError):
+        client.exchange_facebook_token('app', 'secret', 'short')
+
+
+def test_invalid_response_raises_provider_error(stub_provider):
+    client = make_client(stub_provider)
+    client.facebook_graph_base_url += '/missing'
+    with pytest.raises(OAuthProviderError):
+        client.exchange_facebook_token('app', 'secret', 'short')
+
+
+def test_revoke_google_token(stub_provider):
+    client = make_client(stub_provider)
+    client.revoke_google_token('valid')
+    with pytest.raises(OAuthProviderError) as exc_info:
+        client.revoke_google_token('invalid')
+    assert not is_retryable(exc_info.value)
+    assert 'invalid' not in str(exc_info.value)
+
+
+def test_revoke_facebook_permissions_server_error_is_retryable(stub_provider):
+    with pytest.raises(OAuthProviderError) as exc_info:
+        make_client(stub_provider).revoke_facebook_permissions('42', 'token')
+    assert is_retryable(exc_info.value)
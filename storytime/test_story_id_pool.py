@@ -0,0 +1,119 @@
+#
+# Story Time App
+# Unit tests for the StoryIdPool
+#
+
+import random
+import threading
+from collections import Counter
+
+from storytime.story_id_pool import StoryIdPool
+
+
+def make_pool(ids):
+    return StoryIdPool(load_ids=lambda after_id: [story_id for story_id in ids if story_id > after_id],
+                       rng=random.Random(1234))
+
+
+def test_choice_is_uniform():
+    ids = list(range(1, 11))
+    pool = make_pool(ids)
+    samples = 20000
+    counts = Counter(pool.choice() for _ in range(samples))
+
+    assert set(counts) == set(ids)
+    expected = samples / len(ids)
+    assert all(abs(count - expected) < expected * 0.1 for count in counts.values())
+
+
+def test_choice_empty_pool():
+    assert make_pool([]).choice() is None
+
+
+def test_discard_and_add():
+    pool = make_pool([1, 2, 3])
+    pool.reload()
+    pool.discard(2)
+    assert {pool.choice() for _ in range(200)} == {1, 3}
+
+    pool.add(7)
+    pool.add(7)
+    assert len(pool) == 3
+    assert {pool.choice() for _ in range(200)} == {1, 3, 7}
+
+
+def test_refresh_loads_only_new_ids():
+    ids = [1, 2]
+    pool = make_pool(ids)
+    pool.reload()
+    pool.discard(1)
+    ids.append(5)
+    pool.refresh()
+    assert {pool.choice() for _ in range(200)} == {2, 5}
+
+
+def test_discard_keeps_pool_dense():
+    pool = make_pool(list(range(1, 101)))
+    pool.reload()
+    for story_id in range(1, 101, 2):
+        pool.discard(story_id)
+    pool.discard(1000)
+    assert len(pool) == 50
+    assert {pool.choice() for _ in range(5000)} == set(range(2, 101, 2))
+
+    pool.add(3)
+    pool.discard(100)
+    pool.add(4)
+    assert len(pool) == 50
+    assert {pool.choice() for _ in range(5000)} == set(range(2, 100, 2)) | {3}
+
+
+def test_choice_does_not_wait_for_refreshes():
+    threads = []
+
+    def load_ids(after_id):
+        threads.append(threading.current_thread())
+        return [1, 2]
+
+    pool = StoryIdPool(load_ids=load_ids, reload_interval=0)
+    for _ in range(10):
+        assert pool.choice() in (1, 2)
+    # Only the first load is done by a request
+    assert threads[0] == threading.current_thread()
+    assert threading.current_thread() not in threads[1:]
+    pool.stop()
+
+
+def make_background_pool(ids, reload_interval: float):
+    loaded = threading.Event()
+    pool = StoryIdPool(load_ids=lambda after_id: [story_id for story_id in ids if story_id > after_id],
+                       refresh_interval=0.01, reload_interval=reload_interval, on_background_load=loaded.set)
+    return pool, loaded
+
+
+def wait_for_background_loads(loaded):
+    # Wait for two loads, as the first may have started before the ids changed
+    for _ in range(2):
+        loaded.clear()
+        assert loaded.wait(5)
+
+
+def test_background_refresh_adds_new_ids():
+    ids = [1, 2]
+    pool, loaded = make_background_pool(ids, reload_interval=3600)
+    pool.choice()
+    ids.append(5)
+    wait_for_background_loads(loaded)
+    pool.stop()
+    assert len(pool) == 3
+    assert {pool.choice() for _ in range(200)} == {1, 2, 5}
+
+
+def test_background_reload_removes_ids():
+    ids = [1, 2]
+    pool, loaded = make_background_pool(ids, reload_interval=0)
+    pool.choice()
+    ids.remove(1)
+    wait_for_background_loads(loaded)
+    pool.stop()
+    assert {pool.choice() for _ in range(200)} == {2}
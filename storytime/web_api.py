@@ -3,35 +3,320 @@
 # Web JSON API
 #
 
-from flask import Blueprint, jsonify, request
-from werkzeug.exceptions import NotFound
+from flask import Blueprint, Response, current_app, json, jsonify, request, stream_with_context
+from werkzeug.exceptions import BadRequest, NotFound
 
 from storytime import story_time_service
+from storytime.http_util import get_not_modified_response, make_etag, set_validators
+from storytime.story_time_db_init import Story
 
 web_api = Blueprint('web_api', __name__, template_folder='templates')
 
+API_STORIES_LIMIT_DEFAULT = 50
+API_STORIES_LIMIT_MAX = 100
+# The most stories that can be fetched by id in one request, unless the API_STORIES_IDS_MAX config setting is set
+API_STORIES_IDS_MAX_DEFAULT = 100
+API_SEARCH_LIMIT_DEFAULT = 20
+API_SEARCH_LIMIT_MAX = 100
+API_STORY_TEXT_LIMIT_DEFAULT = story_time_service.STORY_TEXT_PAGE_SIZE
+API_STORY_TEXT_LIMIT_MAX = 500
+
+# The story fields returned by the story list endpoints unless the fields parameter is given
+API_STORY_LIST_FIELDS_DEFAULT = Story.SUMMARY_FIELDS
+
+# Streaming
+STREAM_FORMAT_JSON = 'json'
+STREAM_FORMAT_NDJSON = 'ndjson'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _get_int_arg(name: str, default: int = None):
+    """
+    Gets an integer query string argument. Raises BadRequest if the argument is present but not an integer.
+    :param name: the name of the query string argument
+    :param default: the value to return if the argument is not present
+    :return: the integer value of the argument or the default
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest('The {} parameter must be an integer.'.format(name))
+
+
+def _get_bool_arg(name: str, default: bool = False):
+    """
+    Gets a boolean query string argument. Raises BadRequest if the argument is present but not true or false.
+    :param name: the name of the query string argument
+    :param default: the value to return if the argument is not present
+    :return: the boolean value of the argument or the default
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise BadRequest('The {} parameter must be true or false.'.format(name))
+
+
+def _get_int_list_arg(name: str):
+    """
+    Gets a comma separated list of integers query string argument. Raises BadRequest if an item is not an integer.
+    :param name: the name of the query string argument
+    :return: a list of integers (empty if the argument is not present)
+    """
+    try:
+        return [int(item) for item in request.args.get(name, '').split(',') if item.strip()]
+    except ValueError:
+        raise BadRequest('The {} parameter must be a comma separated list of integers.'.format(name))
+
+
+def _get_fields_arg(allowed_fields: tuple, default: tuple):
+    """
+    Gets the comma separated list of fields to return from the fields query string argument. Raises BadRequest if
+    a field is not one of the allowed fields.
+    :param allowed_fields: the fields that may be requested
+    :param default: the fields to return if the argument is not present
+    :return: a tuple of field names
+    """
+    value = request.args.get('fields')
+    if value is None or value == '':
+        return default
+    fields = tuple(field.strip() for field in value.split(',') if field.strip())
+    invalid_fields = [field for field in fields if field not in allowed_fields]
+    if invalid_fields or not fields:
+        raise BadRequest('The fields parameter must be a comma separated list of: {}.'.format(
+            ', '.join(allowed_fields)))
+    return fields
+
+
+def _buffer_chunks(chunks):
+    """
+    Joins small string chunks into chunks of at least STREAM_CHUNK_SIZE characters, so a streamed response is not
+    written to the socket one item at a time.
+    :param chunks: an iterator of strings
+    :return: an iterator of strings
+    """
+    buffer = []
+    buffer_size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+        if buffer_size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            buffer_size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _serialize(item):
+    return item.serialize
+
+
+def _generate_json_envelope(key: str, items, serialize):
+    """
+    Generates a JSON document of the form {key: [serialize(item), ...]} one item at a time.
+    """
+    yield '{{{}: ['.format(json.dumps(key))
+    for index, item in enumerate(items):
+        yield (',' if index else '') + json.dumps(serialize(item))
+    yield ']}'
+
+
+def _generate_ndjson(items, serialize):
+    """
+    Generates newline delimited JSON with one serialize(item) per line.
+    """
+    for item in items:
+        yield json.dumps(serialize(item)) + '\n'
+
+
+def _stream_response(key: str, items, stream_format: str, serialize=_serialize):
+    """
+    Creates a streamed response that serializes the given items as they are iterated, so the full collection is
+    never held in memory. Raises BadRequest if the stream format is not supported.
+    :param key: the name of the collection in the JSON envelope
+    :param items: an iterator of objects
+    :param stream_format: STREAM_FORMAT_JSON for a {key: [...]} envelope or STREAM_FORMAT_NDJSON for one item per line
+    :param serialize: a function that returns the JSON serializable form of an item (defaults to its serialize
+    property)
+    :return: the response
+    """
+    if stream_format == STREAM_FORMAT_JSON:
+        chunks, mimetype = _generate_json_envelope(key, items, serialize), 'application/json'
+    elif stream_format == STREAM_FORMAT_NDJSON:
+        chunks, mimetype = _generate_ndjson(items, serialize), 'application/x-ndjson'
+    else:
+        raise BadRequest('The stream parameter must be one of: {}, {}.'.format(STREAM_FORMAT_JSON,
+                                                                               STREAM_FORMAT_NDJSON))
+
+    # Keep the request context (and with it the DB session) alive until the last chunk has been sent
+    return Response(stream_with_context(_buffer_chunks(chunks)), mimetype=mimetype)
+
 
 @web_api.route('/api/stories')
 def api_stories():
-    category_id = request.args.get('category')
-    if category_id:
-        stories = story_time_service.get_published_stories_by_category_id(category_id)
-    else:
-        stories = story_time_service.get_published_stories()
-    return jsonify(Stories=[story.serialize for story in stories])
+    category_id = _get_int_arg('category')
+    fields = _get_fields_arg(Story.FIELDS, API_STORY_LIST_FIELDS_DEFAULT)
+
+    # Fetch the stories with the given ids if requested
+    if 'ids' in request.args:
+        return _api_stories_by_ids(fields)
+
+    # Return 304 if the client's copy of the list is current
+    last_modified, count = story_time_service.get_published_stories_version(category_id=category_id)
+    etag = make_etag('stories', last_modified, count, sorted(request.args.items()))
+    not_modified = get_not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    # Stream the full collection if requested
+    stream_format = request.args.get('stream')
+    if stream_format:
+        return set_validators(_stream_response('Stories', story_time_service.iter_published_stories(
+            category_id=category_id, fields=fields), stream_format, lambda story: story.serialize_fields(fields)),
+            etag, last_modified)
+
+    limit = _get_int_arg('limit', API_STORIES_LIMIT_DEFAULT)
+    if not 1 <= limit <= API_STORIES_LIMIT_MAX:
+        raise BadRequest('The limit parameter must be between 1 and {}.'.format(API_STORIES_LIMIT_MAX))
+
+    try:
+        page = story_time_service.get_published_stories_page(cursor=request.args.get('cursor'), limit=limit,
+                                                             category_id=category_id, fields=fields)
+    except ValueError:
+        raise BadRequest('The cursor parameter is not valid.')
+
+    return set_validators(jsonify(Stories=[story.serialize_fields(fields) for story in page.stories],
+                                  NextCursor=page.next_cursor), etag, last_modified)
+
+
+def _api_stories_by_ids(fields: tuple):
+    """
+    Creates the response to a request for the stories with the ids in the ids parameter, in the order of the ids,
+    listing the ids no story was found for. Raises BadRequest if there are more ids than API_STORIES_IDS_MAX or
+    the ids parameter is combined with a parameter that pages or filters the list.
+    :param fields: the fields of the stories to return
+    :return: the response
+    """
+    for name in ('category', 'cursor', 'limit', 'stream'):
+        if name in request.args:
+            raise BadRequest('The ids parameter cannot be combined with the {} parameter.'.format(name))
+    story_ids = _get_int_list_arg('ids')
+    ids_max = current_app.config.get('API_STORIES_IDS_MAX', API_STORIES_IDS_MAX_DEFAULT)
+    if not 1 <= len(story_ids) <= ids_max:
+        raise BadRequest('The ids parameter must list between 1 and {} story ids.'.format(ids_max))
+
+    batch = story_time_service.get_stories_by_ids(story_ids, fields=fields)
+
+    # Return 304 if the client's copy of the stories is current
+    etag = make_etag('stories_by_ids', [(story.id, story.date_last_modified) for story in batch.stories],
+                     batch.missing_ids, fields)
+    not_modified = get_not_modified_response(etag)
+    if not_modified:
+        return not_modified
+
+    return set_validators(jsonify(Stories=[story.serialize_fields(fields) for story in batch.stories],
+                                  MissingIds=batch.missing_ids), etag)
 
 
 @web_api.route('/api/stories/<int:story_id>')
 def api_story(story_id):
-    story = story_time_service.get_story_by_id(story_id)
+    fields = _get_fields_arg(Story.FIELDS, Story.FIELDS)
+
+    # Return 304 if the client's copy of the story is current
+    last_modified = story_time_service.get_story_last_modified(story_id)
+    if not last_modified:
+        raise NotFound
+
+    etag = make_etag('story', story_id, last_modified, fields)
+    not_modified = get_not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    story = story_time_service.get_story_by_id(story_id, fields=fields)
     if not story:
         raise NotFound
 
-    return jsonify(Story=story.serialize)
+    return set_validators(jsonify(Story=story.serialize_fields(fields)), etag, last_modified)
+
+
+@web_api.route('/api/stories/<int:story_id>/text')
+def api_story_text(story_id):
+    offset = _get_int_arg('offset', 0)
+    if offset < 0:
+        raise BadRequest('The offset parameter must not be negative.')
+    limit = _get_int_arg('limit', API_STORY_TEXT_LIMIT_DEFAULT)
+    if not 1 <= limit <= API_STORY_TEXT_LIMIT_MAX:
+        raise BadRequest('The limit parameter must be between 1 and {}.'.format(API_STORY_TEXT_LIMIT_MAX))
+
+    # Return 304 if the client's copy of the page is current
+    last_modified = story_time_service.get_story_last_modified(story_id)
+    if not last_modified:
+        raise NotFound
+
+    etag = make_etag('story_text', story_id, last_modified, offset, limit)
+    not_modified = get_not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+
+    page = story_time_service.get_story_text_page(story_id, offset=offset, limit=limit)
+    if not page:
+        raise NotFound
+
+    return set_validators(jsonify(Paragraphs=page.paragraphs, Offset=page.offset, Total=page.total,
+                                  NextOffset=page.next_offset), etag, last_modified)
+
+
+@web_api.route('/api/search')
+def api_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise BadRequest('The q parameter is required.')
+    category_id = _get_int_arg('category')
+    limit = _get_int_arg('limit', API_SEARCH_LIMIT_DEFAULT)
+    if not 1 <= limit <= API_SEARCH_LIMIT_MAX:
+        raise BadRequest('The limit parameter must be between 1 and {}.'.format(API_SEARCH_LIMIT_MAX))
+
+    try:
+        page = story_time_service.search_stories(query, category_id=category_id, cursor=request.args.get('cursor'),
+                                                 limit=limit)
+    except ValueError:
+        raise BadRequest('The cursor parameter is not valid.')
+
+    # The story text is not loaded for search results, so results hold the story summary and the snippet
+    results = [{
+        'id': result.story.id,
+        'title': result.story.title,
+        'description': result.story.description,
+        'user_id': result.story.user_id,
+        'date_created': result.story.date_created,
+        'date_last_modified': result.story.date_last_modified,
+        'categories': [category.serialize for category in result.story.categories],
+        'rank': result.rank,
+        'snippet': result.snippet
+    } for result in page.results]
+    return jsonify(Results=results, NextCursor=page.next_cursor)
 
 
 @web_api.route('/api/categories')
 def api_categories():
+    stream_format = request.args.get('stream')
+    if _get_bool_arg('counts'):
+        if stream_format:
+            raise BadRequest('The counts parameter cannot be combined with the stream parameter.')
+        categories = story_time_service.get_categories_with_counts()
+        return jsonify(Categories=[dict(result.category.serialize, published_count=result.published_count)
+                                   for result in categories])
+
+    if stream_format:
+        return _stream_response('Categories', story_time_service.iter_categories(), stream_format)
+
     categories = story_time_service.get_categories()
     return jsonify(Categories=[category.serialize for category in categories])
 